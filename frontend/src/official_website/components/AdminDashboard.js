@@ -26,6 +26,7 @@ ChartJS.register(
 
 const socket = io("http://localhost:3001", {
   transports: ["websocket", "polling"],
+  withCredentials: true,
 });
 
 const AdminDashboard = () => {
@@ -68,6 +69,7 @@ const AdminDashboard = () => {
   useEffect(() => {
     const socket = io("http://localhost:3001", {
       transports: ["websocket", "polling"],
+      withCredentials: true,
     });
 
     socket.on("connect", () => {
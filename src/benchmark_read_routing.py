@@ -0,0 +1,154 @@
+# Mixed read/write load with and without read-only routing (see read_routing.py).
+# - Reader threads load the owner dashboard and the admin reports while writer threads book appointments,
+#   first with READ_ROUTING_ENABLED off and then on; each run reports throughput and latency percentiles.
+# - Run it against a scratch database, never mps.db:
+#     SQLALCHEMY_DATABASE_URI=sqlite:////tmp/mps_bench.db SQLITE_JOURNAL_MODE=wal \
+#         python benchmark_read_routing.py --readers 8 --writers 2 --seconds 10
+import argparse
+import itertools
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, time as day_time, timedelta
+
+import pytz
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from config import Config
+
+if Config.SQLALCHEMY_DATABASE_URI == 'sqlite:///' + os.path.join(Config.basedir, 'mps.db'):
+    sys.exit('Set SQLALCHEMY_DATABASE_URI to a scratch database; the benchmark writes to it.')
+
+from official_website import app, db
+from official_website.models import User, Service, WorkingHours
+from business_owner.models import BusinessOwner, Appointment
+from business_owner.line_items import make_line_item
+import business_owner  # noqa: F401  (registers the shop routes and upgrades the schema)
+from werkzeug.security import generate_password_hash
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+# One shop open 00:00-23:59 every day with `appointments` past bookings, so the dashboard has rows to read.
+def seed(appointments):
+    username = 'bench_' + uuid.uuid4().hex[:6]
+    with app.app_context():
+        user = User(personal_name='Bench', company_name=username, store_address='-', phone_number='+70000000000',
+                    email=f'{username}@bench.local', status='Approved')
+        db.session.add(user)
+        db.session.flush()
+        service = Service(title='Slot', cost=10, description='Benchmark slot', service_time=15, user_id=user.id)
+        db.session.add(service)
+        db.session.add_all(WorkingHours(day=day, start_time=day_time(0), end_time=day_time(23, 59), user_id=user.id)
+                           for day in DAYS)
+        owner = BusinessOwner(user_id=user.id, personal_name='Bench', company_name=username, store_address='-',
+                              phone_number='+70000000000', email=f'{username}@bench.local', username=username,
+                              password=generate_password_hash('bench'), qr_code_link='-')
+        db.session.add(owner)
+        db.session.flush()
+
+        start = datetime.now(MOSCOW_TZ).replace(tzinfo=None, minute=0, second=0, microsecond=0) - timedelta(days=365)
+        items = json.dumps([make_line_item(service, 1)])
+        db.session.add_all(Appointment(
+            owner_id=owner.id, client_name='Client', client_email='client@bench.local',
+            phone_number=f'+7900{index:07d}', service=items, date=start + timedelta(minutes=15 * index),
+            end_time=start + timedelta(minutes=15 * (index + 1)), total_service_time=15, num_services=1,
+            total_cost=10, status='Completed'
+        ) for index in range(appointments))
+        db.session.commit()
+        return {'owner_id': owner.id, 'user_id': user.id, 'username': username, 'service_id': service.id}
+
+
+# `slots` numbers the 15-minute booking slots from tomorrow on; runs share it so every booking gets a free slot.
+def run(shop, slots, readers, writers, seconds, routed):
+    app.config['READ_ROUTING_ENABLED'] = routed
+    latencies = {'read': [], 'write': []}
+    errors = {'read': 0, 'write': 0}
+    lock = threading.Lock()
+    first_slot = datetime.now(MOSCOW_TZ).replace(minute=0, second=0, microsecond=0) + timedelta(days=1)
+
+    def record(kind, started, ok):
+        with lock:
+            latencies[kind].append(time.perf_counter() - started)
+            if not ok:
+                errors[kind] += 1
+
+    def reader(client, index):
+        paths = ['/api/business_owner/dashboard_data', '/api/reports?time_filter=yearly']
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            response = client.get(paths[index % len(paths)])
+            record('read', started, response.status_code == 200)
+            index += 1
+
+    def writer(client):
+        while time.monotonic() < deadline:
+            with lock:
+                slot = next(slots)
+            started = time.perf_counter()
+            response = client.post(f"/api/shop/{shop['username']}/reserve", json={
+                'client_name': 'Writer', 'client_email': 'writer@bench.local',
+                'services': [{'id': shop['service_id'], 'quantity': 1}],
+                'date': (first_slot + timedelta(minutes=15 * slot)).strftime('%Y-%m-%d %H:%M')
+            })
+            record('write', started, response.status_code == 200)
+
+    # Sessions are set up one client at a time, before the clock starts
+    threads = []
+    for index in range(readers):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['owner_id'] = shop['owner_id']
+            session['user_id'] = shop['user_id']
+            session['admin_id'] = 1
+            session['expires_at'] = (datetime.now(MOSCOW_TZ) + timedelta(hours=1)).isoformat()
+        threads.append(threading.Thread(target=reader, args=(client, index)))
+    for index in range(writers):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['verified_phone_number'] = f'+7911{index:07d}'
+            session['option_selected'] = 'no'
+        threads.append(threading.Thread(target=writer, args=(client,)))
+
+    deadline = time.monotonic() + seconds
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for kind in ('read', 'write'):
+        samples = sorted(latencies[kind])
+        if not samples:
+            print(f"  {kind:5}  no requests")
+            continue
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        print(f"  {kind:5}  {len(samples) / seconds:8.1f} req/s  p50 {statistics.median(samples) * 1000:7.1f} ms  "
+              f"p95 {p95 * 1000:7.1f} ms  errors {errors[kind]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mixed read/write load with and without read-only routing.')
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--appointments', type=int, default=2000, help='Past bookings seeded for the dashboard to read')
+    args = parser.parse_args()
+
+    shop = seed(args.appointments)
+    slots = itertools.count()
+    print(f"{args.readers} readers, {args.writers} writers, {args.seconds:g}s per run, "
+          f"{args.appointments} seeded appointments, journal mode {app.config.get('SQLITE_JOURNAL_MODE') or 'default'}")
+    for routed in (False, True):
+        print(f"read routing {'on' if routed else 'off'}:")
+        run(shop, slots, args.readers, args.writers, args.seconds, routed)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,4 +17,24 @@ with app.app_context():
 
 from official_website import app, db  # Import app and db from the official_website module
 
-from business_owner import models, routes
+from sharding import sharding_enabled, init_shard_schemas
+from business_owner import models, dependencies, routes
+from business_owner.clients import upgrade_client_schema
+from business_owner.archive import ensure_history_view
+from business_owner.line_items import upgrade_line_item_snapshots
+from business_owner.events import ensure_event_log, create_event_log_triggers
+from business_owner.status import upgrade_status_columns, APPOINTMENT_CODES, CHANGE_REQUEST_CODES
+
+with app.app_context():
+    db.create_all()
+    upgrade_client_schema()
+    upgrade_status_columns(db, [
+        (models.Appointment.__table__, APPOINTMENT_CODES),
+        (models.AppointmentArchive.__table__, APPOINTMENT_CODES),
+        (models.RequestChange.__table__, CHANGE_REQUEST_CODES),
+    ])
+    upgrade_line_item_snapshots()
+    ensure_history_view()
+    if sharding_enabled():
+        init_shard_schemas(db, [ensure_history_view, create_event_log_triggers])
+    ensure_event_log()
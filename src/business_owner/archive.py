@@ -0,0 +1,95 @@
+import logging
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import insert, literal, select, text
+
+from official_website import app, db
+from invalidation import invalidate_on_commit
+from .models import Appointment, AppointmentArchive, RequestChange
+from .status import AppointmentStatus
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+logger = logging.getLogger(__name__)
+
+# Statuses that end an appointment's day-to-day life; only these are archived.
+CLOSED_STATUSES = (AppointmentStatus.COMPLETED, AppointmentStatus.CANCELLED, AppointmentStatus.REJECTED)
+
+# Columns the two tables share, in the order the view lists them.
+HISTORY_COLUMNS = [column.name for column in Appointment.__table__.columns]
+
+# Every appointment, hot or archived, for reporting; `archived` tells them apart.
+# It is a view, so it lives in its own metadata and create_all never makes it a table.
+appointment_history = db.Table(
+    'appointment_history', db.MetaData(),
+    *[db.Column(column.name, column.type, primary_key=column.primary_key) for column in Appointment.__table__.columns],
+    db.Column('archived', db.Boolean)
+)
+
+
+# (Re)creates the appointment_history view (in `engine`'s database, the main one by default); runs at startup
+# so the view follows column changes.
+def ensure_history_view(engine=None):
+    columns = ', '.join(HISTORY_COLUMNS)
+    with (engine or db.engine).begin() as conn:
+        conn.execute(text("DROP VIEW IF EXISTS appointment_history"))
+        conn.execute(text(
+            f"CREATE VIEW appointment_history AS "
+            f"SELECT {columns}, 0 AS archived FROM appointment "
+            f"UNION ALL SELECT {columns}, 1 AS archived FROM appointment_archive"
+        ))
+
+
+# Moves closed appointments older than APPOINTMENT_ARCHIVE_AFTER_DAYS into appointment_archive.
+# - Works in batches of APPOINTMENT_ARCHIVE_BATCH_SIZE, one transaction each: copy, drop the rows' leftover
+#   change requests, delete. A failure leaves the batch where it was.
+# - Returns the number of appointments moved.
+def archive_appointments(batch_size=None):
+    batch_size = batch_size or app.config['APPOINTMENT_ARCHIVE_BATCH_SIZE']
+    cutoff = datetime.now(MOSCOW_TZ).replace(tzinfo=None) - timedelta(days=app.config['APPOINTMENT_ARCHIVE_AFTER_DAYS'])
+    columns = [getattr(Appointment, name) for name in HISTORY_COLUMNS]
+    moved = 0
+
+    while True:
+        batch = db.session.query(Appointment.id, Appointment.owner_id, Appointment.client_id).filter(
+            Appointment.status.in_(CLOSED_STATUSES),
+            Appointment.date < cutoff
+        ).order_by(Appointment.id).limit(batch_size).all()
+        if not batch:
+            break
+        ids = [row.id for row in batch]
+
+        db.session.execute(insert(AppointmentArchive).from_select(
+            HISTORY_COLUMNS + ['archived_at'],
+            select(*columns, literal(datetime.now(MOSCOW_TZ).replace(tzinfo=None))).where(Appointment.id.in_(ids))
+        ))
+        RequestChange.query.filter(RequestChange.appointment_id.in_(ids)).delete(synchronize_session=False)
+        Appointment.query.filter(Appointment.id.in_(ids)).delete(synchronize_session=False)
+
+        keys = {f'appointment:{row.id}' for row in batch}
+        keys.update(f'owner:{row.owner_id}:appointments' for row in batch)
+        keys.update(f'owner:{row.owner_id}:change_requests' for row in batch)
+        keys.update(f'client:{row.client_id}:appointments' for row in batch if row.client_id)
+        invalidate_on_commit(db.session, keys)
+        db.session.commit()
+
+        moved += len(ids)
+        if len(ids) < batch_size:
+            break
+
+    if moved:
+        logger.info("Archived %s appointments closed before %s", moved, cutoff.date())
+    return moved
+
+
+# Runs the archiver from the background scheduler.
+def run_appointment_archiver():
+    with app.app_context():
+        try:
+            archive_appointments()
+        except Exception as e:
+            logger.error("Error archiving appointments: %s", e)
+            db.session.rollback()
+        finally:
+            db.session.remove()
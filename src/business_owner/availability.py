@@ -0,0 +1,429 @@
+import json
+import logging
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import event, inspect
+
+from official_website import app, db
+from official_website.models import Service
+from realtime import socketio, emit_to_slots
+from .models import BusinessOwner, Appointment, NextAvailable, ShopCapacity
+from .hours import get_calendar
+from .status import ACTIVE_STATUSES, is_active
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+logger = logging.getLogger(__name__)
+
+SLOT_MINUTES = 60
+SLOT_LENGTH = timedelta(minutes=SLOT_MINUTES)
+DAY_MINUTES = 24 * 60
+
+PENDING_KEY = 'pending_slot_changes'
+
+
+# Appointment datetimes are written as Moscow wall-clock time and SQLite hands them back without a zone.
+def to_moscow(value):
+    if value.tzinfo is None:
+        return MOSCOW_TZ.localize(value)
+    return value.astimezone(MOSCOW_TZ)
+
+
+def _minutes(value):
+    return value.hour * 60 + value.minute
+
+
+def _service_ids(appointment_service):
+    try:
+        return {item['id'] for item in json.loads(appointment_service or '[]')}
+    except (TypeError, ValueError, KeyError):
+        return set()
+
+
+# Returns (shop capacity, {service_id: capacity}) for an owner; shops without settings serve one booking at a time.
+def get_capacities(owner_id):
+    shop_capacity = 1
+    service_capacities = {}
+    for setting in ShopCapacity.query.filter_by(owner_id=owner_id).all():
+        if setting.service_id is None:
+            shop_capacity = setting.capacity
+        else:
+            service_capacities[setting.service_id] = setting.capacity
+    return shop_capacity, service_capacities
+
+
+# Loads the active bookings of an owner overlapping [start, end) as (start, end, service_ids) in Moscow time.
+# - is_active() matches the partial index ix_appointment_active_owner_date, so only slot-holding rows are read.
+# - `exclude_id` leaves out one appointment, e.g. the one being moved.
+def load_bookings(owner_id, start, end, exclude_id=None):
+    query = db.session.query(Appointment.date, Appointment.end_time, Appointment.service).filter(
+        Appointment.owner_id == owner_id,
+        is_active(Appointment.status),
+        Appointment.date < end.replace(tzinfo=None),
+        Appointment.end_time > start.replace(tzinfo=None)
+    )
+    if exclude_id is not None:
+        query = query.filter(Appointment.id != exclude_id)
+    rows = query.all()
+    return [(to_moscow(b_start), to_moscow(b_end), _service_ids(service)) for b_start, b_end, service in rows if b_start and b_end]
+
+
+# Counts overlapping bookings for every minute of `num_days` days starting at `first_day`, with a difference array:
+# +1 at each booking's first minute, -1 after its last, then a running sum along the day.
+# - Rows are padded with SLOT_MINUTES zeros so slots near midnight can be read without bounds checks.
+# - A whole month is done in one vectorized pass with NumPy when it is installed.
+def minute_occupancy(bookings, first_day, num_days):
+    width = DAY_MINUTES + SLOT_MINUTES
+    marks = []
+    for b_start, b_end, _ in bookings:
+        day_index = (b_start.date() - first_day).days
+        start_minute = day_index * DAY_MINUTES + _minutes(b_start)
+        end_minute = start_minute + int((b_end - b_start).total_seconds() // 60)
+        start_minute = max(start_minute, 0)
+        end_minute = min(end_minute, num_days * DAY_MINUTES)
+        if start_minute < end_minute:
+            marks.append((start_minute, end_minute))
+
+    if np is not None and num_days > 1:
+        diff = np.zeros(num_days * DAY_MINUTES + 1, dtype=np.int32)
+        if marks:
+            starts, ends = np.array(marks).T
+            np.add.at(diff, starts, 1)
+            np.add.at(diff, ends, -1)
+        occupancy = np.cumsum(diff[:-1]).reshape(num_days, DAY_MINUTES)
+        return np.pad(occupancy, ((0, 0), (0, SLOT_MINUTES)))
+
+    diff = [0] * (num_days * DAY_MINUTES + 1)
+    for start_minute, end_minute in marks:
+        diff[start_minute] += 1
+        diff[end_minute] -= 1
+    occupancy, running = [], 0
+    for day_index in range(num_days):
+        row = []
+        for minute in range(day_index * DAY_MINUTES, (day_index + 1) * DAY_MINUTES):
+            running += diff[minute]
+            row.append(running)
+        occupancy.append(row + [0] * SLOT_MINUTES)
+    return occupancy
+
+
+# Peak occupancy of every window [m, m + SLOT_MINUTES) of each day, indexed by window start minute.
+def slot_peaks(occupancy):
+    if np is not None and isinstance(occupancy, np.ndarray):
+        return np.lib.stride_tricks.sliding_window_view(occupancy, SLOT_MINUTES, axis=1).max(axis=2)
+    return [[max(row[m:m + SLOT_MINUTES]) for m in range(DAY_MINUTES)] for row in occupancy]
+
+
+# Computes the hourly slots of `num_days` days starting at `first_day` for a shop.
+# - Slots run through each open window of the owner's calendar (weekly hours merged with date overrides);
+#   past slots of today are left out.
+# - A slot is 'occupied' once the bookings overlapping it reach the shop's capacity, or the capacity of
+#   `service_id` when given; 'remaining' tells how many more bookings it can take.
+# Returns {date: slots}, with None for days the shop does not work.
+def compute_slots(owner, first_day, num_days, service_id=None):
+    calendar = get_calendar(owner.user_id)
+    shop_capacity, service_capacities = get_capacities(owner.id)
+    service_capacity = service_capacities.get(service_id) if service_id else None
+
+    range_start = MOSCOW_TZ.localize(datetime.combine(first_day, datetime.min.time()))
+    range_end = MOSCOW_TZ.localize(datetime.combine(first_day + timedelta(days=num_days), datetime.min.time()))
+    bookings = load_bookings(owner.id, range_start, range_end)
+    logger.debug("Bookings found from %s for %d days: %d", first_day, num_days, len(bookings))
+
+    shop_peaks = slot_peaks(minute_occupancy(bookings, first_day, num_days))
+    service_peaks = None
+    if service_capacity is not None:
+        service_bookings = [b for b in bookings if service_id in b[2]]
+        service_peaks = slot_peaks(minute_occupancy(service_bookings, first_day, num_days))
+
+    now = datetime.now(MOSCOW_TZ)
+    result = {}
+    for day_index in range(num_days):
+        date = first_day + timedelta(days=day_index)
+        windows = calendar.open_datetimes(date)
+        if not windows:
+            result[date] = None
+            continue
+
+        slots = []
+        for current_time, end_time in windows:
+            while current_time < end_time:
+                if date > now.date() or (date == now.date() and current_time.time() > now.time()):
+                    minute = _minutes(current_time)
+                    remaining = shop_capacity - int(shop_peaks[day_index][minute])
+                    if service_peaks is not None:
+                        remaining = min(remaining, service_capacity - int(service_peaks[day_index][minute]))
+                    remaining = max(remaining, 0)
+                    slots.append({
+                        'time': current_time.strftime('%H:%M'),
+                        'status': 'free' if remaining else 'occupied',
+                        'remaining': remaining
+                    })
+                current_time += SLOT_LENGTH
+        result[date] = slots
+    return result
+
+
+# Computes the hourly slots of one day for a shop; None when the shop does not work on that day.
+def compute_day_slots(owner, date, service_id=None):
+    return compute_slots(owner, date, 1, service_id)[date]
+
+
+# Highest number of the given intervals overlapping at any point of [start, end), by sweeping their ends in order.
+def peak_overlap(intervals, start, end):
+    events = []
+    for i_start, i_end in intervals:
+        i_start, i_end = max(i_start, start), min(i_end, end)
+        if i_start < i_end:
+            events.append((i_start, 1))
+            events.append((i_end, -1))
+    events.sort(key=lambda e: (e[0], e[1]))
+
+    peak = current = 0
+    for _, delta in events:
+        current += delta
+        peak = max(peak, current)
+    return peak
+
+
+# Serializes admission to an owner's calendar for the rest of the transaction.
+# - Bumping the shop-wide ShopCapacity row takes SQLite's write lock (a row lock on other databases) before
+#   bookings are counted, so two reservations can never both see the last free place.
+def lock_owner_calendar(owner_id):
+    locked = ShopCapacity.query.filter(
+        ShopCapacity.owner_id == owner_id,
+        ShopCapacity.service_id.is_(None)
+    ).update({ShopCapacity.admissions: ShopCapacity.admissions + 1}, synchronize_session=False)
+    if not locked:
+        db.session.add(ShopCapacity(owner_id=owner_id, service_id=None, capacity=1, admissions=1))
+        db.session.flush()
+
+
+# Checks whether a booking of `service_ids` over [start, end) fits the shop's capacities, after locking the calendar.
+# The caller must add (or move) the appointment and commit in the same transaction (or roll back when it does not fit).
+# - `exclude_id` is the appointment being moved, which does not compete with itself for its new time.
+def admit_booking(owner_id, start, end, service_ids, exclude_id=None):
+    lock_owner_calendar(owner_id)
+    shop_capacity, service_capacities = get_capacities(owner_id)
+    bookings = load_bookings(owner_id, start, end, exclude_id)
+
+    if peak_overlap([(b[0], b[1]) for b in bookings], start, end) >= shop_capacity:
+        return False
+    for service_id in service_ids:
+        if service_id in service_capacities:
+            overlapping = [(b[0], b[1]) for b in bookings if service_id in b[2]]
+            if peak_overlap(overlapping, start, end) >= service_capacities[service_id]:
+                return False
+    return True
+
+
+def _is_active(status):
+    return status in ACTIVE_STATUSES
+
+
+def _old_value(state, name):
+    history = state.attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    return state.attrs[name].value if not history.added else None
+
+
+# Finds the intervals whose occupancy changed when an appointment was added or modified.
+# - A status change only matters when it moves the appointment in or out of the active set.
+# - A moved appointment frees its old interval and takes the new one.
+def _changed_intervals(appointment):
+    state = inspect(appointment)
+    new_status = appointment.status
+    new_interval = (appointment.date, appointment.end_time)
+
+    if state.pending:
+        return [new_interval] if _is_active(new_status) and appointment.date else []
+
+    old_status = _old_value(state, 'status')
+    old_interval = (_old_value(state, 'date'), _old_value(state, 'end_time'))
+    moved = old_interval != new_interval
+
+    intervals = []
+    if _is_active(old_status) and (moved or not _is_active(new_status)):
+        intervals.append(old_interval)
+    if _is_active(new_status) and (moved or not _is_active(old_status)):
+        intervals.append(new_interval)
+    return [(start, end) for start, end in intervals if start and end]
+
+
+@event.listens_for(db.session, 'before_flush')
+def _collect_slot_changes(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Appointment):
+            continue
+        for start, end in _changed_intervals(obj):
+            session.info.setdefault(PENDING_KEY, []).append((obj.owner_id, to_moscow(start), to_moscow(end)))
+
+
+# Slot statuses are recomputed from the database, which the committed session can no longer do,
+# so the work is handed to a background task with its own app context and session.
+@event.listens_for(db.session, 'after_commit')
+def _schedule_slot_publish(session):
+    changes = session.info.pop(PENDING_KEY, None)
+    if changes:
+        socketio.start_background_task(publish_slot_changes, changes)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_slot_changes(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)
+
+
+def _overlaps_slot(slot_time, start_minute, end_minute):
+    hours, minutes = map(int, slot_time.split(':'))
+    slot_minute = hours * 60 + minutes
+    return slot_minute < end_minute and start_minute < slot_minute + SLOT_MINUTES
+
+
+# Pushes the new status of every slot touched by the given (owner_id, start, end) intervals
+# to the 'slots:<username>:<date>' room as a 'slots_update' event, then updates the owners' next-available entries.
+def publish_slot_changes(changes):
+    with app.app_context():
+        try:
+            touched = {}
+            for owner_id, start, end in changes:
+                day = start.date()
+                end_minute = _minutes(end) if end.date() == day else DAY_MINUTES
+                touched.setdefault((owner_id, day), []).append((_minutes(start), end_minute))
+
+            for (owner_id, day), intervals in touched.items():
+                owner = db.session.get(BusinessOwner, owner_id)
+                if not owner:
+                    continue
+                slots = compute_day_slots(owner, day) or []
+                delta = [s for s in slots if any(_overlaps_slot(s['time'], start, end) for start, end in intervals)]
+                if delta:
+                    emit_to_slots(owner.username, day.strftime('%Y-%m-%d'), 'slots_update', {
+                        'date': day.strftime('%Y-%m-%d'),
+                        'slots': delta
+                    })
+
+            for owner_id in {owner_id for owner_id, _, _ in changes}:
+                owner = db.session.get(BusinessOwner, owner_id)
+                if owner:
+                    update_next_available(owner, [(start, end) for o, start, end in changes if o == owner_id])
+        except Exception as e:
+            logger.error("Failed to publish slot changes: %s", e)
+            db.session.rollback()
+        finally:
+            db.session.remove()
+
+
+# Answers "does [start, end) still have room?" for one service against a fixed set of bookings.
+# - Bookings are kept sorted by start, so each question only sweeps the bookings that can overlap it.
+class CapacityChecker:
+    def __init__(self, bookings, shop_capacity, service_capacities):
+        self.bookings = sorted((b_start, b_end, ids) for b_start, b_end, ids in bookings)
+        self.starts = [b[0] for b in self.bookings]
+        self.longest = max((b[1] - b[0] for b in self.bookings), default=timedelta(0))
+        self.shop_capacity = shop_capacity
+        self.service_capacities = service_capacities
+
+    def fits(self, start, end, service_id=None):
+        first = bisect_left(self.starts, start - self.longest)
+        last = bisect_left(self.starts, end)
+        candidates = self.bookings[first:last]
+
+        if peak_overlap([(b[0], b[1]) for b in candidates], start, end) >= self.shop_capacity:
+            return False
+        capacity = self.service_capacities.get(service_id)
+        if capacity is not None:
+            overlapping = [(b[0], b[1]) for b in candidates if service_id in b[2]]
+            if peak_overlap(overlapping, start, end) >= capacity:
+                return False
+        return True
+
+
+# Finds the earliest slot start after `now` where `duration` minutes fit inside an open window of the calendar
+# within the shop's (and the service's) capacity. Returns None when nothing fits within `horizon_days`.
+def find_next_start(calendar, checker, service_id, duration, now, horizon_days):
+    length = timedelta(minutes=max(duration or 0, 1))
+    for offset in range(horizon_days + 1):
+        day = now.date() + timedelta(days=offset)
+        for current, closing in calendar.open_datetimes(day):
+            while current + length <= closing:
+                if current > now and checker.fits(current, current + length, service_id):
+                    return current
+                current += SLOT_LENGTH
+    return None
+
+
+# Recomputes the next-available entries of an owner's services (all of them unless `services` is given)
+# and adds them to the session. Returns {service_id: NextAvailable}.
+def refresh_next_available(owner, services=None):
+    now = datetime.now(MOSCOW_TZ)
+    horizon_days = app.config['NEXT_AVAILABLE_HORIZON_DAYS']
+    if services is None:
+        services = Service.query.filter_by(user_id=owner.user_id).all()
+
+    calendar = get_calendar(owner.user_id)
+    bookings = load_bookings(owner.id, now, now + timedelta(days=horizon_days + 1))
+    checker = CapacityChecker(bookings, *get_capacities(owner.id))
+
+    entries = {}
+    for service in services:
+        starts_at = find_next_start(calendar, checker, service.id, service.service_time, now, horizon_days)
+        entries[service.id] = db.session.merge(NextAvailable(
+            owner_id=owner.id,
+            service_id=service.id,
+            duration=service.service_time,
+            starts_at=starts_at.replace(tzinfo=None) if starts_at else None,
+            computed_at=now
+        ))
+    return entries
+
+
+# Brings an owner's next-available entries up to date after bookings changed the given (start, end) intervals.
+# - Only services whose stored start could be affected are recomputed: a changed interval that begins
+#   after the stored start plus the service's duration cannot move it.
+# - Entries of new services, changed durations, past starts and 'nothing within the horizon' are recomputed too.
+def update_next_available(owner, intervals):
+    now = datetime.now(MOSCOW_TZ)
+    services = Service.query.filter_by(user_id=owner.user_id).all()
+    entries = {e.service_id: e for e in NextAvailable.query.filter_by(owner_id=owner.id).all()}
+
+    stale = []
+    for service in services:
+        entry = entries.pop(service.id, None)
+        if entry is None or entry.duration != service.service_time or entry.starts_at is None:
+            stale.append(service)
+            continue
+        starts_at = to_moscow(entry.starts_at)
+        reach = starts_at + timedelta(minutes=entry.duration)
+        if starts_at <= now or any(start < reach for start, _ in intervals):
+            stale.append(service)
+
+    for orphan in entries.values():
+        db.session.delete(orphan)
+    if stale:
+        refresh_next_available(owner, stale)
+    db.session.commit()
+    logger.debug("Recomputed next available start of services %s for owner %s", [s.id for s in stale], owner.id)
+
+
+# Returns the NextAvailable entry of one service, recomputing it first when it is missing or out of date
+# (a start already in the past, a changed duration, or an empty result older than a day).
+def get_next_available(owner, service):
+    entry = db.session.get(NextAvailable, (owner.id, service.id))
+    now = datetime.now(MOSCOW_TZ)
+    if entry is not None and entry.duration == service.service_time:
+        if entry.starts_at is not None and to_moscow(entry.starts_at) > now:
+            return entry
+        if entry.starts_at is None and to_moscow(entry.computed_at) > now - timedelta(days=1):
+            return entry
+
+    entry = refresh_next_available(owner, [service])[service.id]
+    db.session.commit()
+    return entry
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from sqlalchemy.dialects.sqlite import insert
+
+from official_website import app, db
+from official_website.models import Service, WorkingHours
+from .models import ShopCatalog
+
+
+# Returns the shop's current catalog version; shops whose services never changed are at version 0.
+def catalog_version(user_id):
+    return db.session.query(ShopCatalog.version).filter(ShopCatalog.user_id == user_id).scalar() or 0
+
+
+# Marks the shop's catalog as changed. Call it before committing a change to its services.
+# - One upsert creates the row at version 1 or increments it in SQL, so concurrent bumps from different
+#   workers never get lost, and two first bumps never both insert the row.
+def bump_catalog_version(user_id):
+    db.session.execute(insert(ShopCatalog).values(user_id=user_id, version=1).on_conflict_do_update(
+        index_elements=['user_id'], set_={'version': ShopCatalog.version + 1}
+    ))
+
+
+# Serialized /api/shop/<username>/data bodies keyed by (owner record, catalog version).
+# - The owner record is part of the key, so changes to the owner's contact details produce a new entry too.
+# - Old versions simply age out of the LRU.
+class CatalogCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, owner, version):
+        key = (owner, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = render_catalog(owner)
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+catalog_cache = CatalogCache(app.config['CATALOG_CACHE_SIZE'])
+
+
+# Builds the public catalog body of a shop. Returns (bytes, etag); the ETag is a hash of the bytes.
+def render_catalog(owner):
+    services = Service.query.filter_by(user_id=owner.user_id).all()
+    working_hours = WorkingHours.query.filter_by(user_id=owner.user_id).all()
+
+    services_data = [
+        {
+            'id': s.id,
+            'title': s.title,
+            'cost': s.cost,
+            'description': s.description,
+            'service_time': s.service_time
+        } for s in services
+    ]
+
+    working_hours_data = [
+        {
+            'day': wh.day,
+            'start_time': wh.start_time.strftime('%H:%M'),
+            'end_time': wh.end_time.strftime('%H:%M')
+        } for wh in working_hours
+    ]
+
+    body = json.dumps({
+        'personal_name': owner.personal_name,
+        'email': owner.email,
+        'phone_number': owner.phone_number,
+        'services': services_data,
+        'working_hours': working_hours_data
+    }).encode()
+    return body, hashlib.sha256(body).hexdigest()[:32]
@@ -0,0 +1,137 @@
+import logging
+import re
+from datetime import datetime
+
+import pytz
+from sqlalchemy import case, inspect, text
+from sqlalchemy.dialects.sqlite import insert
+
+from official_website import app, db
+from .models import Appointment, Client
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+logger = logging.getLogger(__name__)
+
+# Russian numbers dialled domestically start with the trunk prefix 8 instead of the country code.
+TRUNK_PREFIXES = {'7': '8'}
+
+
+# Returns `raw` as an E.164 number ('+79991234567'), or None when it cannot be one.
+# - Spaces, dashes, dots and parentheses are ignored.
+# - Numbers without '+' get CLIENT_PHONE_DEFAULT_COUNTRY when they look national: ten digits,
+#   or eleven starting with the country's trunk prefix. Anything else is taken to include its country code.
+def normalize_phone(raw):
+    if not raw:
+        return None
+    raw = str(raw).strip()
+    digits = re.sub(r'[\s\-().]', '', raw)
+    international = digits.startswith('+')
+    digits = digits.lstrip('+')
+    if not digits.isdigit():
+        return None
+
+    if not international:
+        country = app.config['CLIENT_PHONE_DEFAULT_COUNTRY']
+        trunk = TRUNK_PREFIXES.get(country)
+        if len(digits) == 10:
+            digits = country + digits
+        elif trunk and len(digits) == 11 and digits.startswith(trunk):
+            digits = country + digits[1:]
+
+    if not 8 <= len(digits) <= 15 or digits.startswith('0'):
+        return None
+    return '+' + digits
+
+
+# Returns the id of the client with this E.164 number, creating the client when `create` is set.
+# - Known clients are only read, so returning clients take no write lock on the client table.
+# - The insert ignores the unique conflict, so two first bookings from the same number racing each other
+#   end up with the same client.
+def get_client_id(phone_number, create=False):
+    client_id = db.session.query(Client.id).filter(Client.phone_number == phone_number).scalar()
+    if client_id is None and create:
+        db.session.execute(insert(Client).values(
+            phone_number=phone_number,
+            created_at=datetime.now(MOSCOW_TZ)
+        ).on_conflict_do_nothing(index_elements=['phone_number']))
+        client_id = db.session.query(Client.id).filter(Client.phone_number == phone_number).scalar()
+    return client_id
+
+
+# Finds the booking a client most likely means, or None.
+# - `phone_number` must be normalized; `owner_id` narrows the search to one shop.
+# - The nearest upcoming booking wins; without one, the latest past booking.
+# - The client is looked up first, as appointments may live in another database than clients (see sharding.py);
+#   the lookup is then a seek on ix_appointment_client_owner_date. Each database answers with its best
+#   candidate and the best of those wins.
+def find_client_appointment(phone_number, owner_id=None, exclude_statuses=()):
+    client_id = get_client_id(phone_number)
+    if client_id is None:
+        return None
+    query = Appointment.query.filter(Appointment.client_id == client_id)
+    if owner_id is not None:
+        query = query.filter(Appointment.owner_id == owner_id)
+    if exclude_statuses:
+        query = query.filter(Appointment.status.notin_(exclude_statuses))
+
+    now = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
+    upcoming = Appointment.date >= now
+    candidates = query.order_by(
+        case((upcoming, 0), else_=1),
+        case((upcoming, Appointment.date)),
+        Appointment.date.desc(),
+        Appointment.id.desc()
+    ).limit(1).all()
+    return min(candidates, key=lambda appointment: _nearest_first(appointment, now), default=None)
+
+
+# Sort key matching find_client_appointment's ORDER BY.
+def _nearest_first(appointment, now):
+    if appointment.date is None:
+        return 2, 0, -appointment.id
+    if appointment.date >= now:
+        return 0, appointment.date.timestamp(), -appointment.id
+    return 1, -appointment.date.timestamp(), -appointment.id
+
+
+# Brings databases created before the client table up to date; runs at startup and does nothing once done.
+# - Adds appointment.client_id and its indexes, then links every unlinked appointment to its client,
+#   one UPDATE per distinct stored phone number.
+def upgrade_client_schema():
+    columns = {column['name'] for column in inspect(db.engine).get_columns('appointment')}
+    with db.engine.begin() as conn:
+        if 'client_id' not in columns:
+            conn.execute(text("ALTER TABLE appointment ADD COLUMN client_id INTEGER REFERENCES client (id)"))
+            logger.info("Added appointment.client_id")
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_appointment_client_owner_date ON appointment (client_id, owner_id, date)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_appointment_client_date ON appointment (client_id, date)"
+        ))
+
+        raw_numbers = conn.execute(text(
+            "SELECT DISTINCT phone_number FROM appointment WHERE client_id IS NULL"
+        )).scalars().all()
+        if not raw_numbers:
+            return
+
+        normalized = {raw: normalize_phone(raw) for raw in raw_numbers}
+        numbers = sorted({number for number in normalized.values() if number})
+        if numbers:
+            now = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
+            conn.execute(
+                insert(Client).on_conflict_do_nothing(index_elements=['phone_number']),
+                [{'phone_number': number, 'created_at': now} for number in numbers]
+            )
+        ids = dict(conn.execute(text("SELECT phone_number, id FROM client")).all())
+        links = [{'client_id': ids[number], 'raw': raw} for raw, number in normalized.items() if number]
+        if links:
+            conn.execute(text(
+                "UPDATE appointment SET client_id = :client_id WHERE phone_number = :raw AND client_id IS NULL"
+            ), links)
+        unlinked = [raw for raw, number in normalized.items() if not number]
+        logger.info("Linked appointments of %s phone numbers to %s clients", len(links), len(numbers))
+        if unlinked:
+            logger.warning("Left appointments with invalid phone numbers unlinked: %s", unlinked)
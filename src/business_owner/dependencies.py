@@ -0,0 +1,53 @@
+from invalidation import tracks, current_and_previous
+from official_website import db
+from official_website.models import User, Service, WorkingHours, WorkingHoursOverride
+from .models import BusinessOwner, Appointment, RequestChange
+
+# Entity keys published when rows change. Caches list the keys they depend on and are
+# invalidated after every commit that touches them, wherever the change was made.
+#   user:<user_id>                        any change to the user (its deletion cascades to the owner)
+#   owner:<owner_id>                      the owner's own row
+#   owner:username:<username>             lookups of the owner by username
+#   shop:<user_id>:services | :hours      the public catalog of a shop; :hours covers date overrides too
+#   owner:<owner_id>:appointments         the owner's appointment list, dashboard and slots
+#   appointment:<id>                      one appointment
+#   owner:<owner_id>:change_requests      pending change requests of the owner's appointments
+#   client:<client_id>:appointments       the client's bookings across all shops, as shown in the client portal
+
+
+@tracks(User)
+def user_keys(user):
+    return [f'user:{user.id}']
+
+
+@tracks(BusinessOwner)
+def owner_keys(owner):
+    return [f'owner:{owner.id}', f'user:{owner.user_id}'] + \
+        [f'owner:username:{username}' for username in current_and_previous(owner, 'username')]
+
+
+@tracks(Service)
+def service_keys(service):
+    return [f'shop:{user_id}:services' for user_id in current_and_previous(service, 'user_id')]
+
+
+@tracks(WorkingHours)
+@tracks(WorkingHoursOverride)
+def working_hours_keys(working_hours):
+    return [f'shop:{user_id}:hours' for user_id in current_and_previous(working_hours, 'user_id')]
+
+
+@tracks(Appointment)
+def appointment_keys(appointment):
+    return [f'appointment:{appointment.id}'] + \
+        [f'owner:{owner_id}:appointments' for owner_id in current_and_previous(appointment, 'owner_id')] + \
+        [f'client:{client_id}:appointments' for client_id in current_and_previous(appointment, 'client_id')]
+
+
+@tracks(RequestChange)
+def change_request_keys(change_request):
+    keys = [f'appointment:{change_request.appointment_id}']
+    appointment = db.session.get(Appointment, change_request.appointment_id)
+    if appointment:
+        keys.append(f'owner:{appointment.owner_id}:change_requests')
+    return keys
@@ -0,0 +1,244 @@
+import json
+import logging
+from datetime import datetime, timedelta
+
+import click
+import pytz
+from sqlalchemy import case, exists, func, select, text
+
+from official_website import app, db
+from invalidation import invalidate_on_commit
+from .models import AppointmentEvent, OwnerStatusCount, OwnerDailyEarnings, ScheduleEntry, ClientHistoryEntry
+from .archive import appointment_history
+from .line_items import load_line_items
+from .status import AppointmentStatus
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+logger = logging.getLogger(__name__)
+
+
+# Appointment datetimes as stored: Moscow wall time without tzinfo.
+def _wall_time(value):
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(MOSCOW_TZ).replace(tzinfo=None)
+
+
+# Appends an event to the log and projects it into the read models, in the current transaction.
+# - `appointment` is an Appointment, or any row with its columns (the import reads appointment_history).
+# - The event carries the appointment's state after the change; `changes` are the fields the event changed.
+def record_appointment_event(appointment, event_name, changes=None):
+    previous = last_event(appointment.id)
+    event = AppointmentEvent(
+        appointment_id=appointment.id,
+        owner_id=appointment.owner_id,
+        client_id=appointment.client_id,
+        event=event_name,
+        status=appointment.status,
+        date=_wall_time(appointment.date),
+        end_time=_wall_time(appointment.end_time),
+        total_cost=appointment.total_cost or 0,
+        data=json.dumps({
+            'client_name': appointment.client_name,
+            'service': load_line_items(appointment.service),
+            'cancellation_reason': appointment.cancellation_reason,
+            'rejection_reason': appointment.rejection_reason,
+            'changes': changes or {}
+        }, default=str)
+    )
+    db.session.add(event)
+    project(event, previous)
+    return event
+
+
+def last_event(appointment_id):
+    return AppointmentEvent.query.filter_by(appointment_id=appointment_id) \
+        .order_by(AppointmentEvent.id.desc()).first()
+
+
+# Projectors keep one read model each. They get the new event and the appointment's previous one (None for its
+# first), take back what the previous state contributed and add the new state, so replaying the log in order
+# from empty tables gives the same rows as following it live.
+
+def project_status_counts(event, previous):
+    if previous is not None:
+        _bump(OwnerStatusCount, (previous.owner_id, previous.status), count=-1)
+    _bump(OwnerStatusCount, (event.owner_id, event.status), count=1)
+
+
+def project_earnings(event, previous):
+    if previous is not None and previous.status == AppointmentStatus.COMPLETED and previous.date:
+        _bump(OwnerDailyEarnings, (previous.owner_id, previous.date.date()), earnings=-previous.total_cost, completed=-1)
+    if event.status == AppointmentStatus.COMPLETED and event.date:
+        _bump(OwnerDailyEarnings, (event.owner_id, event.date.date()), earnings=event.total_cost, completed=1)
+
+
+def project_schedule(event, previous):
+    payload = event.payload()
+    entry = _entry(ScheduleEntry, event.appointment_id)
+    entry.owner_id = event.owner_id
+    entry.day = event.date.date() if event.date else None
+    entry.date = event.date
+    entry.end_time = event.end_time
+    entry.status = event.status
+    entry.client_name = payload.get('client_name')
+    entry.service = json.dumps(payload.get('service', []))
+
+
+def project_client_history(event, previous):
+    if not event.client_id:
+        return
+    payload = event.payload()
+    entry = _entry(ClientHistoryEntry, event.appointment_id)
+    entry.client_id = event.client_id
+    entry.owner_id = event.owner_id
+    entry.date = event.date
+    entry.end_time = event.end_time
+    entry.status = event.status
+    entry.service = json.dumps(payload.get('service', []))
+    entry.total_cost = event.total_cost
+    entry.cancellation_reason = payload.get('cancellation_reason')
+    entry.rejection_reason = payload.get('rejection_reason')
+
+
+# Projections by name, with the tables they own; rebuild_projections() empties those tables before replaying.
+PROJECTIONS = {
+    'status_counts': (project_status_counts, [OwnerStatusCount]),
+    'earnings': (project_earnings, [OwnerDailyEarnings]),
+    'schedule': (project_schedule, [ScheduleEntry]),
+    'client_history': (project_client_history, [ClientHistoryEntry]),
+}
+
+
+def project(event, previous, names=None):
+    for name in names or PROJECTIONS:
+        projector, _ = PROJECTIONS[name]
+        projector(event, previous)
+
+
+def _entry(model, key):
+    entry = db.session.get(model, key)
+    if entry is None:
+        entry = model(**dict(zip([column.name for column in model.__table__.primary_key], _as_tuple(key))))
+        db.session.add(entry)
+    return entry
+
+
+def _bump(model, key, **deltas):
+    row = _entry(model, key)
+    for name, delta in deltas.items():
+        setattr(row, name, (getattr(row, name) or 0) + delta)
+
+
+def _as_tuple(key):
+    return key if isinstance(key, tuple) else (key,)
+
+
+# Number of the shop's appointments in each status, by status.
+def status_counts(owner_id):
+    return dict(db.session.query(OwnerStatusCount.status, OwnerStatusCount.count)
+                .filter(OwnerStatusCount.owner_id == owner_id).all())
+
+
+# The shop's earnings for today, the last 7 and the last 30 days (Moscow calendar days; later days count too),
+# read from the daily buckets in one query, with the dashboard's forecast from the daily average per completed appointment.
+def earnings_summary(owner_id):
+    today = datetime.now(MOSCOW_TZ).date()
+
+    def since(days):
+        return func.coalesce(func.sum(case(
+            (OwnerDailyEarnings.day > today - timedelta(days=days), OwnerDailyEarnings.earnings), else_=0
+        )), 0)
+
+    daily, weekly, monthly, completed = db.session.query(
+        since(1), since(7), since(30), func.coalesce(func.sum(OwnerDailyEarnings.completed), 0)
+    ).filter(OwnerDailyEarnings.owner_id == owner_id).one()
+
+    earnings = {'daily': daily, 'weekly': weekly, 'monthly': monthly, 'forecast': {'labels': [], 'data': []}}
+    if completed > 0:
+        avg_daily_earnings = daily / completed
+        earnings['forecast']['labels'] = ['Next Week', 'Next Month', 'Next Year']
+        earnings['forecast']['data'] = [avg_daily_earnings * 7, avg_daily_earnings * 30, avg_daily_earnings * 365]
+    return earnings
+
+
+# Empties the named projections (all by default) and replays the whole log into them, in one transaction.
+# - Events are read in pages of `batch_size` by id and detached once projected; only the latest event of each
+#   appointment is kept, as the next one's previous.
+# - Meant for recovery and for filling new projections; run it from the CLI (`flask rebuild-projections`),
+#   as it clears the session it runs in.
+def rebuild_projections(names=None, batch_size=1000):
+    names = list(names or PROJECTIONS)
+    unknown = set(names) - set(PROJECTIONS)
+    if unknown:
+        raise ValueError(f"Unknown projections {sorted(unknown)}")
+
+    db.session.commit()
+    for name in names:
+        for model in PROJECTIONS[name][1]:
+            model.query.delete(synchronize_session=False)
+    db.session.expunge_all()
+
+    previous = {}
+    clients = set()
+    replayed = 0
+    last_id = 0
+    while True:
+        events = AppointmentEvent.query.filter(AppointmentEvent.id > last_id) \
+            .order_by(AppointmentEvent.id).limit(batch_size).all()
+        if not events:
+            break
+        for event in events:
+            project(event, previous.get(event.appointment_id), names)
+            previous[event.appointment_id] = event
+            if event.client_id:
+                clients.add(event.client_id)
+        db.session.flush()
+        for event in events:
+            db.session.expunge(event)
+        replayed += len(events)
+        last_id = events[-1].id
+
+    invalidate_on_commit(db.session, {f'client:{client_id}:appointments' for client_id in clients})
+    db.session.commit()
+    logger.info("Rebuilt projections %s from %s events", names, replayed)
+    return replayed
+
+
+# Makes appointment_event append-only in `engine`'s database (the main one by default).
+def create_event_log_triggers(engine=None):
+    with (engine or db.engine).begin() as conn:
+        for operation in ('UPDATE', 'DELETE'):
+            conn.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS appointment_event_no_{operation.lower()} "
+                f"BEFORE {operation} ON appointment_event "
+                f"BEGIN SELECT RAISE(ABORT, 'appointment_event is append-only'); END"
+            ))
+
+
+# Sets up the log on startup; does nothing once done.
+# - Triggers make appointment_event append-only.
+# - Appointments without events (booked before the log existed) get an 'imported' event carrying their
+#   current state, hot and archived alike, so the projections start complete.
+def ensure_event_log():
+    create_event_log_triggers()
+
+    history = appointment_history.c
+    rows = db.session.execute(select(appointment_history).where(
+        ~exists().where(AppointmentEvent.appointment_id == history.id)
+    ).order_by(history.id)).all()
+    if not rows:
+        return
+    for row in rows:
+        record_appointment_event(row, 'imported')
+    db.session.commit()
+    logger.info("Imported %s appointments into the event log", len(rows))
+
+
+@app.cli.command('rebuild-projections', help='Rebuild read models from the appointment event log.')
+@click.option('--projection', 'names', multiple=True, type=click.Choice(list(PROJECTIONS)),
+              help='Projection to rebuild (repeatable; defaults to all).')
+def rebuild_projections_command(names):
+    replayed = rebuild_projections(names or None)
+    click.echo(f"Replayed {replayed} events.")
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+import pytz
+
+from invalidation import DependencyCache
+from official_website import app
+from official_website.models import WorkingHours, WorkingHoursOverride
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Overrides older than this are not compiled; they can no longer affect bookable slots.
+OVERRIDE_LOOKBACK = timedelta(days=31)
+
+
+# An owner's weekly working hours merged with the date-specific overrides.
+# - `weekly` holds the open windows of each weekday (Monday first); `overrides` maps a date to the windows
+#   that replace them, an empty tuple meaning closed.
+# - open_intervals() is a dictionary lookup, whatever the number of overrides.
+class OwnerCalendar:
+    def __init__(self, weekly, overrides):
+        self.weekly = weekly
+        self.overrides = overrides
+
+    def open_intervals(self, date):
+        windows = self.overrides.get(date)
+        return self.weekly[date.weekday()] if windows is None else windows
+
+    # The open windows of `date` as Moscow datetimes, in order.
+    def open_datetimes(self, date):
+        return [
+            (MOSCOW_TZ.localize(datetime.combine(date, start)), MOSCOW_TZ.localize(datetime.combine(date, end)))
+            for start, end in self.open_intervals(date)
+        ]
+
+    # Whether [start, end) lies entirely inside one open window of its day.
+    def covers(self, start, end):
+        return any(open_start <= start and end <= open_end for open_start, open_end in self.open_datetimes(start.date()))
+
+
+def compile_calendar(user_id):
+    weekly = {day: [] for day in DAY_NAMES}
+    for wh in WorkingHours.query.filter_by(user_id=user_id).all():
+        if wh.day in weekly:
+            weekly[wh.day].append((wh.start_time, wh.end_time))
+
+    overrides = {}
+    closed = set()
+    since = datetime.now(MOSCOW_TZ).date() - OVERRIDE_LOOKBACK
+    for override in WorkingHoursOverride.query.filter(
+        WorkingHoursOverride.user_id == user_id,
+        WorkingHoursOverride.date >= since
+    ).all():
+        windows = overrides.setdefault(override.date, [])
+        if override.closed:
+            closed.add(override.date)
+        elif override.start_time and override.end_time:
+            windows.append((override.start_time, override.end_time))
+
+    return OwnerCalendar(
+        tuple(tuple(sorted(weekly[day])) for day in DAY_NAMES),
+        {date: () if date in closed else tuple(sorted(windows)) for date, windows in overrides.items()}
+    )
+
+
+# Compiled calendars by user, dropped whenever the owner's weekly hours or overrides change
+# (both publish 'shop:<user_id>:hours'); the TTL moves the override window along with the date.
+calendar_cache = DependencyCache('calendars', app.config['CALENDAR_CACHE_SIZE'], ttl=3600)
+
+
+def get_calendar(user_id):
+    return calendar_cache.get(user_id, lambda: compile_calendar(user_id), [f'shop:{user_id}:hours'])
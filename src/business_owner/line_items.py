@@ -0,0 +1,141 @@
+import json
+import logging
+
+from sqlalchemy import inspect, text
+
+from official_website import db
+from official_website.models import Service
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN_SERVICE = 'Unknown Service'
+
+# Snapshot columns holding each table's total, by the table and column storing its line items.
+SNAPSHOT_COLUMNS = [
+    ('appointment', 'service', 'total_cost'),
+    ('appointment_archive', 'service', 'total_cost'),
+    ('request_change', 'requested_service', 'requested_total_cost'),
+]
+
+
+# A line item as stored on appointments and change requests: the service as it was when booked.
+def make_line_item(service, quantity):
+    return {
+        'id': service.id,
+        'quantity': quantity,
+        'title': service.title,
+        'cost': service.cost,
+        'duration': service.service_time
+    }
+
+
+# Snapshots the services a client asked for, as line items in the order given.
+# - `requested` is a list of {'id' (or 'service_id'), 'quantity'}; with `user_id` set, the services must belong to that shop.
+# - The services are loaded with one IN query. Returns None when any of them does not exist;
+#   raises ValueError when an item is malformed or its quantity is not positive.
+def snapshot_line_items(requested, user_id=None):
+    wanted = []
+    try:
+        for item in requested:
+            service_id = int(item.get('id') or item.get('service_id'))
+            quantity = int(item.get('quantity', 1))
+            if quantity < 1:
+                raise ValueError(f"Invalid quantity {quantity}")
+            wanted.append((service_id, quantity))
+    except (AttributeError, TypeError) as e:
+        raise ValueError(f"Invalid service item: {e}")
+
+    query = Service.query.filter(Service.id.in_({service_id for service_id, _ in wanted}))
+    if user_id is not None:
+        query = query.filter(Service.user_id == user_id)
+    services = {service.id: service for service in query}
+    if any(service_id not in services for service_id, _ in wanted):
+        return None
+    return [make_line_item(services[service_id], quantity) for service_id, quantity in wanted]
+
+
+# Reads stored line items, from JSON text or an already parsed list.
+# - Items stored before snapshots existed (or whose service was gone when they were migrated) come back with
+#   title, cost and duration set to None; old change requests keyed the service as 'service_id'.
+def load_line_items(raw):
+    if not raw:
+        return []
+    items = json.loads(raw) if isinstance(raw, str) else raw
+    return [{
+        'id': item.get('id') or item.get('service_id'),
+        'quantity': item.get('quantity', 1),
+        'title': item.get('title'),
+        'cost': item.get('cost'),
+        'duration': item.get('duration')
+    } for item in items]
+
+
+def line_total(item):
+    return (item['cost'] or 0) * item['quantity']
+
+
+def total_cost(items):
+    return sum(line_total(item) for item in items)
+
+
+def total_duration(items):
+    return sum((item['duration'] or 0) * item['quantity'] for item in items)
+
+
+# A line item as the dashboards show it; 'cost' is the unit price.
+def describe_line_item(item):
+    return {
+        'id': item['id'],
+        'name': item['title'] or UNKNOWN_SERVICE,
+        'quantity': item['quantity'],
+        'cost': item['cost'] if item['cost'] is not None else 'Unknown Cost',
+        'duration': item['duration'] if item['duration'] is not None else 'Unknown Duration'
+    }
+
+
+# Brings databases created before line item snapshots up to date; runs at startup and does nothing once done.
+# - Adds the total columns, then snapshots every row without a total from the current services, one IN query
+#   and one executemany per table. Services deleted since keep their id and quantity only and count as 0.
+def upgrade_line_item_snapshots():
+    for table, items_column, total_column in SNAPSHOT_COLUMNS:
+        columns = {column['name'] for column in inspect(db.engine).get_columns(table)}
+        with db.engine.begin() as conn:
+            if total_column not in columns:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {total_column} FLOAT"))
+                logger.info("Added %s.%s", table, total_column)
+
+            rows = conn.execute(text(
+                f"SELECT id, {items_column} FROM {table} WHERE {total_column} IS NULL"
+            )).all()
+            if not rows:
+                continue
+
+            stored = {row.id: load_line_items(row[1]) for row in rows}
+            service_ids = {item['id'] for items in stored.values() for item in items if item['id']}
+            services = {service.id: service for service in conn.execute(
+                Service.__table__.select().where(Service.id.in_(service_ids))
+            )} if service_ids else {}
+
+            updates = []
+            missing = set()
+            for row_id, items in stored.items():
+                snapshot = []
+                for item in items:
+                    service = services.get(item['id'])
+                    if service is None:
+                        missing.add(item['id'])
+                        snapshot.append({'id': item['id'], 'quantity': item['quantity']})
+                    else:
+                        snapshot.append(make_line_item(service, item['quantity']))
+                updates.append({
+                    'row_id': row_id,
+                    'items': json.dumps(snapshot),
+                    'total': total_cost(load_line_items(snapshot))
+                })
+            conn.execute(text(
+                f"UPDATE {table} SET {items_column} = CASE WHEN {items_column} IS NULL THEN NULL ELSE :items END, "
+                f"{total_column} = :total WHERE id = :row_id"
+            ), updates)
+            logger.info("Snapshotted line items of %s %s rows", len(updates), table)
+            if missing:
+                logger.warning("Services %s no longer exist; %s rows keep them as unknown", sorted(missing), table)
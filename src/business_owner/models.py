@@ -1,7 +1,10 @@
 from official_website import db  # Use the db instance from official_website
 from datetime import datetime
 from sqlalchemy import Text
+import json
 import pytz
+from .status import AppointmentStatus, ChangeRequestStatus, APPOINTMENT_CODES, CHANGE_REQUEST_CODES, \
+    StatusCode, ACTIVE_APPOINTMENT_SQL, PENDING_CHANGE_REQUEST_SQL
 
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
@@ -42,6 +45,15 @@ class OTP(db.Model):
     def __repr__(self):
         return f"<OTP {self.phone_number} - {self.otp}>"
 
+# Model for the client portal's login codes, kept apart from the booking OTPs above: the owner's
+# "mark as arrived" check reads those by phone number, so a portal login must never replace or delete them.
+class ClientLoginCode(db.Model):
+    __tablename__ = 'client_login_code'
+    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for the code
+    phone_number = db.Column(db.String(16), nullable=False, index=True)  # Phone number in E.164 form the code was sent to
+    code = db.Column(db.String(6), nullable=False)  # Login code sent by SMS
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)  # Timestamp of the code; it expires after CLIENT_OTP_TTL
+
 # Model representing Feedback from clients regarding a business owner
 # - Stores client complaints or feedback submitted for the business owner.
 class Feedback(db.Model):
@@ -56,8 +68,19 @@ class Feedback(db.Model):
     # Relationship with the BusinessOwner
     owner = db.relationship('BusinessOwner', backref=db.backref('feedbacks', lazy=True))
 
+# Model representing a client, identified across all shops by their phone number
+# - The number is stored in E.164 form (see business_owner/clients.py), so '+7999...' and '8999...' are one client.
+class Client(db.Model):
+    __tablename__ = 'client'
+    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for the client
+    phone_number = db.Column(db.String(16), unique=True, nullable=False)  # Phone number in E.164 form
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(MOSCOW_TZ), nullable=False)  # Timestamp of the first booking
+
 # Model representing an Appointment for a business owner
 # - Includes appointment details like client info, services, and status.
+# - Client lookups go through (client_id, owner_id, date), so finding a client's booking is an index seek;
+#   (client_id, date) serves the client's history across shops in date order.
+# - The partial index on (owner_id, date) only holds bookings that occupy slots, for availability queries.
 class Appointment(db.Model):
     __tablename__ = 'appointment'
     id = db.Column(db.Integer, primary_key=True)  # Unique identifier for the appointment
@@ -67,18 +90,58 @@ class Appointment(db.Model):
     client_email = db.Column(db.String(100))  # Client's email address
     date = db.Column(db.DateTime, nullable=False)  # Start date and time of the appointment
     end_time = db.Column(db.DateTime, nullable=False)  # End time of the appointment
-    service = db.Column(db.Text, nullable=False)  # Serialized JSON storing service details for the appointment
+    service = db.Column(db.Text, nullable=False)  # Serialized JSON line items: each service's id, title, unit cost, duration and quantity when booked
     total_service_time = db.Column(db.Integer, nullable=False)  # Total time for all services in minutes
     num_services = db.Column(db.Integer, nullable=False)  # Total number of services in the appointment
-    status = db.Column(db.String(20), nullable=False)  # Status of the appointment (e.g., 'Pending', 'Completed')
+    total_cost = db.Column(db.Float, default=0)  # Sum of the line items' cost x quantity, as booked
+    status = db.Column(StatusCode(AppointmentStatus, APPOINTMENT_CODES), nullable=False)  # Status of the appointment, stored as its code (see business_owner/status.py)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(MOSCOW_TZ), nullable=False)  # Timestamp for appointment creation
     report_details = db.Column(db.Text, nullable=True)  # Optional report details for the appointment
     cancellation_reason = db.Column(db.Text, nullable=True)  # Reason for cancellation if applicable
     rejection_reason = db.Column(db.Text, nullable=True)  # Reason for rejection if applicable
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=True)  # Foreign key linking to the Client
 
     # Relationship with the BusinessOwner
     owner = db.relationship('BusinessOwner', backref=db.backref('appointments', lazy=True))
 
+    # Relationship with the Client
+    client = db.relationship('Client', backref=db.backref('appointments', lazy=True))
+
+    __table_args__ = (
+        db.Index('ix_appointment_client_owner_date', 'client_id', 'owner_id', 'date'),
+        db.Index('ix_appointment_client_date', 'client_id', 'date'),
+        db.Index('ix_appointment_active_owner_date', 'owner_id', 'date', sqlite_where=db.text(ACTIVE_APPOINTMENT_SQL)),
+    )
+
+# Model holding closed appointments (Completed, Cancelled, Rejected) moved out of `appointment` by the archiver
+# - Same columns as Appointment, ids kept, so the two tables read as one through the appointment_history view
+#   (see business_owner/archive.py); the hot table and its indexes only hold bookings that still matter day to day.
+class AppointmentArchive(db.Model):
+    __tablename__ = 'appointment_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Id the appointment had in the hot table
+    owner_id = db.Column(db.Integer, db.ForeignKey('business_owner.id'), nullable=False)  # Foreign key linking to the BusinessOwner
+    client_name = db.Column(db.String(100), nullable=False)  # Client's name for the appointment
+    phone_number = db.Column(db.String(15), nullable=False)  # Client's phone number
+    client_email = db.Column(db.String(100))  # Client's email address
+    date = db.Column(db.DateTime, nullable=False)  # Start date and time of the appointment
+    end_time = db.Column(db.DateTime, nullable=False)  # End time of the appointment
+    service = db.Column(db.Text, nullable=False)  # Serialized JSON storing the appointment's line items
+    total_service_time = db.Column(db.Integer, nullable=False)  # Total time for all services in minutes
+    num_services = db.Column(db.Integer, nullable=False)  # Total number of services in the appointment
+    total_cost = db.Column(db.Float, default=0)  # Sum of the line items' cost x quantity, as booked
+    status = db.Column(StatusCode(AppointmentStatus, APPOINTMENT_CODES), nullable=False)  # Final status of the appointment, stored as its code
+    created_at = db.Column(db.DateTime, nullable=False)  # Timestamp for appointment creation
+    report_details = db.Column(db.Text, nullable=True)  # Optional report details for the appointment
+    cancellation_reason = db.Column(db.Text, nullable=True)  # Reason for cancellation if applicable
+    rejection_reason = db.Column(db.Text, nullable=True)  # Reason for rejection if applicable
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=True)  # Foreign key linking to the Client
+    archived_at = db.Column(db.DateTime, default=lambda: datetime.now(MOSCOW_TZ), nullable=False)  # Timestamp of the move
+
+    __table_args__ = (
+        db.Index('ix_appointment_archive_owner_date', 'owner_id', 'date'),
+        db.Index('ix_appointment_archive_client_date', 'client_id', 'date'),
+    )
+
 # Model representing a client's request to change an existing appointment
 # - Stores the requested changes such as new services or times.
 class RequestChange(db.Model):
@@ -90,21 +153,26 @@ class RequestChange(db.Model):
     client_email = db.Column(db.String(100))  # Client's email address
     requested_date = db.Column(db.DateTime, nullable=True)  # Requested new date and time for the appointment
     requested_end_time = db.Column(db.DateTime, nullable=True)  # Requested new end time for the appointment
-    requested_service = db.Column(db.Text, nullable=True)  # Serialized JSON storing requested services
+    requested_service = db.Column(db.Text, nullable=True)  # Serialized JSON line items, snapshotted like Appointment.service
     requested_total_service_time = db.Column(db.Integer, nullable=True)  # Total service time requested in minutes
     requested_num_services = db.Column(db.Integer, nullable=True)  # Number of services requested
-    status = db.Column(db.String(20), nullable=False, default='Pending')  # Status of the change request (e.g., 'Pending', 'Approved')
+    requested_total_cost = db.Column(db.Float, nullable=True)  # Sum of the requested line items' cost x quantity
+    status = db.Column(StatusCode(ChangeRequestStatus, CHANGE_REQUEST_CODES), nullable=False, default=ChangeRequestStatus.PENDING)  # Status of the change request, stored as its code
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(MOSCOW_TZ), nullable=False)  # Timestamp for request creation
     updated_at = db.Column(db.DateTime, onupdate=lambda: datetime.now(MOSCOW_TZ))  # Timestamp for the last update
 
     # Relationship with the Appointment
     appointment = db.relationship('Appointment', backref=db.backref('request_changes', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_request_change_pending', 'appointment_id', sqlite_where=db.text(PENDING_CHANGE_REQUEST_SQL)),
+    )
+
     # Initialization for the request change
     def __init__(self, appointment_id, client_name, phone_number, client_email=None,
                  requested_date=None, requested_end_time=None,
                  requested_service=None, requested_total_service_time=None,
-                 requested_num_services=None):
+                 requested_num_services=None, requested_total_cost=None):
         self.appointment_id = appointment_id
         self.client_name = client_name
         self.phone_number = phone_number
@@ -114,4 +182,140 @@ class RequestChange(db.Model):
         self.requested_service = requested_service
         self.requested_total_service_time = requested_total_service_time
         self.requested_num_services = requested_num_services
-        self.status = 'Pending'
+        self.requested_total_cost = requested_total_cost
+        self.status = ChangeRequestStatus.PENDING
+
+# Model representing one change to an owner's appointments, pushed to the owner's dashboard in real time
+# - The auto-incrementing id doubles as the feed version; reconnecting dashboards ask for everything after the last id they saw.
+class OwnerUpdate(db.Model):
+    __tablename__ = 'owner_update'
+    id = db.Column(db.Integer, primary_key=True)  # Feed version, increasing across all owners
+    owner_id = db.Column(db.Integer, db.ForeignKey('business_owner.id', ondelete='CASCADE'), nullable=False, index=True)  # Owner whose dashboard is affected
+    appointment_id = db.Column(db.Integer, nullable=False)  # Appointment the change applies to
+    event = db.Column(db.String(30), nullable=False)  # What happened (e.g., 'reserved', 'accepted', 'change_requested')
+    status = db.Column(db.String(20), nullable=True)  # Appointment status after the change
+    changes = db.Column(Text, nullable=True)  # Serialized JSON of the changed fields
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(MOSCOW_TZ), nullable=False)  # Timestamp of the change
+
+    def to_dict(self):
+        return {
+            'version': self.id,
+            'appointment_id': self.appointment_id,
+            'event': self.event,
+            'status': self.status,
+            'changes': json.loads(self.changes) if self.changes else {},
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+
+# Model holding the version of a shop's public catalog (services and working hours)
+# - Bumped in the same transaction as every service change, so cached catalog responses keyed by it are never stale.
+class ShopCatalog(db.Model):
+    __tablename__ = 'shop_catalog'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)  # Shop's user, as referenced by Service
+    version = db.Column(db.Integer, nullable=False, default=1)  # Incremented on every catalog change
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(MOSCOW_TZ), onupdate=lambda: datetime.now(MOSCOW_TZ), nullable=False)  # Time of the last change
+
+
+# Model caching the earliest bookable start of each service of a shop
+# - Maintained after booking changes touch the near-term calendar, so the next-available endpoint is a primary-key lookup.
+class NextAvailable(db.Model):
+    __tablename__ = 'next_available'
+    owner_id = db.Column(db.Integer, db.ForeignKey('business_owner.id', ondelete='CASCADE'), primary_key=True)  # Shop the entry belongs to
+    service_id = db.Column(db.Integer, db.ForeignKey('service.id', ondelete='CASCADE'), primary_key=True)  # Service whose duration was fitted
+    duration = db.Column(db.Integer, nullable=False)  # Service duration in minutes the start was computed for
+    starts_at = db.Column(db.DateTime, nullable=True)  # Earliest free start (Moscow time); NULL when nothing fits within the horizon
+    computed_at = db.Column(db.DateTime, default=lambda: datetime.now(MOSCOW_TZ), onupdate=lambda: datetime.now(MOSCOW_TZ), nullable=False)  # Time of the last recomputation
+
+
+# Model holding how many bookings a shop can serve at the same time
+# - The row without a service applies to the whole shop (chairs, stations, staff); a row with a service caps
+#   concurrent bookings containing that service (e.g., one massage room). Shops without rows take one booking at a time.
+# - The shop-wide row doubles as the lock reservations take to admit bookings atomically.
+class ShopCapacity(db.Model):
+    __tablename__ = 'shop_capacity'
+    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for the capacity setting
+    owner_id = db.Column(db.Integer, db.ForeignKey('business_owner.id', ondelete='CASCADE'), nullable=False, index=True)  # Shop the setting belongs to
+    service_id = db.Column(db.Integer, db.ForeignKey('service.id', ondelete='CASCADE'), nullable=True)  # Service the limit applies to; NULL for the whole shop
+    capacity = db.Column(db.Integer, nullable=False, default=1)  # Bookings that may overlap
+    admissions = db.Column(db.Integer, nullable=False, default=0)  # Bookings admitted; bumped to serialize admission
+
+    __table_args__ = (
+        db.UniqueConstraint('owner_id', 'service_id', name='uq_shop_capacity_service'),
+        db.Index('uq_shop_capacity_shop', 'owner_id', unique=True, sqlite_where=db.text('service_id IS NULL')),
+    )
+
+# Model holding the append-only log of appointment transitions (see business_owner/events.py)
+# - Each event carries the appointment's state after the transition, so the read models below can be rebuilt
+#   from the log alone. Unlike OwnerUpdate it is never pruned, and triggers refuse UPDATE and DELETE.
+# - No foreign key to appointment: events outlive the row's move to appointment_archive.
+class AppointmentEvent(db.Model):
+    __tablename__ = 'appointment_event'
+    id = db.Column(db.Integer, primary_key=True)  # Position in the log
+    appointment_id = db.Column(db.Integer, nullable=False)  # Appointment the event belongs to
+    owner_id = db.Column(db.Integer, db.ForeignKey('business_owner.id'), nullable=False)  # Shop of the appointment
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=True)  # Client of the appointment
+    event = db.Column(db.String(30), nullable=False)  # What happened (e.g., 'reserved', 'accepted', 'paid')
+    status = db.Column(StatusCode(AppointmentStatus, APPOINTMENT_CODES), nullable=False)  # Status after the event, stored as its code
+    date = db.Column(db.DateTime, nullable=True)  # Start of the appointment after the event (Moscow time)
+    end_time = db.Column(db.DateTime, nullable=True)  # End of the appointment after the event (Moscow time)
+    total_cost = db.Column(db.Float, nullable=False, default=0)  # Total of the line items after the event
+    data = db.Column(Text, nullable=True)  # Serialized JSON: client name, line items, reasons and the event's changed fields
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(MOSCOW_TZ), nullable=False)  # Timestamp of the event
+
+    __table_args__ = (
+        db.Index('ix_appointment_event_appointment', 'appointment_id', 'id'),
+    )
+
+    def payload(self):
+        return json.loads(self.data) if self.data else {}
+
+# Read model: number of appointments of a shop in each status, projected from appointment_event
+class OwnerStatusCount(db.Model):
+    __tablename__ = 'owner_status_count'
+    owner_id = db.Column(db.Integer, db.ForeignKey('business_owner.id', ondelete='CASCADE'), primary_key=True)  # Shop counted
+    status = db.Column(StatusCode(AppointmentStatus, APPOINTMENT_CODES), primary_key=True)  # Status counted, stored as its code
+    count = db.Column(db.Integer, nullable=False, default=0)  # Appointments currently in the status
+
+# Read model: a shop's earnings from completed appointments per Moscow calendar day, projected from appointment_event
+class OwnerDailyEarnings(db.Model):
+    __tablename__ = 'owner_daily_earnings'
+    owner_id = db.Column(db.Integer, db.ForeignKey('business_owner.id', ondelete='CASCADE'), primary_key=True)  # Shop the bucket belongs to
+    day = db.Column(db.Date, primary_key=True)  # Day the appointments took place
+    earnings = db.Column(db.Float, nullable=False, default=0)  # Sum of the completed appointments' totals
+    completed = db.Column(db.Integer, nullable=False, default=0)  # Number of completed appointments
+
+# Read model: one row per appointment on a shop's day schedule, projected from appointment_event
+class ScheduleEntry(db.Model):
+    __tablename__ = 'schedule_entry'
+    appointment_id = db.Column(db.Integer, primary_key=True)  # Appointment shown
+    owner_id = db.Column(db.Integer, db.ForeignKey('business_owner.id', ondelete='CASCADE'), nullable=False)  # Shop the schedule belongs to
+    day = db.Column(db.Date, nullable=True)  # Day of the appointment (Moscow time); NULL until it has a date
+    date = db.Column(db.DateTime, nullable=True)  # Start of the appointment (Moscow time)
+    end_time = db.Column(db.DateTime, nullable=True)  # End of the appointment (Moscow time)
+    status = db.Column(StatusCode(AppointmentStatus, APPOINTMENT_CODES), nullable=False)  # Current status, stored as its code
+    client_name = db.Column(db.String(100), nullable=True)  # Client's name for the appointment
+    service = db.Column(Text, nullable=True)  # Serialized JSON line items
+
+    __table_args__ = (
+        db.Index('ix_schedule_entry_owner_day', 'owner_id', 'day', 'date'),
+    )
+
+# Read model: one row per appointment in a client's history across shops, projected from appointment_event
+# - Archived appointments keep their row, so the client portal reads one table.
+class ClientHistoryEntry(db.Model):
+    __tablename__ = 'client_history_entry'
+    appointment_id = db.Column(db.Integer, primary_key=True)  # Appointment shown
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)  # Client the history belongs to
+    owner_id = db.Column(db.Integer, db.ForeignKey('business_owner.id', ondelete='CASCADE'), nullable=False)  # Shop of the appointment
+    date = db.Column(db.DateTime, nullable=True)  # Start of the appointment (Moscow time)
+    end_time = db.Column(db.DateTime, nullable=True)  # End of the appointment (Moscow time)
+    status = db.Column(StatusCode(AppointmentStatus, APPOINTMENT_CODES), nullable=False)  # Current status, stored as its code
+    service = db.Column(Text, nullable=True)  # Serialized JSON line items
+    total_cost = db.Column(db.Float, nullable=False, default=0)  # Total of the line items
+    cancellation_reason = db.Column(db.Text, nullable=True)  # Reason for cancellation if applicable
+    rejection_reason = db.Column(db.Text, nullable=True)  # Reason for rejection if applicable
+
+    __table_args__ = (
+        db.Index('ix_client_history_entry_client_date', 'client_id', 'date', 'appointment_id'),
+    )
@@ -0,0 +1,31 @@
+from collections import namedtuple
+
+from invalidation import DependencyCache
+from official_website import app, db
+from .models import BusinessOwner
+
+# The public part of a business owner the shop endpoints need; never carries the password hash.
+OwnerRecord = namedtuple('OwnerRecord', [
+    'id', 'user_id', 'username', 'company_name', 'personal_name', 'email', 'phone_number'
+])
+
+# Process-local LRU+TTL cache of username -> OwnerRecord.
+# - Unknown usernames are cached as None too, so scans of a mistyped QR link do not hit the database.
+# - Entries depend on 'owner:username:<username>' and the owner's 'user:<user_id>', so any committed change
+#   to the owner (or the deletion of its user, which cascades in the database) drops them.
+owner_cache = DependencyCache('owners', app.config['OWNER_CACHE_SIZE'], app.config['OWNER_CACHE_TTL'])
+
+
+def _load_owner(username):
+    row = db.session.query(*(getattr(BusinessOwner, field) for field in OwnerRecord._fields)) \
+        .filter(BusinessOwner.username == username).first()
+    return OwnerRecord(*row) if row else None
+
+
+# Looks up a shop by username for the public endpoints. Returns an OwnerRecord or None.
+def get_owner_by_username(username):
+    return owner_cache.get(
+        username,
+        lambda: _load_owner(username),
+        lambda record: [f'owner:username:{username}'] + ([f'user:{record.user_id}'] if record else [])
+    )
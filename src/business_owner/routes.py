@@ -1,20 +1,39 @@
 from functools import wraps
 import random
-from flask import request, jsonify, session, redirect, url_for
+from flask import request, jsonify, session, redirect, url_for, Response
 from werkzeug.security import generate_password_hash, check_password_hash
 from official_website import app, db
-from .models import BusinessOwner, BusinessOwnerLog, Appointment, Feedback, OTP, RequestChange
-from official_website.models import Service, WorkingHours
+from .models import BusinessOwner, BusinessOwnerLog, Appointment, Feedback, OTP, RequestChange, ShopCapacity, ScheduleEntry
+from .updates import record_appointment_update, format_time, updates_since, latest_version
+from .availability import compute_day_slots, compute_slots, get_next_available, get_capacities, admit_booking, \
+    refresh_next_available
+from .search import search_earliest
+from .owner_cache import get_owner_by_username
+from .hours import get_calendar
+from .clients import normalize_phone, get_client_id, find_client_appointment
+from .archive import appointment_history
+from .events import record_appointment_event, status_counts, earnings_summary
+from .status import AppointmentStatus, ChangeRequestStatus, can_transition, can_reschedule, is_pending
+from .line_items import snapshot_line_items, load_line_items, line_total, total_cost, total_duration, describe_line_item, \
+    UNKNOWN_SERVICE
+from .catalog import catalog_cache, catalog_version, bump_catalog_version
+from singleflight import coalesced
+from invalidation import invalidate_on_commit
+from read_routing import read_only
+from session_store import regenerate_session
+from realtime import socketio
+from official_website.models import Service, WorkingHoursOverride
 import logging
 import pytz
 from datetime import datetime, timedelta
-from dateutil import tz
+from sqlalchemy import insert, select
 import json
+import calendar
 
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
 
-logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 
 def login_required(f):
@@ -25,24 +44,65 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Returns a 409 response when the state machine does not allow moving `appointment` to `new_status`
+# (see business_owner/status.py), or None when the move is allowed.
+def invalid_transition(appointment, new_status):
+    if can_transition(appointment.status, new_status):
+        return None
+    logger.warning("Refused moving appointment %s from %s to %s", appointment.id, appointment.status, new_status)
+    return jsonify({'message': f'Cannot change the appointment from {appointment.status} to {new_status}'}), 409
+
+# Returns a 409 response when a booking of `service_ids` cannot take [start, end): the shop is closed then
+# (weekly hours and date overrides) or the time is fully booked. Returns None when it can; the calendar then
+# stays locked until the caller commits. Every path that sets a booking's time goes through here.
+# - `appointment_id` is the booking being moved, if any.
+def booking_time_error(owner, start, end, service_ids, appointment_id=None):
+    if not get_calendar(owner.user_id).covers(start, end):
+        return jsonify({'message': 'The shop is closed at the selected time'}), 409
+    if not admit_booking(owner.id, start, end, service_ids, exclude_id=appointment_id):
+        db.session.rollback()
+        return jsonify({'message': 'The selected time is fully booked'}), 409
+    return None
+
+# Returns a 409 response when `appointment` can no longer be moved to another time, or None when it can.
+def invalid_reschedule(appointment):
+    if can_reschedule(appointment.status):
+        return None
+    logger.warning("Refused rescheduling appointment %s in status %s", appointment.id, appointment.status)
+    return jsonify({'message': f'Cannot reschedule an appointment that is {appointment.status}'}), 409
+
+# Statuses set by the owner's reservation actions.
+ACTION_STATUSES = {
+    'accept': AppointmentStatus.ACCEPTED,
+    'reject': AppointmentStatus.REJECTED,
+    'report': AppointmentStatus.REPORTED,
+    'arrived': AppointmentStatus.ARRIVED,
+}
+
+# Marks the session permanent once; PERMANENT_SESSION_LIFETIME comes from config.
+# - Server-side sessions are already permanent, so this never forces a session write.
 @app.before_request
 def make_session_permanent():
-    session.permanent = True
-    app.permanent_session_lifetime = timedelta(days=1)
-    session.modified = True
+    if not session.permanent:
+        session.permanent = True
 
+# Expires owner sessions after a day without activity.
+# - last_activity is rewritten at most once per SESSION_ACTIVITY_WRITE_INTERVAL, so most requests leave the session untouched.
 @app.before_request
 def check_inactivity():
     if 'owner_id' in session:
+        now = datetime.now(MOSCOW_TZ)
         last_activity = session.get('last_activity')
         if last_activity:
             last_activity = datetime.fromisoformat(last_activity)
-            if datetime.now(MOSCOW_TZ) - last_activity > timedelta(days=1):
+            if now - last_activity > timedelta(days=1):
                 session.pop('owner_id', None)
                 session.pop('last_activity', None)
-                logging.info("Session expired due to inactivity")
+                logger.info("Session expired due to inactivity")
                 return jsonify({'message': 'Session expired due to inactivity'}), 401
-        session['last_activity'] = datetime.now(MOSCOW_TZ).isoformat()
+            if now - last_activity < app.config['SESSION_ACTIVITY_WRITE_INTERVAL']:
+                return None
+        session['last_activity'] = now.isoformat()
 
 
 # Authenticates the business owner based on the provided username and password.
@@ -56,11 +116,12 @@ def business_owner_login():
 
     business_owner = BusinessOwner.query.filter_by(username=username).first()
     if business_owner and check_password_hash(business_owner.password, password):
+        regenerate_session(session)
         session['owner_id'] = business_owner.id
         session['user_id'] = business_owner.user_id
-        logging.info(f"Business owner {username} logged in successfully with id {business_owner.id}")
+        logger.info("Business owner %s logged in successfully with id %s", username, business_owner.id)
         return jsonify({'message': 'Login successful'}), 200
-    logging.warning(f"Failed login attempt for username: {username}")
+    logger.warning("Failed login attempt for username: %s", username)
     return jsonify({'message': 'Invalid credentials'}), 401
 
 
@@ -74,7 +135,7 @@ def business_owner_logout():
     owner_id = session.pop('owner_id', None)
     session.pop('last_activity', None)
     if owner_id:
-        logging.info(f"Business owner {owner_id} logged out successfully")
+        logger.info("Business owner %s logged out successfully", owner_id)
     return jsonify({'message': 'Logout successful'}), 200
 
 # Submits and stores client details for an appointment (without service and date yet).
@@ -86,12 +147,12 @@ def submit_client_details(username):
     client_name = data.get('client_name')
     client_email = data.get('client_email')
 
-    phone_number = session.get('verified_phone_number')
+    phone_number = normalize_phone(session.get('verified_phone_number'))
 
     if not client_name or not client_email or not phone_number:
         return jsonify({'message': 'Client name, email, and verified phone number are required'}), 400
 
-    owner = BusinessOwner.query.filter_by(username=username).first()
+    owner = get_owner_by_username(username)
     if not owner:
         return jsonify({'message': 'Business owner not found'}), 404
 
@@ -100,13 +161,16 @@ def submit_client_details(username):
         owner_id=owner.id,
         client_name=client_name,
         phone_number=phone_number,
+        client_id=get_client_id(phone_number, create=True),
         client_email=client_email,
         service=None,
-        status='Client Details Provided',
+        status=AppointmentStatus.CLIENT_DETAILS,
         date=None,
     )
-    logging.debug(f"Storing appointment with date: {appointment.date}")
+    logger.debug("Storing appointment with date: %s", appointment.date)
     db.session.add(appointment)
+    db.session.flush()
+    record_appointment_event(appointment, 'client_details')
     db.session.commit()
 
     return jsonify({'message': 'Client details saved successfully'}), 200
@@ -118,43 +182,25 @@ def submit_client_details(username):
 # - Includes data on client requests for appointment changes.
 @app.route('/api/business_owner/dashboard_data', methods=['GET'])
 @login_required
+@read_only
 def business_owner_dashboard_data():
     user_id = session['user_id']
     owner = BusinessOwner.query.filter_by(user_id=user_id).first()
 
     if not owner:
-        logging.error(f"Business owner with user_id {user_id} not found")
+        logger.error("Business owner with user_id %s not found", user_id)
         return jsonify({'message': 'Business owner not found'}), 404
 
     appointments = Appointment.query.filter_by(owner_id=owner.id).all()
 
     # Handle cancelled reservations
     cancelled_reservations = []
-    cancelled_appointments = Appointment.query.filter_by(owner_id=owner.id, status='Cancelled').all()
+    cancelled_appointments = [a for a in appointments if a.status == AppointmentStatus.CANCELLED]
 
     for a in cancelled_appointments:
-        logging.info(f"Cancellation Reason for Appointment {a.id}: {a.cancellation_reason}")
-
-        service_details = json.loads(a.service) if a.service else []
-        service_names = []
-
-        for service_data in service_details:
-            service_id = service_data.get('service_id') or service_data.get('id')
-            service_obj = Service.query.get(service_id)
-            if service_obj:
-                service_names.append({
-                    'name': service_obj.title,
-                    'quantity': service_data.get('quantity', 'Unknown Quantity'),
-                    'cost': service_obj.cost,
-                    'duration': service_obj.service_time
-                })
-            else:
-                service_names.append({
-                    'name': 'Unknown Service',
-                    'quantity': service_data.get('quantity', 'Unknown Quantity'),
-                    'cost': 'Unknown Cost',
-                    'duration': 'Unknown Duration'
-                })
+        logger.debug("Cancellation reason for appointment %s: %s", a.id, a.cancellation_reason)
+
+        service_names = [describe_line_item(item) for item in load_line_items(a.service)]
 
         # Add the full service details to the cancelled reservation
         cancelled_reservations.append({
@@ -166,52 +212,36 @@ def business_owner_dashboard_data():
             'date': a.date.strftime('%Y-%m-%d %H:%M') if a.date else "Not Set",
             'start_time': a.date.astimezone(MOSCOW_TZ).strftime('%Y-%m-%d %H:%M') if a.date else "Not Set",
             'end_time': a.end_time.astimezone(MOSCOW_TZ).strftime('%Y-%m-%d %H:%M') if a.end_time else "Not Set",
-            'cancellation_reason': a.cancellation_reason if a.status == 'Cancelled' else None,
+            'cancellation_reason': a.cancellation_reason if a.status == AppointmentStatus.CANCELLED else None,
             'status': a.status
         })
 
-    # Gather statistics
+    # Gather statistics from the status counters projected from the event log
+    counts = status_counts(owner.id)
     statistics = {
-        'pending': sum(1 for a in appointments if a.status == 'Pending'),
-        'accepted': sum(1 for a in appointments if a.status == 'Accepted'),
-        'rejected': sum(1 for a in appointments if a.status == 'Rejected'),
-        'reported': sum(1 for a in appointments if a.status == 'Reported'),
-        'completed': sum(1 for a in appointments if a.status == 'Completed'),
-        'pending_payment': sum(1 for a in appointments if a.status == 'Arrived'),
-        'cancelled': sum(1 for a in appointments if a.status == 'Cancelled')
+        'pending': counts.get(AppointmentStatus.PENDING, 0),
+        'accepted': counts.get(AppointmentStatus.ACCEPTED, 0),
+        'rejected': counts.get(AppointmentStatus.REJECTED, 0),
+        'reported': counts.get(AppointmentStatus.REPORTED, 0),
+        'completed': counts.get(AppointmentStatus.COMPLETED, 0),
+        'pending_payment': counts.get(AppointmentStatus.ARRIVED, 0),
+        'cancelled': counts.get(AppointmentStatus.CANCELLED, 0)
     }
 
-    # Handle request changes
-    request_changes = RequestChange.query.join(Appointment).filter(Appointment.owner_id == owner.id).all()
+    # Handle request changes; pending ones are read through the ix_request_change_pending partial index
+    request_changes = RequestChange.query.join(Appointment).filter(
+        Appointment.owner_id == owner.id,
+        is_pending(RequestChange.status)
+    ).all()
 
     change_requests_data = []
     for rc in request_changes:
         try:
-            logging.info(f"Raw requested_service for RequestChange ID {rc.id}: {rc.requested_service}")
+            logger.debug("Raw requested_service for RequestChange ID %s: %s", rc.id, rc.requested_service)
             requested_service_data = json.loads(rc.requested_service) if rc.requested_service else []
-            logging.info(f"Parsed service data for RequestChange ID {rc.id}: {requested_service_data}")
-
-            services_info = []
-            for service_data in requested_service_data:
-                service_id = service_data.get('service_id')
-
-                if not service_id:
-                    logging.warning(f"Service ID missing for service_data: {service_data}")
-                    service_obj = None
-                else:
-                    service_obj = Service.query.get(service_id)
-                    if service_obj:
-                        logging.info(f"Loaded service {service_obj.title} with ID {service_id}")
-                    else:
-                        logging.warning(f"Service with ID {service_id} not found")
-
-                services_info.append({
-                    'id': service_id,
-                    'name': service_obj.title if service_obj else 'Unknown Service',
-                    'quantity': service_data.get('quantity', 'Unknown Quantity'),
-                    'cost': service_obj.cost if service_obj else 'Unknown Cost',
-                    'duration': service_obj.service_time if service_obj else 'Unknown Duration'
-                })
+            logger.debug("Parsed service data for RequestChange ID %s: %s", rc.id, requested_service_data)
+
+            services_info = [describe_line_item(item) for item in load_line_items(requested_service_data)]
 
             change_requests_data.append({
                 'id': rc.id,
@@ -224,84 +254,44 @@ def business_owner_dashboard_data():
                 'requested_service': services_info,
                 'requested_total_service_time': rc.requested_total_service_time,
                 'requested_num_services': rc.requested_num_services,
+                'requested_total_cost': rc.requested_total_cost,
                 'status': rc.status,
                 'created_at': rc.created_at.strftime('%Y-%m-%d %H:%M')
             })
 
         except json.JSONDecodeError as e:
-            logging.error(f"Error decoding requested_service for RequestChange ID {rc.id}: {str(e)}")
-
-    # Calculate earnings
-    earnings = {'daily': 0, 'weekly': 0, 'monthly': 0, 'forecast': {'labels': [], 'data': []}}
-    now = datetime.now(tz.UTC)
-    completed_appointments = [a for a in appointments if a.status == 'Completed']
-    total_appointments = len(completed_appointments)
-
-    if total_appointments > 0:
-        for appointment in completed_appointments:
-            service_details = json.loads(appointment.service) if appointment.service else []
-            for service in service_details:
-                service_obj = Service.query.get(service.get('id'))
-                if service_obj:
-                    appointment_date = appointment.date
-                    if appointment_date.tzinfo is None:
-                        appointment_date = appointment_date.replace(tzinfo=tz.UTC)
-
-                    diff = now - appointment_date
-                    earnings_value = service_obj.cost * service['quantity']
-
-                    if diff.days < 1:
-                        earnings['daily'] += earnings_value
-                    if diff.days < 7:
-                        earnings['weekly'] += earnings_value
-                    if diff.days < 30:
-                        earnings['monthly'] += earnings_value
-
-        avg_daily_earnings = earnings['daily'] / total_appointments
-        earnings['forecast']['labels'] = ['Next Week', 'Next Month', 'Next Year']
-        earnings['forecast']['data'] = [
-            avg_daily_earnings * 7,
-            avg_daily_earnings * 30,
-            avg_daily_earnings * 365
-        ]
-
-    # Services data
-    services_data = []
-    for service in Service.query.filter_by(user_id=user_id).all():
-        earnings_by_service = 0
-        for appointment in completed_appointments:
-            service_details = json.loads(appointment.service) if appointment.service else []
-            for s in service_details:
-                if s.get('id') == service.id:
-                    earnings_by_service += service.cost * s['quantity']
-        services_data.append({
-            'title': service.title,
-            'earnings': earnings_by_service
-        })
+            logger.error("Error decoding requested_service for RequestChange ID %s: %s", rc.id, e)
+
+    # Earnings from the daily buckets projected from the event log
+    earnings = earnings_summary(owner.id)
+
+    # Services data, earned at the prices the appointments were booked at; services deleted since keep their booked title
+    history = appointment_history.c
+    completed_appointments = db.session.execute(select(history.service).where(
+        history.owner_id == owner.id,
+        history.status == AppointmentStatus.COMPLETED
+    )).all()
+    earnings_by_service = {}
+    booked_titles = {}
+    for appointment in completed_appointments:
+        for item in load_line_items(appointment.service):
+            earnings_by_service[item['id']] = earnings_by_service.get(item['id'], 0) + line_total(item)
+            booked_titles[item['id']] = item['title'] or booked_titles.get(item['id'])
+    current_services = Service.query.filter_by(user_id=user_id).all()
+    services_data = [{
+        'title': service.title,
+        'earnings': earnings_by_service.pop(service.id, 0)
+    } for service in current_services]
+    services_data.extend({
+        'title': booked_titles.get(service_id) or UNKNOWN_SERVICE,
+        'earnings': earnings
+    } for service_id, earnings in earnings_by_service.items())
 
     # Reservations
     reservations = []
     completed_reservations = []
     for a in appointments:
-        service_details = json.loads(a.service) if a.service else []
-        service_names = []
-        for service_data in service_details:
-            service_id = service_data.get('service_id') or service_data.get('id')
-            service_obj = Service.query.get(service_id)
-            if service_obj:
-                service_names.append({
-                    'name': service_obj.title,
-                    'quantity': service_data.get('quantity', 'Unknown Quantity'),
-                    'cost': service_obj.cost,
-                    'duration': service_obj.service_time
-                })
-            else:
-                service_names.append({
-                    'name': 'Unknown Service',
-                    'quantity': service_data.get('quantity', 'Unknown Quantity'),
-                    'cost': 'Unknown Cost',
-                    'duration': 'Unknown Duration'
-                })
+        service_names = [describe_line_item(item) for item in load_line_items(a.service)]
 
         reservation = {
             'id': a.id,
@@ -313,10 +303,10 @@ def business_owner_dashboard_data():
             'start_time': a.date.astimezone(MOSCOW_TZ).strftime('%Y-%m-%d %H:%M') if a.date else "Not Set",
             'end_time': a.end_time.astimezone(MOSCOW_TZ).strftime('%Y-%m-%d %H:%M') if a.end_time else "Not Set",
             'status': a.status,
-            'rejection_reason': a.rejection_reason if a.status == 'Rejected' else None
+            'rejection_reason': a.rejection_reason if a.status == AppointmentStatus.REJECTED else None
         }
 
-        if a.status == 'Completed':
+        if a.status == AppointmentStatus.COMPLETED:
             completed_reservations.append(reservation)
         else:
             reservations.append(reservation)
@@ -330,14 +320,59 @@ def business_owner_dashboard_data():
         'servicesData': services_data,
         'changeRequests': change_requests_data,
         'shop_name': owner.company_name,
-        'username': owner.username
+        'username': owner.username,
+        'version': latest_version(owner.id)
     }), 200
 
 
 
+# Returns the appointment deltas the owner's dashboard missed since the given version.
+# - Live deltas are pushed to the owner's Socket.IO room as 'appointment_update'; this endpoint lets a
+#   reconnecting dashboard catch up without reloading the full dashboard_data payload.
+# - If `reset` is true the missed deltas were pruned and the dashboard must reload dashboard_data.
+@app.route('/api/business_owner/updates', methods=['GET'])
+@login_required
+def business_owner_updates():
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'message': 'since=<version> is required'}), 400
+
+    limit = min(request.args.get('limit', 500, type=int), 500)
+    return jsonify(updates_since(session['owner_id'], since, limit)), 200
+
+
+# Returns the owner's appointments on one day (`date`, YYYY-MM-DD, Moscow time; today by default), in start order.
+# - Reads the schedule projected from the appointment event log: one index range on (owner_id, day).
+@app.route('/api/business_owner/schedule', methods=['GET'])
+@login_required
+@read_only
+def business_owner_schedule():
+    day_str = request.args.get('date')
+    try:
+        day = datetime.strptime(day_str, '%Y-%m-%d').date() if day_str else datetime.now(MOSCOW_TZ).date()
+    except ValueError:
+        return jsonify({'message': 'Invalid date format. Use YYYY-MM-DD.'}), 400
+
+    entries = ScheduleEntry.query.filter_by(owner_id=session['owner_id'], day=day) \
+        .order_by(ScheduleEntry.date, ScheduleEntry.appointment_id).all()
+    return jsonify({
+        'date': day.strftime('%Y-%m-%d'),
+        'appointments': [{
+            'id': entry.appointment_id,
+            'client_name': entry.client_name,
+            'start_time': entry.date.strftime('%H:%M'),
+            'end_time': entry.end_time.strftime('%H:%M') if entry.end_time else None,
+            'service': [describe_line_item(item) for item in load_line_items(entry.service)],
+            'status': entry.status
+        } for entry in entries]
+    }), 200
+
+
 # Accepts and applies a client's requested changes to an existing appointment.
+# - Only the owner of the appointment can accept, and only a pending request for an appointment that can
+#   still be rescheduled.
 # - Updates appointment details such as the date, time, and services.
-# - Deletes the change request after it has been applied.
+# - Deletes the change request after it has been applied, in the same transaction.
 @app.route('/api/business_owner/accept_change/<int:request_change_id>', methods=['POST'])
 @login_required
 def accept_change_request(request_change_id):
@@ -347,10 +382,16 @@ def accept_change_request(request_change_id):
         if not change_request:
             return jsonify({'message': 'Change request not found'}), 404
 
-        appointment = Appointment.query.get(change_request.appointment_id)
+        appointment = Appointment.query.filter_by(id=change_request.appointment_id, owner_id=session['owner_id']).first()
         if not appointment:
             return jsonify({'message': 'Appointment not found'}), 404
 
+        if change_request.status != ChangeRequestStatus.PENDING:
+            return jsonify({'message': f'The change request is already {change_request.status}'}), 409
+        error = invalid_reschedule(appointment)
+        if error:
+            return error
+
 
         if change_request.requested_date.tzinfo is None:
             requested_date_moscow = MOSCOW_TZ.localize(change_request.requested_date)
@@ -362,23 +403,34 @@ def accept_change_request(request_change_id):
         else:
             requested_end_time_moscow = change_request.requested_end_time.astimezone(MOSCOW_TZ)
 
+        error = booking_time_error(db.session.get(BusinessOwner, appointment.owner_id),
+                                   requested_date_moscow, requested_end_time_moscow,
+                                   {item['id'] for item in load_line_items(change_request.requested_service)},
+                                   appointment_id=appointment.id)
+        if error:
+            return error
 
         appointment.date = requested_date_moscow
         appointment.end_time = requested_end_time_moscow
         appointment.service = change_request.requested_service
         appointment.total_service_time = change_request.requested_total_service_time
         appointment.num_services = change_request.requested_num_services
-
-
-        db.session.commit()
-
+        appointment.total_cost = change_request.requested_total_cost
+        record_appointment_update(appointment, 'change_accepted',
+                                  request_change_id=change_request.id,
+                                  date=format_time(appointment.date),
+                                  end_time=format_time(appointment.end_time),
+                                  service=json.loads(appointment.service) if appointment.service else [],
+                                  total_service_time=appointment.total_service_time,
+                                  num_services=appointment.num_services,
+                                  total_cost=appointment.total_cost)
 
         db.session.delete(change_request)
         db.session.commit()
 
         return jsonify({'message': 'Change request accepted and applied to the appointment'}), 200
     except Exception as e:
-        logging.error(f"Error processing change request: {str(e)}")
+        logger.error("Error processing change request: %s", e)
         db.session.rollback()
         return jsonify({'message': 'Failed to apply change request', 'error': str(e)}), 500
 
@@ -390,24 +442,29 @@ def accept_change_request(request_change_id):
 def handle_reservation_action(action, reservation_id):
     valid_actions = ['accept', 'reject', 'report', 'arrived']
     if action not in valid_actions:
-        logging.warning(f"Invalid action attempt: {action}")
+        logger.warning("Invalid action attempt: %s", action)
         return jsonify({'message': 'Invalid action'}), 400
 
     owner_id = session['owner_id']
     appointment = Appointment.query.filter_by(id=reservation_id, owner_id=owner_id).first()
 
     if not appointment:
-        logging.error(f"Appointment {reservation_id} not found for owner {owner_id}")
+        logger.error("Appointment %s not found for owner %s", reservation_id, owner_id)
         return jsonify({'message': 'Appointment not found'}), 404
 
+    error = invalid_transition(appointment, ACTION_STATUSES[action])
+    if error:
+        return error
+
     if action == 'reject':
         reason = request.json.get('reason')
         if not reason:
             return jsonify({'message': 'Rejection reason is required'}), 400
-        appointment.status = 'Rejected'
+        appointment.status = AppointmentStatus.REJECTED
         appointment.rejection_reason = reason
+        record_appointment_update(appointment, 'rejected', rejection_reason=reason)
         db.session.commit()
-        logging.info(f"Reservation {reservation_id} rejected by owner {owner_id}")
+        logger.info("Reservation %s rejected by owner %s", reservation_id, owner_id)
 
 
 
@@ -422,31 +479,27 @@ def handle_reservation_action(action, reservation_id):
         otp_entry = OTP(phone_number=appointment.phone_number, otp=str(otp_code))
         db.session.add(otp_entry)
 
-        appointment.status = 'Accepted'
+        appointment.status = AppointmentStatus.ACCEPTED
+        record_appointment_update(appointment, 'accepted')
 
 
         db.session.commit()
 
 
-        confirmation_message = (
-            f"Dear {appointment.client_name},\n"
-            f"Your appointment at {appointment.date.strftime('%Y-%m-%d %H:%M')} "
-            f"with {appointment.owner.company_name} has been confirmed. "
-            f"Your OTP is {otp_code}. Please present this OTP at the time of your appointment."
-        )
+        confirmation_message = build_confirmation_message(appointment, appointment.owner.company_name, otp_code)
 
 
         email_success, sms_success = send_confirmation_message(appointment.client_email, appointment.phone_number, confirmation_message)
 
 
-        logging.info(f"Reservation {reservation_id} accepted by owner {owner_id}")
-        logging.info(f"Generated OTP for client {appointment.client_name}: {otp_code}")
+        logger.info("Reservation %s accepted by owner %s", reservation_id, owner_id)
+        logger.info("Generated OTP for client %s", appointment.client_name)
 
         if not email_success:
-            logging.error(f"Failed to send confirmation email to {appointment.client_email}")
+            logger.error("Failed to send confirmation email to %s", appointment.client_email)
 
         if not sms_success:
-            logging.error(f"Failed to send confirmation SMS to {appointment.phone_number}")
+            logger.error("Failed to send confirmation SMS to %s", appointment.phone_number)
 
 
         return jsonify({
@@ -461,11 +514,11 @@ def handle_reservation_action(action, reservation_id):
         report_details = request.json.get('report_details')
         if not report_details:
             return jsonify({'message': 'Report details are required'}), 400
-        appointment.status = 'Reported'
-        new_feedback = Feedback(owner_id=owner_id, feedback=report_details, created_at=datetime.now(MOSCOW_TZ))
-        db.session.add(new_feedback)
+        appointment.status = AppointmentStatus.REPORTED
+        appointment.report_details = report_details
+        record_appointment_update(appointment, 'reported', report_details=report_details)
         db.session.commit()
-        logging.info(f"Reservation {reservation_id} reported by owner {owner_id}")
+        logger.info("Reservation %s reported by owner %s", reservation_id, owner_id)
 
     elif action == 'arrived':
 
@@ -480,10 +533,11 @@ def handle_reservation_action(action, reservation_id):
         if stored_otp.otp != otp_code:
             return jsonify({'message': 'Invalid OTP'}), 400
 
-        appointment.status = 'Arrived'
+        appointment.status = AppointmentStatus.ARRIVED
+        record_appointment_update(appointment, 'arrived')
         db.session.commit()
 
-        logging.info(f"Reservation {reservation_id} marked as arrived by owner {owner_id}")
+        logger.info("Reservation %s marked as arrived by owner %s", reservation_id, owner_id)
 
     return jsonify({'message': f'Reservation {action}ed successfully'}), 200
 
@@ -496,21 +550,150 @@ def send_confirmation_message(email, phone_number, message):
 
     try:
 
-        logging.info(f"Sending email to {email}: {message}")
+        logger.info("Sending email to %s", email)
         email_success = True
     except Exception as e:
-        logging.error(f"Error sending email: {str(e)}")
+        logger.error("Error sending email: %s", e)
 
     try:
 
-        logging.info(f"Sending SMS to {phone_number}: {message}")
+        logger.info("Sending SMS to %s", phone_number)
         sms_success = True
     except Exception as e:
-        logging.error(f"Error sending SMS: {str(e)}")
+        logger.error("Error sending SMS: %s", e)
 
     return email_success, sms_success
 
 
+def build_confirmation_message(appointment, company_name, otp_code):
+    return (
+        f"Dear {appointment.client_name},\n"
+        f"Your appointment at {appointment.date.strftime('%Y-%m-%d %H:%M')} "
+        f"with {company_name} has been confirmed. "
+        f"Your OTP is {otp_code}. Please present this OTP at the time of your appointment."
+    )
+
+
+# Sends the confirmations of a batch of accepted reservations; runs as a background task after the commit.
+def send_confirmation_messages(messages):
+    for email, phone_number, message in messages:
+        email_success, sms_success = send_confirmation_message(email, phone_number, message)
+        if not email_success:
+            logger.error("Failed to send confirmation email to %s", email)
+        if not sms_success:
+            logger.error("Failed to send confirmation SMS to %s", phone_number)
+
+
+# Applies one reservation action to several of the owner's appointments at once.
+# - Body: {'action': 'accept' | 'reject' | 'report' | 'arrived', 'reservation_ids': [...]}, plus 'reason' for
+#   reject, 'report_details' for report and 'otps' ({reservation ID: OTP}) for arrived.
+# - Ownership is checked with one IN query. Items that are not the owner's, cannot move to the new status or
+#   fail the OTP check are reported and skipped; the rest change in one transaction.
+# - Accepted reservations get their OTP rows in one INSERT, and one background task sends their confirmations
+#   after the commit.
+# Responds with one result per reservation ID, in request order.
+@app.route('/api/business_owner/reservations/batch', methods=['POST'])
+@login_required
+def batch_reservation_action():
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    if action not in ACTION_STATUSES:
+        logger.warning("Invalid batch action attempt: %s", action)
+        return jsonify({'message': 'Invalid action'}), 400
+
+    reservation_ids = data.get('reservation_ids')
+    if not isinstance(reservation_ids, list) or not reservation_ids or \
+            not all(isinstance(reservation_id, int) and not isinstance(reservation_id, bool)
+                    for reservation_id in reservation_ids):
+        return jsonify({'message': 'reservation_ids must be a non-empty list of reservation IDs'}), 400
+    if len(reservation_ids) > app.config['RESERVATION_BATCH_LIMIT']:
+        return jsonify({'message': f"At most {app.config['RESERVATION_BATCH_LIMIT']} reservations per batch"}), 400
+
+    reason = data.get('reason')
+    report_details = data.get('report_details')
+    otps = data.get('otps') or {}
+    if action == 'reject' and not reason:
+        return jsonify({'message': 'Rejection reason is required'}), 400
+    if action == 'report' and not report_details:
+        return jsonify({'message': 'Report details are required'}), 400
+    if action == 'arrived' and not isinstance(otps, dict):
+        return jsonify({'message': 'otps must map reservation IDs to OTPs'}), 400
+
+    owner_id = session['owner_id']
+    new_status = ACTION_STATUSES[action]
+    try:
+        appointments = {appointment.id: appointment for appointment in Appointment.query.filter(
+            Appointment.owner_id == owner_id, Appointment.id.in_(set(reservation_ids))
+        ).all()}
+
+        stored_otps = {}
+        if action == 'arrived':
+            phone_numbers = {appointment.phone_number for appointment in appointments.values()}
+            for entry in OTP.query.filter(OTP.phone_number.in_(phone_numbers)).order_by(OTP.created_at, OTP.id):
+                stored_otps[entry.phone_number] = entry.otp
+
+        results = {}
+        changed = []
+        for reservation_id in reservation_ids:
+            if reservation_id in results:
+                continue
+            appointment = appointments.get(reservation_id)
+            error = None
+            if appointment is None:
+                error = 'Appointment not found'
+            elif not can_transition(appointment.status, new_status):
+                error = f'Cannot change the appointment from {appointment.status} to {new_status}'
+            elif action == 'arrived':
+                stored_otp = stored_otps.get(appointment.phone_number)
+                if stored_otp is None:
+                    error = 'No OTP found for this phone number'
+                elif stored_otp != str(otps.get(str(reservation_id))):
+                    error = 'Invalid OTP'
+            if error:
+                results[reservation_id] = {'id': reservation_id, 'result': 'error', 'message': error}
+            else:
+                results[reservation_id] = {'id': reservation_id, 'result': 'ok', 'status': new_status}
+                changed.append(appointment)
+
+        otp_rows = []
+        messages = []
+        company_name = db.session.get(BusinessOwner, owner_id).company_name if action == 'accept' else None
+        for appointment in changed:
+            appointment.status = new_status
+            if action == 'reject':
+                appointment.rejection_reason = reason
+                record_appointment_update(appointment, 'rejected', rejection_reason=reason)
+            elif action == 'accept':
+                otp_code = random.randint(1000, 9999)
+                otp_rows.append({'phone_number': appointment.phone_number, 'otp': str(otp_code)})
+                record_appointment_update(appointment, 'accepted')
+                confirmation_message = build_confirmation_message(appointment, company_name, otp_code)
+                messages.append((appointment.client_email, appointment.phone_number, confirmation_message))
+                results[appointment.id].update(otp=otp_code, confirmation_message=confirmation_message)
+            elif action == 'report':
+                appointment.report_details = report_details
+                record_appointment_update(appointment, 'reported', report_details=report_details)
+            else:
+                record_appointment_update(appointment, 'arrived')
+        if otp_rows:
+            db.session.execute(insert(OTP.__table__), otp_rows)
+        db.session.commit()
+    except Exception as e:
+        logger.error("Error applying batch action %s for owner %s: %s", action, owner_id, e)
+        db.session.rollback()
+        return jsonify({'message': 'Failed to apply the batch action', 'error': str(e)}), 500
+
+    if messages:
+        socketio.start_background_task(send_confirmation_messages, messages)
+    logger.info("Batch %s: %s of %s reservations changed by owner %s", action, len(changed), len(results), owner_id)
+    return jsonify({
+        'action': action,
+        'changed': len(changed),
+        'failed': len(results) - len(changed),
+        'results': list(results.values())
+    }), 200
+
+
 # Manages business owner services including listing, adding, updating, and deleting services.
 # - GET: Retrieves all services for the logged-in business owner.
 # - POST: Adds a new service.
@@ -521,10 +704,10 @@ def send_confirmation_message(email, phone_number, message):
 def manage_services():
     user_id = session.get('user_id')
     if not user_id:
-        logging.error("User ID not found in session. Unauthorized access.")
+        logger.error("User ID not found in session. Unauthorized access.")
         return jsonify({'message': 'Unauthorized'}), 401
 
-    logging.info(f"Fetching services for user_id: {user_id}")
+    logger.info("Fetching services for user_id: %s", user_id)
 
     if request.method == 'GET':
         services = Service.query.filter_by(user_id=user_id).all()
@@ -539,7 +722,7 @@ def manage_services():
             }
             for s in services
         ]
-        logging.info(f"Fetched services for user {user_id}: {services_data}")
+        logger.debug("Fetched %d services for user %s", len(services_data), user_id)
         return jsonify(services_data), 200
 
     if request.method == 'POST':
@@ -550,13 +733,14 @@ def manage_services():
         service_time = data.get('service_time')
 
         if not all([title, cost, description, service_time]):
-            logging.error("Missing service information in POST request.")
+            logger.error("Missing service information in POST request.")
             return jsonify({'message': 'Missing service information'}), 400
 
         new_service = Service(title=title, cost=cost, description=description, service_time=service_time, user_id=user_id)
         db.session.add(new_service)
+        bump_catalog_version(user_id)
         db.session.commit()
-        logging.info(f"New service added by owner {user_id}: {title}")
+        logger.info("New service added by owner %s: %s", user_id, title)
         return jsonify({'message': 'Service added successfully', 'service': {'id': new_service.id, 'title': new_service.title, 'cost': new_service.cost, 'description': new_service.description, 'service_time': new_service.service_time}}), 201
 
     if request.method == 'PUT':
@@ -569,34 +753,155 @@ def manage_services():
 
         service = Service.query.get(service_id)
         if not service or service.user_id != user_id:
-            logging.error(f"Service update failed: Service ID {service_id} not found or unauthorized")
+            logger.error("Service update failed: Service ID %s not found or unauthorized", service_id)
             return jsonify({'message': 'Service not found or unauthorized'}), 404
 
         service.title = title
         service.cost = cost
         service.description = description
         service.service_time = service_time
+        bump_catalog_version(user_id)
         db.session.commit()
-        logging.info(f"Service {service_id} updated by owner {user_id}")
+        logger.info("Service %s updated by owner %s", service_id, user_id)
         return jsonify({'message': 'Service updated successfully'}), 200
 
     if request.method == 'DELETE':
         service_id = request.args.get('id')
         if not service_id:
-            logging.error("Service ID not provided for deletion.")
+            logger.error("Service ID not provided for deletion.")
             return jsonify({'message': 'Service ID is required'}), 400
 
         service = Service.query.get(service_id)
         if not service or service.user_id != user_id:
-            logging.error(f"Service delete failed: Service ID {service_id} not found or unauthorized")
+            logger.error("Service delete failed: Service ID %s not found or unauthorized", service_id)
             return jsonify({'message': 'Service not found or unauthorized'}), 404
 
         db.session.delete(service)
+        bump_catalog_version(user_id)
         db.session.commit()
-        logging.info(f"Service {service_id} deleted by owner {user_id}")
+        logger.info("Service %s deleted by owner %s", service_id, user_id)
         return jsonify({'message': 'Service deleted successfully'}), 200
 
 
+# Manages date-specific exceptions to the weekly working hours.
+# - GET: Lists today's and later overrides as {'date', 'closed', 'windows': [{'start_time', 'end_time'}], 'note'}.
+# - PUT: Replaces the overrides of one date with {'date': 'YYYY-MM-DD', 'closed': bool, 'windows': [...], 'note': ...}.
+# - DELETE: Removes the overrides of ?date=YYYY-MM-DD, restoring the weekly hours for that day.
+@app.route('/api/business_owner/working_hours/overrides', methods=['GET', 'PUT', 'DELETE'])
+@login_required
+def manage_working_hours_overrides():
+    owner_id = session['owner_id']
+    user_id = session.get('user_id')
+
+    if request.method == 'GET':
+        today = datetime.now(MOSCOW_TZ).date()
+        overrides = WorkingHoursOverride.query.filter(
+            WorkingHoursOverride.user_id == user_id,
+            WorkingHoursOverride.date >= today
+        ).order_by(WorkingHoursOverride.date, WorkingHoursOverride.start_time).all()
+
+        by_date = {}
+        for override in overrides:
+            entry = by_date.setdefault(override.date, {
+                'date': override.date.strftime('%Y-%m-%d'), 'closed': False, 'windows': [], 'note': override.note
+            })
+            if override.closed:
+                entry['closed'] = True
+            elif override.start_time and override.end_time:
+                entry['windows'].append({
+                    'start_time': override.start_time.strftime('%H:%M'),
+                    'end_time': override.end_time.strftime('%H:%M')
+                })
+        return jsonify(list(by_date.values())), 200
+
+    date_str = request.args.get('date') if request.method == 'DELETE' else (request.get_json() or {}).get('date')
+    try:
+        date = datetime.strptime(date_str or '', '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'message': 'Date is required in YYYY-MM-DD format'}), 400
+
+    rows = []
+    if request.method == 'PUT':
+        data = request.get_json()
+        note = data.get('note')
+        if data.get('closed'):
+            rows.append(WorkingHoursOverride(user_id=user_id, date=date, closed=True, note=note))
+        else:
+            for window in data.get('windows') or []:
+                try:
+                    start_time = datetime.strptime(window['start_time'], '%H:%M').time()
+                    end_time = datetime.strptime(window['end_time'], '%H:%M').time()
+                except (KeyError, TypeError, ValueError):
+                    return jsonify({'message': 'Each window needs start_time and end_time in HH:MM format'}), 400
+                if start_time >= end_time:
+                    return jsonify({'message': 'Window start_time must be before end_time'}), 400
+                rows.append(WorkingHoursOverride(user_id=user_id, date=date, start_time=start_time, end_time=end_time, note=note))
+            if not rows:
+                return jsonify({'message': 'Either closed or at least one window is required'}), 400
+
+    WorkingHoursOverride.query.filter_by(user_id=user_id, date=date).delete(synchronize_session=False)
+    invalidate_on_commit(db.session, [f'shop:{user_id}:hours'])
+    db.session.add_all(rows)
+    db.session.commit()
+
+    refresh_next_available(db.session.get(BusinessOwner, owner_id))
+    db.session.commit()
+    logger.info("Working hours override for %s set by owner %s: %s rows", date, owner_id, len(rows))
+    return jsonify({'message': 'Working hours override saved' if rows else 'Working hours override removed'}), 200
+
+
+# Manages how many bookings the shop can serve at the same time.
+# - GET: Returns {'capacity': <shop-wide>, 'services': {<service_id>: <capacity>}}.
+# - PUT: Accepts the same shape; 'capacity' replaces the shop-wide value and each service entry sets that
+#   service's limit, or removes it when null.
+@app.route('/api/business_owner/capacity', methods=['GET', 'PUT'])
+@login_required
+def manage_capacity():
+    owner_id = session['owner_id']
+    user_id = session.get('user_id')
+
+    if request.method == 'PUT':
+        data = request.get_json() or {}
+        settings = {s.service_id: s for s in ShopCapacity.query.filter_by(owner_id=owner_id).all()}
+
+        changes = {}
+        if 'capacity' in data:
+            changes[None] = data['capacity']
+        services = data.get('services') or {}
+        if not isinstance(services, dict):
+            return jsonify({'message': 'services must map service IDs to capacities'}), 400
+        for service_id, capacity in services.items():
+            if not str(service_id).isdigit():
+                return jsonify({'message': f'Invalid service ID: {service_id}'}), 400
+            service = Service.query.get(int(service_id))
+            if not service or service.user_id != user_id:
+                return jsonify({'message': f'Service {service_id} not found or unauthorized'}), 404
+            changes[service.id] = capacity
+
+        for service_id, capacity in changes.items():
+            if capacity is None and service_id is not None:
+                if service_id in settings:
+                    db.session.delete(settings[service_id])
+                continue
+            if not isinstance(capacity, int) or isinstance(capacity, bool) or capacity < 1:
+                return jsonify({'message': 'Capacity must be a positive integer'}), 400
+            if service_id in settings:
+                settings[service_id].capacity = capacity
+            else:
+                db.session.add(ShopCapacity(owner_id=owner_id, service_id=service_id, capacity=capacity))
+
+        db.session.commit()
+        refresh_next_available(db.session.get(BusinessOwner, owner_id))
+        db.session.commit()
+        logger.info("Capacity of owner %s updated: %s", owner_id, changes)
+
+    shop_capacity, service_capacities = get_capacities(owner_id)
+    return jsonify({
+        'capacity': shop_capacity,
+        'services': {str(service_id): capacity for service_id, capacity in service_capacities.items()}
+    }), 200
+
+
 # Returns support contact information including email, phone, and address for the business owner.
 # - Useful for technical support or other inquiries.
 @app.route('/api/business_owner/support', methods=['GET'])
@@ -627,7 +932,7 @@ def get_reservations(username):
         return redirect(f'/shop/{username}')
 
 
-    owner = BusinessOwner.query.filter_by(username=username).first()
+    owner = get_owner_by_username(username)
     if not owner:
         return jsonify({'message': 'Shop not found'}), 404
 
@@ -636,38 +941,44 @@ def get_reservations(username):
 
     return jsonify(reservations_data), 200
 
+# Resolves the optional shop `username` a client lookup is limited to.
+# - Returns (owner_id, None), with owner_id None for all shops, or (None, error response) for an unknown shop.
+def client_lookup_scope(username):
+    if not username:
+        return None, None
+    owner = get_owner_by_username(username)
+    if not owner:
+        return None, (jsonify({'message': 'Business owner not found'}), 404)
+    return owner.id, None
+
 # Checks if an appointment exists based on the provided phone number.
-# - Returns appointment details if found, or a 404 if no appointment is found.
+# - Returns the client's nearest upcoming appointment (else the latest one), or a 404 if no appointment is found.
+# - An optional `username` limits the search to one shop.
 @app.route('/api/check_appointment', methods=['GET'])
 def check_appointment():
-    phone_number = request.args.get('phone').strip()
+    phone_number = normalize_phone(request.args.get('phone'))
+    if not phone_number:
+        return jsonify({'message': 'A valid phone number is required'}), 400
 
-    if not phone_number.startswith('+'):
-        phone_number = '+' + phone_number
+    owner_id, error = client_lookup_scope(request.args.get('username'))
+    if error:
+        return error
 
-    appointment = Appointment.query.filter_by(phone_number=phone_number).first()
+    appointment = find_client_appointment(phone_number, owner_id)
 
     if appointment:
-        services = json.loads(appointment.service) if isinstance(appointment.service, str) else appointment.service
-        services_details = []
-        total_cost = 0
-
-        for s in services:
-            service_obj = Service.query.get(s['id'])
-            service_cost = service_obj.cost * s['quantity']
-            services_details.append({
-                'name': service_obj.title,
-                'quantity': s['quantity'],
-                'cost': service_cost
-            })
-            total_cost += service_cost
+        services_details = [{
+            'name': item['title'] or UNKNOWN_SERVICE,
+            'quantity': item['quantity'],
+            'cost': line_total(item)
+        } for item in load_line_items(appointment.service)]
 
         appointment_info = {
             'time': appointment.date.strftime('%Y-%m-%d %H:%M') if appointment.date else "Not Set",
             'services': services_details,
             'status': appointment.status,
-            'total': total_cost,
-            'rejection_reason': appointment.rejection_reason if appointment.status == 'Rejected' else None,
+            'total': appointment.total_cost,
+            'rejection_reason': appointment.rejection_reason if appointment.status == AppointmentStatus.REJECTED else None,
         }
         return jsonify(appointment_info), 200
 
@@ -694,7 +1005,7 @@ def submit_feedback():
         if not shop_username:
             return jsonify({'message': 'Shop not specified'}), 400
 
-        owner = BusinessOwner.query.filter_by(username=shop_username).first()
+        owner = get_owner_by_username(shop_username)
         if not owner:
             return jsonify({'message': 'Business owner not found'}), 404
 
@@ -727,18 +1038,18 @@ def submit_feedback():
 def ensure_option_selected():
     if request.endpoint in ['get_shop_data', 'get_reservations', 'shop_view']:
         option_selected = session.get('option_selected')
-        logging.info(f"Option selected: {option_selected}")
+        logger.debug("Option selected: %s", option_selected)
         if option_selected is None:
             username = request.view_args.get('username', None)
             if username:
-                logging.info(f"Redirecting to option selection for username: {username}")
+                logger.info("Redirecting to option selection for username: %s", username)
                 return redirect(f'/shop/{username}/option')
             return jsonify({'message': 'You must select an option first'}), 403
         elif option_selected == 'no':
-            logging.info(f"User selected 'No', allowing access to shop view.")
+            logger.debug("User selected 'No', allowing access to shop view.")
             return None
         elif option_selected == 'yes':
-            logging.info(f"User selected 'Yes', proceeding normally.")
+            logger.debug("User selected 'Yes', proceeding normally.")
             return None
 
 
@@ -749,70 +1060,97 @@ def serve_react_app(path):
 
 # Returns available time slots for appointments on a specific date.
 # - Considers the business owner's working hours and existing appointments.
-# - Marks slots as 'occupied' if they are already booked.
+# - Marks slots as 'occupied' once overlapping bookings reach the shop's capacity (or that of `service_id`, when given);
+#   'remaining' tells how many more bookings a slot can take.
+# - Viewers can subscribe to 'slots:<username>:<date>' over Socket.IO instead of polling this endpoint.
+# - Identical concurrent requests share one computation.
 @app.route('/api/shop/<username>/available_slots', methods=['GET'])
+@coalesced
 def get_available_slots(username):
     date_str = request.args.get('date')
     if not date_str:
         return jsonify({'message': 'Date is required'}), 400
 
-    owner = BusinessOwner.query.filter_by(username=username).first()
+    owner = get_owner_by_username(username)
     if not owner:
         return jsonify({'message': 'Shop not found'}), 404
 
-    logging.debug(f"Retrieved owner with user_id: {owner.user_id} and owner_id: {owner.id}")
+    logger.debug("Retrieved owner with user_id: %s and owner_id: %s", owner.user_id, owner.id)
 
     date = datetime.strptime(date_str, '%Y-%m-%d').date()
-    day_of_week = date.strftime('%A')
 
-    working_hours = WorkingHours.query.filter_by(user_id=owner.user_id, day=day_of_week).first()
-    if not working_hours:
+    available_slots = compute_day_slots(owner, date, request.args.get('service_id', type=int))
+    if available_slots is None:
         return jsonify({'message': 'No working hours found for this day'}), 404
 
-    start_time = datetime.combine(date, working_hours.start_time).replace(tzinfo=MOSCOW_TZ)
-    end_time = datetime.combine(date, working_hours.end_time).replace(tzinfo=MOSCOW_TZ)
+    return jsonify({
+        'available_slots': available_slots,
+    }), 200
 
-    time_slots = []
-    current_time = start_time
-    now = datetime.now(MOSCOW_TZ)
 
-    # Generate available time slots
-    while current_time < end_time:
-        if date > now.date() or (date == now.date() and current_time.time() > now.time()):
-            time_slots.append(current_time.strftime('%H:%M'))
-        current_time += timedelta(minutes=60)
+# Returns the slots of every day of a month in one response: {'YYYY-MM-DD': [slots] or null when closed}.
+# - month: 'YYYY-MM'; service_id: optional, as for available_slots.
+# - The whole month is computed in one pass over the month's bookings.
+@app.route('/api/shop/<username>/availability', methods=['GET'])
+@coalesced
+def get_month_availability(username):
+    try:
+        first_day = datetime.strptime(request.args.get('month', ''), '%Y-%m').date()
+    except ValueError:
+        return jsonify({'message': 'Month is required in YYYY-MM format'}), 400
 
-    # Fetch all bookings, but only consider those that are not 'Rejected' or 'Cancelled' or 'Completed'
-    bookings = Appointment.query.filter(
-        Appointment.owner_id == owner.id,
-        db.func.date(Appointment.date) == date_str,
-        Appointment.status.notin_(['Rejected', 'Cancelled','Completed'])  #Exclude Rejected or Cancelled or Completed statuses
-    ).all()
+    owner = get_owner_by_username(username)
+    if not owner:
+        return jsonify({'message': 'Shop not found'}), 404
 
-    logging.debug(f"Bookings found for {date_str}: {[b.id for b in bookings]}")
+    num_days = calendar.monthrange(first_day.year, first_day.month)[1]
+    slots = compute_slots(owner, first_day, num_days, request.args.get('service_id', type=int))
+    return jsonify({
+        'month': first_day.strftime('%Y-%m'),
+        'days': {date.strftime('%Y-%m-%d'): day_slots for date, day_slots in slots.items()}
+    }), 200
 
-    # Collect booked slots
-    booked_slots = set()
-    for booking in bookings:
-        slot_time = booking.date.astimezone(MOSCOW_TZ)
-        appointment_end_time = booking.end_time.astimezone(MOSCOW_TZ)
 
-        while slot_time < appointment_end_time:
-            slot_str = slot_time.strftime('%H:%M')
-            booked_slots.add(slot_str)
-            logging.debug(f"Marking slot as booked: {slot_str}")
-            slot_time += timedelta(minutes=60)
+# Returns the earliest start at which a service of the shop can be booked.
+# - Served from the next_available table, which is kept current as bookings change, instead of scanning appointments.
+# - 'next_available' is null when nothing fits within NEXT_AVAILABLE_HORIZON_DAYS.
+@app.route('/api/shop/<username>/next_available', methods=['GET'])
+def get_next_available_slot(username):
+    service_id = request.args.get('service_id', type=int)
+    if not service_id:
+        return jsonify({'message': 'service_id is required'}), 400
 
-    logging.debug(f"Final booked slots: {booked_slots}")
+    owner = get_owner_by_username(username)
+    if not owner:
+        return jsonify({'message': 'Shop not found'}), 404
 
-    # Prepare available slots response
-    available_slots = [{'time': slot, 'status': 'occupied' if slot in booked_slots else 'free'} for slot in time_slots]
+    service = db.session.get(Service, service_id)
+    if not service or service.user_id != owner.user_id:
+        return jsonify({'message': 'Service not found'}), 404
 
+    entry = get_next_available(owner, service)
     return jsonify({
-        'available_slots': available_slots,
+        'service_id': service.id,
+        'duration': entry.duration,
+        'next_available': entry.starts_at.strftime('%Y-%m-%d %H:%M') if entry.starts_at else None
     }), 200
 
 
+
+# Searches all shops for a service by keyword and returns the shops that can fit it soonest.
+# - q: keywords matched against service titles and descriptions (prefix match, all words required).
+# - limit: number of shops to return (default 10, at most 50); duration: minimum service length in minutes.
+@app.route('/api/shops/search', methods=['GET'])
+def search_shops():
+    keywords = request.args.get('q', '').strip()
+    if not keywords:
+        return jsonify({'message': 'Search query is required'}), 400
+
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    duration = max(request.args.get('duration', 0, type=int), 0)
+
+    return jsonify({'results': search_earliest(keywords, limit, duration)}), 200
+
 # Retrieves time slots for a specific business owner on a given date.
 # - Marks slots as 'free' or 'occupied' based on existing bookings.
 @app.route('/api/shop/<int:owner_id>/slots', methods=['GET'])
@@ -869,7 +1207,7 @@ def request_otp(username):
     session['otp_phone_number'] = phone_number
 
 
-    logging.info(f"Generated OTP for {phone_number}: {otp}")
+    logger.info("Generated OTP for %s", phone_number)
 
 
     if phone_number.startswith("+7"):
@@ -891,22 +1229,22 @@ def verify_otp_route(username):
     phone_number = data.get('phone_number')
     otp_code = data.get('otp_code')
 
-    logging.info(f"Received data for verification: {data}")
 
     if not phone_number or not otp_code:
-        logging.warning(f"Missing phone_number or otp_code: phone_number={phone_number}, otp_code={otp_code}")
+        logger.warning("Missing phone_number or otp_code for verification")
         return jsonify({'message': 'Phone number and OTP code are required'}), 400
 
     stored_otp = session.get('otp')
     stored_phone_number = session.get('otp_phone_number')
 
     if stored_otp and stored_phone_number == phone_number and int(otp_code) == stored_otp:
+        regenerate_session(session)
         session['verified_phone_number'] = phone_number
-        logging.info(f"Stored phone_number in session: {session.get('verified_phone_number')}")
+        logger.info("Stored phone_number in session: %s", session.get('verified_phone_number'))
         return jsonify({'message': 'OTP verified successfully'}), 200
 
     else:
-        logging.warning(f"OTP verification failed for {phone_number}")
+        logger.warning("OTP verification failed for %s", phone_number)
         return jsonify({'message': 'Invalid OTP'}), 400
 
 
@@ -925,7 +1263,7 @@ def generate_cancel_otp():
     otp_code = randint(100000, 999999)
 
 
-    logging.info(f"Generated OTP for {phone_number}: {otp_code}")
+    logger.info("Generated OTP for %s", phone_number)
 
 
     session['otp'] = otp_code
@@ -955,7 +1293,7 @@ def select_option_page(username):
 @app.route('/shop/<username>/view', methods=['GET'])
 def shop_view(username):
     option_selected = session.get('option_selected')
-    logging.info(f"Option selected in session: {option_selected}")
+    logger.info("Option selected in session: %s", option_selected)
 
     if option_selected == 'no':
         return get_shop_data(username)
@@ -972,53 +1310,33 @@ def select_option():
     option_selected = data.get('option_selected')
     if option_selected:
         session['option_selected'] = option_selected
-        logging.info(f"Option selected: {option_selected}")
+        logger.info("Option selected: %s", option_selected)
         return jsonify({'message': 'Option selected successfully'}), 200
     return jsonify({'error': 'Invalid option'}), 400
 
 
 # Fetches business owner and shop details including services and working hours.
 # - Returns services offered by the business owner and their daily working hours.
+# - The body is serialized once per catalog version and served from memory with a strong ETag;
+#   clients revalidate with If-None-Match and get 304 while the catalog is unchanged.
+# - Identical concurrent requests share one computation.
 @app.route('/api/shop/<username>/data', methods=['GET'])
+@coalesced
 def get_shop_data(username):
 
-    logging.info(f"Fetching shop data for username: {username}")
-    owner = BusinessOwner.query.filter_by(username=username).first()
+    logger.debug("Fetching shop data for username: %s", username)
+    owner = get_owner_by_username(username)
 
     if not owner:
-        logging.error(f"Shop not found for username: {username}")
+        logger.error("Shop not found for username: %s", username)
         return jsonify({'message': 'Shop not found'}), 404
 
+    body, etag = catalog_cache.get(owner, catalog_version(owner.user_id))
 
-    services = Service.query.filter_by(user_id=owner.user_id).all()
-    working_hours = WorkingHours.query.filter_by(user_id=owner.user_id).all()
-
-
-    services_data = [
-        {
-            'id': s.id,
-            'title': s.title,
-            'cost': s.cost,
-            'description': s.description,
-            'service_time': s.service_time
-        } for s in services
-    ]
-
-    working_hours_data = [
-        {
-            'day': wh.day,
-            'start_time': wh.start_time.strftime('%H:%M'),
-            'end_time': wh.end_time.strftime('%H:%M')
-        } for wh in working_hours
-    ]
-
-    return jsonify({
-        'personal_name': owner.personal_name,
-        'email': owner.email,
-        'phone_number': owner.phone_number,
-        'services': services_data,
-        'working_hours': working_hours_data
-    }), 200
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 # Reserves an appointment for a client with selected services and a specific date.
@@ -1030,14 +1348,10 @@ def reserve_appointment(username):
     data = request.get_json()
     client_name = data.get('client_name')
     client_email = data.get('client_email')
-    phone_number = session.get('verified_phone_number').strip()
+    phone_number = normalize_phone(session.get('verified_phone_number'))
     services = data.get('services')
     appointment_date_str = data.get('date')
 
-
-    if not phone_number.startswith('+'):
-        phone_number = '+' + phone_number
-
     if not client_name or not client_email or not phone_number or not services or not appointment_date_str:
         return jsonify({'message': 'Client name, email, phone number, services, and appointment date are required'}), 400
 
@@ -1048,14 +1362,26 @@ def reserve_appointment(username):
     except ValueError:
         return jsonify({'message': 'Invalid date format. Use YYYY-MM-DD HH:MM.'}), 400
 
-    owner = BusinessOwner.query.filter_by(username=username).first()
+    owner = get_owner_by_username(username)
     if not owner:
         return jsonify({'message': 'Business owner not found'}), 404
 
-    total_service_time = sum([Service.query.get(service['id']).service_time * service['quantity'] for service in services])
+    # Price and duration are captured now; later edits to the services do not touch this booking
+    try:
+        line_items = snapshot_line_items(services, owner.user_id)
+    except ValueError:
+        return jsonify({'message': 'Invalid service information'}), 400
+    if line_items is None:
+        return jsonify({'message': 'One or more services not found'}), 404
+
+    total_service_time = total_duration(line_items)
     end_time_moscow = appointment_date_moscow + timedelta(minutes=total_service_time)
 
-    services_json = json.dumps(services)
+    error = booking_time_error(owner, appointment_date_moscow, end_time_moscow, {item['id'] for item in line_items})
+    if error:
+        return error
+
+    services_json = json.dumps(line_items)
 
 
     appointment = Appointment(
@@ -1063,67 +1389,48 @@ def reserve_appointment(username):
         client_name=client_name,
         client_email=client_email,
         phone_number=phone_number,
+        client_id=get_client_id(phone_number, create=True),
         service=services_json,
         date=appointment_date_moscow,
         end_time=end_time_moscow,
         total_service_time=total_service_time,
-        num_services=len(services),
-        status='Pending',
+        num_services=len(line_items),
+        total_cost=total_cost(line_items),
+        status=AppointmentStatus.PENDING,
     )
     db.session.add(appointment)
+    db.session.flush()
+    record_appointment_update(appointment, 'reserved',
+                              client_name=client_name,
+                              phone_number=phone_number,
+                              client_email=client_email,
+                              date=format_time(appointment_date_moscow),
+                              end_time=format_time(end_time_moscow),
+                              service=line_items,
+                              total_service_time=total_service_time,
+                              total_cost=appointment.total_cost)
     db.session.commit()
 
     return jsonify({'message': 'Appointment reserved successfully'}), 200
 
 
-
-
-
-@app.route('/api/business_owner/<action>/<int:reservation_id>', methods=['POST'])
-@login_required
-def process_reservation_action(action, reservation_id):
-    valid_actions = ['accept', 'reject', 'report']
-    if action not in valid_actions:
-        logging.warning(f"Invalid action attempt: {action}")
-        return jsonify({'message': 'Invalid action'}), 400
-
-    owner_id = session['owner_id']
-    appointment = Appointment.query.filter_by(id=reservation_id, owner_id=owner_id).first()
-
-    if not appointment:
-        logging.error(f"Appointment {reservation_id} not found for owner {owner_id}")
-        return jsonify({'message': 'Appointment not found'}), 404
-
-    if action == 'accept':
-        appointment.status = 'Accepted'
-
-        db.session.commit()
-        logging.info(f"Reservation {reservation_id} accepted by owner {owner_id}")
-    elif action == 'reject':
-        appointment.status = 'Rejected'
-        db.session.commit()
-        logging.info(f"Reservation {reservation_id} rejected by owner {owner_id}")
-    elif action == 'report':
-        appointment.status = 'Reported'
-        db.session.commit()
-        logging.info(f"Reservation {reservation_id} reported by owner {owner_id}")
-
-    return jsonify({'message': f'Reservation {action}ed successfully'}), 200
-
-
 # Marks an appointment as 'Arrived' after verifying the OTP provided by the client.
 # - Updates the reservation status accordingly.
 @app.route('/api/business_owner/arrived/<int:reservation_id>', methods=['POST'])
 @login_required
 def mark_as_arrived(reservation_id):
     owner_id = session['owner_id']
-    logging.info(f"Processing 'Arrived' action for reservation {reservation_id} by owner {owner_id}")
+    logger.info("Processing 'Arrived' action for reservation %s by owner %s", reservation_id, owner_id)
 
     appointment = Appointment.query.filter_by(id=reservation_id, owner_id=owner_id).first()
     if not appointment:
-        logging.error(f"Appointment {reservation_id} not found for owner {owner_id}")
+        logger.error("Appointment %s not found for owner %s", reservation_id, owner_id)
         return jsonify({'message': 'Appointment not found'}), 404
 
+    error = invalid_transition(appointment, AppointmentStatus.ARRIVED)
+    if error:
+        return error
+
     data = request.get_json()
     otp_code = data.get('otp')
 
@@ -1131,24 +1438,26 @@ def mark_as_arrived(reservation_id):
     stored_otp = OTP.query.filter_by(phone_number=appointment.phone_number).order_by(OTP.created_at.desc()).first()
 
     if not stored_otp:
-        logging.error(f"No OTP found for phone number {appointment.phone_number}")
+        logger.error("No OTP found for phone number %s", appointment.phone_number)
         return jsonify({'message': 'No OTP found for this phone number'}), 404
 
     if stored_otp.otp != otp_code:
-        logging.error(f"Invalid OTP provided: {otp_code} for phone number {appointment.phone_number}")
+        logger.error("Invalid OTP provided for phone number %s", appointment.phone_number)
         return jsonify({'message': 'Invalid OTP'}), 400
 
 
-    appointment.status = 'Arrived'
+    appointment.status = AppointmentStatus.ARRIVED
+    record_appointment_update(appointment, 'arrived')
     db.session.commit()
 
-    logging.info(f"Reservation {reservation_id} marked as 'Arrived'. No earnings calculated.")
+    logger.info("Reservation %s marked as 'Arrived'. No earnings calculated.", reservation_id)
     return jsonify({
         'id': appointment.id,
         'client_name': appointment.client_name,
         'phone_number': appointment.phone_number,
         'client_email': appointment.client_email,
-        'service': eval(appointment.service),
+        'service': load_line_items(appointment.service),
+        'total_cost': appointment.total_cost,
         'date': appointment.date.strftime('%Y-%m-%d %H:%M') if appointment.date else "Not Set",
         'status': appointment.status
     }), 200
@@ -1161,21 +1470,25 @@ def mark_as_arrived(reservation_id):
 @login_required
 def mark_as_paid(reservation_id):
     owner_id = session['owner_id']
-    logging.info(f"Processing 'Paid' action for reservation {reservation_id} by owner {owner_id}")
+    logger.info("Processing 'Paid' action for reservation %s by owner %s", reservation_id, owner_id)
 
     appointment = Appointment.query.filter_by(id=reservation_id, owner_id=owner_id).first()
     if not appointment:
-        logging.error(f"Appointment {reservation_id} not found for owner {owner_id}")
+        logger.error("Appointment %s not found for owner %s", reservation_id, owner_id)
         return jsonify({'message': 'Appointment not found'}), 404
 
+    error = invalid_transition(appointment, AppointmentStatus.COMPLETED)
+    if error:
+        return error
 
-    appointment.status = 'Completed'
+    appointment.status = AppointmentStatus.COMPLETED
+    record_appointment_update(appointment, 'paid')
     db.session.commit()
 
 
     earnings = calculate_earnings(owner_id)
 
-    logging.info(f"Reservation {reservation_id} marked as 'Paid' and 'Completed'. Earnings updated: {earnings}")
+    logger.info("Reservation %s marked as 'Paid' and 'Completed'. Earnings updated: %s", reservation_id, earnings)
 
     return jsonify({
         'reservation': {
@@ -1183,7 +1496,8 @@ def mark_as_paid(reservation_id):
             'client_name': appointment.client_name,
             'phone_number': appointment.phone_number,
             'client_email': appointment.client_email,
-            'service': eval(appointment.service),
+            'service': load_line_items(appointment.service),
+            'total_cost': appointment.total_cost,
             'date': appointment.date.strftime('%Y-%m-%d %H:%M') if appointment.date else "Not Set",
             'status': appointment.status
         },
@@ -1191,80 +1505,6 @@ def mark_as_paid(reservation_id):
     }), 200
 
 
-
-
-
-def calculate_earnings(owner_id):
-    earnings = {'daily': 0, 'weekly': 0, 'monthly': 0}
-    now = datetime.now(tz.UTC)
-
-    business_owner = BusinessOwner.query.get(owner_id)
-    if not business_owner:
-        logging.error(f"BusinessOwner with ID {owner_id} not found")
-        return earnings
-
-    user_id = business_owner.user_id
-
-    services = Service.query.filter_by(user_id=user_id).all()
-    if not services:
-        logging.error(f"No services found for user_id {user_id}")
-        return earnings
-
-
-    appointments = Appointment.query.filter_by(owner_id=owner_id, status='Completed').all()
-    if not appointments:
-        logging.info(f"No completed appointments found for owner_id {owner_id}")
-        return earnings
-
-    service_earnings = {}
-    for appointment in appointments:
-        try:
-
-            services_data = json.loads(appointment.service) if isinstance(appointment.service, str) else appointment.service
-
-
-            if not isinstance(services_data, list):
-                logging.error(f"Invalid service data format in appointment {appointment.id}")
-                continue
-
-            for service in services_data:
-
-                logging.info(f"Processing service data: {service}")
-                service_id = service.get('id') or service.get('service_id')
-                if not service_id:
-                    logging.error(f"Service ID missing in service details for appointment {appointment.id}: {service}")
-                    continue
-
-                service_obj = Service.query.get(service_id)
-                if not service_obj or service_obj.user_id != user_id:
-                    logging.error(f"Service with ID {service_id} not found or does not belong to user {user_id}")
-                    continue
-
-                earnings_value = service_obj.cost * service.get('quantity', 1)
-                appointment_date = appointment.date
-                if appointment_date.tzinfo is None:
-                    appointment_date = appointment_date.replace(tzinfo=tz.UTC)
-
-                diff = now - appointment_date
-                if diff.days < 1:
-                    earnings['daily'] += earnings_value
-                if diff.days < 7:
-                    earnings['weekly'] += earnings_value
-                if diff.days < 30:
-                    earnings['monthly'] += earnings_value
-
-
-                if service_obj.title not in service_earnings:
-                    service_earnings[service_obj.title] = 0
-                service_earnings[service_obj.title] += earnings_value
-
-        except Exception as e:
-            logging.error(f"Error processing appointment {appointment.id}: {str(e)}")
-            continue
-
-    return earnings
-
-
 # Allows a business owner to report an issue with a reservation.
 # - Requires report details and updates the reservation status to 'Reported.'
 @app.route('/api/business_owner/report/<int:reservation_id>', methods=['POST'])
@@ -1274,49 +1514,77 @@ def report_reservation(reservation_id):
     appointment = Appointment.query.filter_by(id=reservation_id, owner_id=owner_id).first()
 
     if not appointment:
-        logging.error(f"Appointment {reservation_id} not found for owner {owner_id}")
+        logger.error("Appointment %s not found for owner %s", reservation_id, owner_id)
         return jsonify({'message': 'Appointment not found'}), 404
 
     report_details = request.json.get('report_details')
     if not report_details:
         return jsonify({'message': 'Report details are required'}), 400
 
+    error = invalid_transition(appointment, AppointmentStatus.REPORTED)
+    if error:
+        return error
 
-    appointment.status = 'Reported'
+    appointment.status = AppointmentStatus.REPORTED
     appointment.report_details = report_details
+    record_appointment_update(appointment, 'reported', report_details=report_details)
     db.session.commit()
 
-    logging.info(f"Reservation {reservation_id} reported by owner {owner_id}")
+    logger.info("Reservation %s reported by owner %s", reservation_id, owner_id)
 
     return jsonify({'message': 'Reservation reported successfully'}), 200
 
 
 # Updates the date and time of an existing appointment based on the client's phone number.
+# - The phone number must be the one the client verified in this session, as for reservations.
 # - Updates both the start and end times of the appointment.
+# - The appointment is the client's nearest upcoming one, in the shop given by the optional `username`,
+#   and must still be reschedulable.
 @app.route('/api/update_appointment', methods=['POST'])
 def update_appointment():
     data = request.get_json()
-    phone_number = data.get('phone')
+    phone_number = normalize_phone(data.get('phone'))
     new_date_str = data.get('new_date')
     new_time_str = data.get('new_time')
 
     if not phone_number or not new_date_str or not new_time_str:
         return jsonify({'message': 'Phone number, new date, and new time are required'}), 400
+    if phone_number != normalize_phone(session.get('verified_phone_number')):
+        return jsonify({'message': 'Verify your phone number first'}), 403
+
+    owner_id, error = client_lookup_scope(data.get('username'))
+    if error:
+        return error
 
-    appointment = Appointment.query.filter_by(phone_number=phone_number).first()
+    appointment = find_client_appointment(phone_number, owner_id, exclude_statuses=(AppointmentStatus.CANCELLED,))
 
     if not appointment:
         return jsonify({'message': 'Appointment not found'}), 404
 
+    error = invalid_reschedule(appointment)
+    if error:
+        return error
+
     try:
 
         new_datetime_moscow = MOSCOW_TZ.localize(datetime.strptime(f"{new_date_str} {new_time_str}", '%Y-%m-%d %H:%M'))
-        new_datetime_utc = new_datetime_moscow.astimezone(pytz.utc)
     except ValueError:
         return jsonify({'message': 'Invalid date or time format'}), 400
-
-    appointment.date = new_datetime_utc
-    appointment.end_time = new_datetime_utc + timedelta(minutes=appointment.total_service_time)
+    new_end_time_moscow = new_datetime_moscow + timedelta(minutes=appointment.total_service_time)
+
+    error = booking_time_error(db.session.get(BusinessOwner, appointment.owner_id),
+                               new_datetime_moscow, new_end_time_moscow,
+                               {item['id'] for item in load_line_items(appointment.service)},
+                               appointment_id=appointment.id)
+    if error:
+        return error
+
+    # Stored as Moscow wall time, like every other path that writes appointment times
+    appointment.date = new_datetime_moscow
+    appointment.end_time = new_end_time_moscow
+    record_appointment_update(appointment, 'rescheduled',
+                              date=format_time(appointment.date),
+                              end_time=format_time(appointment.end_time))
     db.session.commit()
 
     return jsonify({'message': 'Appointment updated successfully'}), 200
@@ -1325,39 +1593,25 @@ def update_appointment():
 # - Includes service details, appointment status, and total cost.
 @app.route('/api/shop/<username>/appointment_details', methods=['GET'])
 def get_appointment_details(username):
-    phone_number = request.args.get('phone').strip()
-
-    if not phone_number.startswith('+'):
-        phone_number = '+' + phone_number
-    logging.info(f"Checking appointment for phone number: {phone_number}")
+    phone_number = normalize_phone(request.args.get('phone'))
+    if not phone_number:
+        return jsonify({'message': 'A valid phone number is required'}), 400
+    logger.info("Checking appointment for phone number: %s", phone_number)
 
+    owner_id, error = client_lookup_scope(username)
+    if error:
+        return error
 
-    appointment = Appointment.query.filter_by(phone_number=phone_number).filter(Appointment.status != 'Cancelled').first()
+    appointment = find_client_appointment(phone_number, owner_id, exclude_statuses=(AppointmentStatus.CANCELLED,))
 
     if appointment:
-        logging.info(f"Appointment found: {appointment}")
-        services = json.loads(appointment.service) if isinstance(appointment.service, str) else appointment.service
-        services_details = []
-        total_cost = 0
-
-        for s in services:
-            service_id = s.get('id')
-            if service_id:
-                service_obj = Service.query.get(service_id)
-                if service_obj:
-                    service_cost = service_obj.cost * s['quantity']
-                    services_details.append({
-                        'name': service_obj.title,
-                        'quantity': s['quantity'],
-                        'cost': service_cost,
-                        'duration': service_obj.service_time
-                    })
-                    total_cost += service_cost
-                else:
-                    logging.warning(f"Service with id {service_id} not found.")
-            else:
-                logging.warning("Service ID missing in one of the services.")
-
+        logger.info("Appointment found: %s", appointment)
+        services_details = [{
+            'name': item['title'] or UNKNOWN_SERVICE,
+            'quantity': item['quantity'],
+            'cost': line_total(item),
+            'duration': item['duration']
+        } for item in load_line_items(appointment.service)]
 
         appointment_info = {
             'id': appointment.id,
@@ -1367,8 +1621,8 @@ def get_appointment_details(username):
             'time': appointment.date.astimezone(MOSCOW_TZ).strftime('%H:%M'),
             'services': services_details,
             'status': appointment.status,
-            'total': total_cost,
-            'rejection_reason': appointment.rejection_reason if appointment.status == 'Rejected' else None,
+            'total': appointment.total_cost,
+            'rejection_reason': appointment.rejection_reason if appointment.status == AppointmentStatus.REJECTED else None,
         }
 
         return jsonify(appointment_info), 200
@@ -1389,7 +1643,7 @@ def request_otp_ver():
     if phone:
         otp = random.randint(100000, 999999)
         otp_storage[phone] = otp
-        app.logger.info(f"Generated OTP for {phone}: {otp}")
+        app.logger.info("Generated OTP for %s", phone)
         return jsonify({'message': 'OTP sent successfully'}), 200
     else:
         return jsonify({'message': 'Phone number is required'}), 400
@@ -1403,8 +1657,11 @@ def verify_otp_ver():
     otp = data.get('otp')
 
     if otp_storage.get(phone) == int(otp):
-        # Fetch the appointment using the phone number
-        appointment = Appointment.query.filter_by(phone_number=phone).first()
+        # Fetch the client's most relevant appointment, in the given shop if any
+        owner_id, error = client_lookup_scope(data.get('username'))
+        if error:
+            return error
+        appointment = find_client_appointment(normalize_phone(phone), owner_id, exclude_statuses=(AppointmentStatus.CANCELLED,))
 
         if not appointment:
             return jsonify({'message': 'Appointment not found'}), 404
@@ -1427,19 +1684,13 @@ def verify_otp_ver():
         ]
 
 
-        services = json.loads(appointment.service) if isinstance(appointment.service, str) else appointment.service
-        services_details = []
-        for s in services:
-            service_id = s.get('service_id') or s.get('id')
-            service_obj = Service.query.get(service_id)
-            if service_obj:
-                services_details.append({
-                    'service_id': service_id,
-                    'name': service_obj.title,
-                    'quantity': s['quantity'],
-                    'cost': service_obj.cost,
-                    'duration': service_obj.service_time
-                })
+        services_details = [{
+            'service_id': item['id'],
+            'name': item['title'] or UNKNOWN_SERVICE,
+            'quantity': item['quantity'],
+            'cost': item['cost'],
+            'duration': item['duration']
+        } for item in load_line_items(appointment.service)]
 
 
         response_data = {
@@ -1463,8 +1714,6 @@ def verify_otp_ver():
 @app.route('/api/request_change', methods=['POST'])
 def request_change():
     data = request.get_json()
-    print('Received request data:', data)
-    logging.info(f"Received data: {data}")
 
     appointment_id = data.get('appointment_id')
     client_name = data.get('client_name')
@@ -1473,25 +1722,28 @@ def request_change():
     requested_date_str = data.get('requested_date')
     requested_time_str = data.get('requested_time')
     requested_service = data.get('requested_service')
-    requested_total_service_time = data.get('requested_total_service_time')
-    requested_num_services = data.get('requested_num_services')
 
 
-    logging.info(f"Requested services: {requested_service}")
 
 
     if not all([appointment_id, client_name, phone_number, requested_date_str, requested_time_str]):
-        logging.warning('Missing required fields in the request')
+        logger.warning('Missing required fields in the request')
         return jsonify({'message': 'Missing required information'}), 400
 
-    if requested_total_service_time is None:
-        return jsonify({"error": "Total service time is missing."}), 400
-
-
     appointment = Appointment.query.get(appointment_id)
     if not appointment:
         return jsonify({'message': 'Appointment not found'}), 404
 
+    # The requested services are snapshotted like a booking; their duration sets the requested end time
+    try:
+        line_items = snapshot_line_items(requested_service or [], appointment.owner.user_id)
+    except ValueError:
+        logger.warning('One or more services are missing a service_id')
+        return jsonify({'message': 'Invalid service information'}), 400
+    if line_items is None:
+        return jsonify({'message': 'One or more services not found'}), 404
+    requested_total_service_time = total_duration(line_items)
+
     try:
         requested_datetime_moscow = MOSCOW_TZ.localize(
             datetime.strptime(f"{requested_date_str} {requested_time_str}", '%Y-%m-%d %H:%M')
@@ -1501,17 +1753,6 @@ def request_change():
         return jsonify({'message': 'Invalid date or time format'}), 400
 
 
-    service_ids = [service.get('service_id') for service in requested_service]
-    if not all(service_ids):
-        logging.warning('One or more services are missing a service_id')
-        return jsonify({'message': 'Invalid service information'}), 400
-
-
-    services = Service.query.filter(Service.id.in_(service_ids)).all()
-    if len(services) != len(service_ids):
-        return jsonify({'message': 'One or more services not found'}), 404
-
-
     request_change_entry = RequestChange(
         appointment_id=appointment_id,
         client_name=client_name,
@@ -1519,14 +1760,23 @@ def request_change():
         client_email=client_email,
         requested_date=requested_datetime_moscow,
         requested_end_time=requested_end_time,
-        requested_service=json.dumps(requested_service),
+        requested_service=json.dumps(line_items),
         requested_total_service_time=requested_total_service_time,
-        requested_num_services=requested_num_services,
+        requested_num_services=len(line_items),
+        requested_total_cost=total_cost(line_items),
     )
 
-    logging.info(f"Storing RequestChange entry with services: {request_change_entry.requested_service}")
+    logger.info("Storing RequestChange entry for appointment %s", request_change_entry.appointment_id)
 
     db.session.add(request_change_entry)
+    db.session.flush()
+    record_appointment_update(appointment, 'change_requested',
+                              request_change_id=request_change_entry.id,
+                              requested_date=format_time(requested_datetime_moscow),
+                              requested_end_time=format_time(requested_end_time),
+                              requested_service=line_items,
+                              requested_total_service_time=requested_total_service_time,
+                              requested_total_cost=request_change_entry.requested_total_cost)
     db.session.commit()
 
     return jsonify({'message': 'Request change submitted successfully'}), 200
@@ -1544,24 +1794,28 @@ def cancel_appointment():
         cancellation_reason = data.get('cancellation_reason')
 
 
-        logging.info(f"Received OTP for phone number {phone_number}: {otp_code}")
-        logging.info(f"Cancellation reason provided: {cancellation_reason}")
+        logger.info("Received OTP for phone number %s", phone_number)
+        logger.info("Cancellation reason provided: %s", cancellation_reason)
 
 
-        appointment = Appointment.query.filter_by(id=appointment_id, phone_number=phone_number).first()
-        if not appointment:
+        appointment = db.session.get(Appointment, appointment_id) if appointment_id else None
+        if not appointment or not appointment.client or appointment.client.phone_number != normalize_phone(phone_number):
             return jsonify({'message': 'Appointment not found'}), 404
 
 
         stored_otp = session.get('otp')
         stored_phone_number = session.get('otp_phone_number')
 
-        if not stored_otp or stored_otp != int(otp_code) or stored_phone_number != phone_number:
+        if not stored_otp or stored_otp != int(otp_code) or normalize_phone(stored_phone_number) != normalize_phone(phone_number):
             return jsonify({'message': 'Invalid OTP'}), 400
 
+        error = invalid_transition(appointment, AppointmentStatus.CANCELLED)
+        if error:
+            return error
 
-        appointment.status = 'Cancelled'
+        appointment.status = AppointmentStatus.CANCELLED
         appointment.cancellation_reason = cancellation_reason
+        record_appointment_update(appointment, 'cancelled', cancellation_reason=cancellation_reason)
 
         db.session.commit()
 
@@ -1569,68 +1823,15 @@ def cancel_appointment():
         session.pop('otp', None)
         session.pop('otp_phone_number', None)
 
-        logging.info(f"Appointment {appointment_id} cancelled successfully for {phone_number}")
+        logger.info("Appointment %s cancelled successfully for %s", appointment_id, phone_number)
         return jsonify({'message': 'Appointment cancelled successfully.'}), 200
 
     except Exception as e:
-        logging.error(f"Error cancelling appointment: {str(e)}")
+        logger.error("Error cancelling appointment: %s", e)
         db.session.rollback()
         return jsonify({'message': 'Failed to cancel appointment', 'error': str(e)}), 500
 
 
 
 def calculate_earnings(owner_id):
-    earnings = {'daily': 0, 'weekly': 0, 'monthly': 0, 'forecast': {'labels': [], 'data': []}}
-    now = datetime.now(tz.UTC)
-
-
-    appointments = Appointment.query.filter_by(owner_id=owner_id, status='Completed').all()
-
-    service_earnings = {}
-    for appointment in appointments:
-        service_details = eval(appointment.service)
-        for service in service_details:
-
-            service_id = service.get('id') or service.get('service_id')
-
-            if not service_id:
-                logging.error(f"Service ID missing in appointment {appointment.id}")
-                continue
-
-
-            service_obj = Service.query.get(service_id)
-            if not service_obj:
-                logging.error(f"Service with ID {service_id} not found for appointment {appointment.id}")
-                continue
-
-
-            earnings_value = service_obj.cost * service.get('quantity', 1)
-
-            appointment_date = appointment.date
-            if appointment_date.tzinfo is None:
-                appointment_date = appointment_date.replace(tzinfo=tz.UTC)
-
-            diff = now - appointment_date
-            if diff.days < 1:
-                earnings['daily'] += earnings_value
-            if diff.days < 7:
-                earnings['weekly'] += earnings_value
-            if diff.days < 30:
-                earnings['monthly'] += earnings_value
-
-
-            if service_obj.title not in service_earnings:
-                service_earnings[service_obj.title] = 0
-            service_earnings[service_obj.title] += earnings_value
-
-
-    if len(appointments) > 0:
-        avg_daily_earnings = earnings['daily'] / len(appointments)
-        earnings['forecast']['labels'] = ['Next Week', 'Next Month', 'Next Year']
-        earnings['forecast']['data'] = [
-            avg_daily_earnings * 7,
-            avg_daily_earnings * 30,
-            avg_daily_earnings * 365
-        ]
-
-    return earnings
\ No newline at end of file
+    return earnings_summary(owner_id)
\ No newline at end of file
@@ -0,0 +1,133 @@
+import logging
+import re
+import threading
+from datetime import datetime
+
+import pytz
+from sqlalchemy import text
+
+from official_website import app, db
+from official_website.models import Service
+from .models import BusinessOwner, NextAvailable
+from .availability import refresh_next_available
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+logger = logging.getLogger(__name__)
+
+_index_ready = False
+_index_lock = threading.Lock()
+
+# External-content FTS5 index over service titles and descriptions, kept in sync with the service table by triggers.
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS service_fts USING fts5("
+    "title, description, content='service', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS service_fts_insert AFTER INSERT ON service BEGIN "
+    "INSERT INTO service_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS service_fts_delete AFTER DELETE ON service BEGIN "
+    "INSERT INTO service_fts(service_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS service_fts_update AFTER UPDATE ON service BEGIN "
+    "INSERT INTO service_fts(service_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description); "
+    "INSERT INTO service_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END"
+]
+
+# One row per shop: the matching service that can start soonest, taken from the next_available summary.
+# SQLite returns the other columns of the row holding MIN(starts_at).
+SEARCH_QUERY = text("""
+    SELECT bo.username, bo.company_name, s.id AS service_id, s.title, s.cost, s.service_time,
+           MIN(na.starts_at) AS starts_at
+    FROM service_fts
+    JOIN service s ON s.id = service_fts.rowid
+    JOIN business_owner bo ON bo.user_id = s.user_id
+    JOIN next_available na ON na.owner_id = bo.id AND na.service_id = s.id
+    WHERE service_fts MATCH :query
+      AND na.starts_at > :now
+      AND na.duration >= :duration
+    GROUP BY bo.id
+    ORDER BY starts_at
+    LIMIT :limit
+""")
+
+
+# Creates the search index on first use and fills it from the existing services.
+def ensure_search_index():
+    global _index_ready
+    if _index_ready:
+        return
+    with _index_lock:
+        if _index_ready:
+            return
+        with db.engine.begin() as conn:
+            created = conn.execute(text(
+                "SELECT count(*) FROM sqlite_master WHERE name = 'service_fts'"
+            )).scalar() == 0
+            for statement in SEARCH_INDEX_DDL:
+                conn.execute(text(statement))
+            if created:
+                conn.execute(text("INSERT INTO service_fts(service_fts) VALUES ('rebuild')"))
+                logger.info("Built the service search index")
+        _index_ready = True
+
+
+# Turns free text into an FTS5 query: every word must match, as a prefix, so 'mass' finds 'massage'.
+def to_match_query(keywords):
+    words = re.findall(r'\w+', keywords)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+# Returns up to `limit` shops offering a service matching `keywords`, earliest available first.
+# - The work is one FTS lookup joined by primary key to the next_available summary; no calendar is computed here.
+# - `duration` (minutes) keeps only services whose entry was fitted for at least that long.
+def search_earliest(keywords, limit, duration=0):
+    match = to_match_query(keywords)
+    if not match:
+        return []
+    ensure_search_index()
+
+    now = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
+    rows = db.session.execute(SEARCH_QUERY, {
+        'query': match,
+        'now': now.strftime('%Y-%m-%d %H:%M:%S.%f'),
+        'duration': duration,
+        'limit': limit
+    }).mappings().all()
+
+    return [{
+        'username': row['username'],
+        'company_name': row['company_name'],
+        'service_id': row['service_id'],
+        'title': row['title'],
+        'cost': row['cost'],
+        'service_time': row['service_time'],
+        'next_available': row['starts_at'][:16]
+    } for row in rows]
+
+
+# Recomputes next-available entries that are missing or have slipped into the past, so shops keep showing up
+# in search between bookings; runs from the background scheduler.
+def refresh_stale_next_available():
+    with app.app_context():
+        try:
+            now = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
+            stale = db.session.query(BusinessOwner, Service).join(
+                Service, Service.user_id == BusinessOwner.user_id
+            ).outerjoin(
+                NextAvailable,
+                (NextAvailable.owner_id == BusinessOwner.id) & (NextAvailable.service_id == Service.id)
+            ).filter(
+                (NextAvailable.owner_id.is_(None)) | (NextAvailable.starts_at <= now)
+            ).all()
+
+            by_owner = {}
+            for owner, service in stale:
+                by_owner.setdefault(owner, []).append(service)
+            for owner, services in by_owner.items():
+                refresh_next_available(owner, services)
+            db.session.commit()
+            if by_owner:
+                logger.info("Refreshed next available starts for %s services of %s shops", len(stale), len(by_owner))
+        except Exception as e:
+            logger.error("Error refreshing next available starts: %s", e)
+            db.session.rollback()
+        finally:
+            db.session.remove()
@@ -0,0 +1,164 @@
+import logging
+from enum import Enum
+
+from sqlalchemy import Integer, inspect, literal_column, text
+from sqlalchemy.types import TypeDecorator
+
+logger = logging.getLogger(__name__)
+
+
+# Appointment lifecycle. Members are the labels the API has always returned ('Pending', ...), so they
+# compare equal to and serialize as those strings; the database stores the integer code instead.
+class AppointmentStatus(str, Enum):
+    CLIENT_DETAILS = 'Client Details Provided'
+    PENDING = 'Pending'
+    ACCEPTED = 'Accepted'
+    ARRIVED = 'Arrived'
+    COMPLETED = 'Completed'
+    CANCELLED = 'Cancelled'
+    REJECTED = 'Rejected'
+    REPORTED = 'Reported'
+
+    def __str__(self):
+        return self.value
+
+    def __format__(self, spec):
+        return self.value.__format__(spec)
+
+
+# Change request lifecycle; requests are deleted once accepted, so most rows are pending.
+class ChangeRequestStatus(str, Enum):
+    PENDING = 'Pending'
+    APPROVED = 'Approved'
+    REJECTED = 'Rejected'
+
+    def __str__(self):
+        return self.value
+
+    def __format__(self, spec):
+        return self.value.__format__(spec)
+
+
+# Stored codes. Never renumber: they are what the database holds.
+APPOINTMENT_CODES = {
+    AppointmentStatus.CLIENT_DETAILS: 0,
+    AppointmentStatus.PENDING: 1,
+    AppointmentStatus.ACCEPTED: 2,
+    AppointmentStatus.ARRIVED: 3,
+    AppointmentStatus.COMPLETED: 4,
+    AppointmentStatus.CANCELLED: 5,
+    AppointmentStatus.REJECTED: 6,
+    AppointmentStatus.REPORTED: 7,
+}
+
+CHANGE_REQUEST_CODES = {
+    ChangeRequestStatus.PENDING: 1,
+    ChangeRequestStatus.APPROVED: 2,
+    ChangeRequestStatus.REJECTED: 3,
+}
+
+# Allowed moves; anything else is refused by the handlers with 409.
+TRANSITIONS = {
+    AppointmentStatus.CLIENT_DETAILS: {AppointmentStatus.PENDING, AppointmentStatus.CANCELLED},
+    AppointmentStatus.PENDING: {AppointmentStatus.ACCEPTED, AppointmentStatus.REJECTED,
+                                AppointmentStatus.CANCELLED, AppointmentStatus.REPORTED},
+    AppointmentStatus.ACCEPTED: {AppointmentStatus.ARRIVED, AppointmentStatus.REJECTED,
+                                 AppointmentStatus.CANCELLED, AppointmentStatus.REPORTED},
+    AppointmentStatus.ARRIVED: {AppointmentStatus.COMPLETED, AppointmentStatus.REPORTED},
+    AppointmentStatus.COMPLETED: {AppointmentStatus.REPORTED},
+    AppointmentStatus.CANCELLED: set(),
+    AppointmentStatus.REJECTED: set(),
+    AppointmentStatus.REPORTED: set(),
+}
+
+# Appointments that can still be moved to another time; once served, refused or closed they keep theirs.
+RESCHEDULABLE_STATUSES = (AppointmentStatus.CLIENT_DETAILS, AppointmentStatus.PENDING, AppointmentStatus.ACCEPTED)
+
+# Appointments in these states hold their time slot.
+ACTIVE_STATUSES = (AppointmentStatus.CLIENT_DETAILS, AppointmentStatus.PENDING, AppointmentStatus.ACCEPTED,
+                   AppointmentStatus.ARRIVED, AppointmentStatus.REPORTED)
+
+
+def can_transition(current, new):
+    return AppointmentStatus(new) in TRANSITIONS[AppointmentStatus(current)]
+
+
+def can_reschedule(status):
+    return AppointmentStatus(status) in RESCHEDULABLE_STATUSES
+
+
+# Integer column holding an enum's code; binds and returns enum members, and accepts plain labels.
+class StatusCode(TypeDecorator):
+    impl = Integer
+    cache_ok = True
+
+    def __init__(self, enum, codes):
+        super().__init__()
+        self.enum = enum
+        self.codes = tuple(codes.items())  # Hashable, as it is part of the statement cache key
+        self._to_code = dict(codes)
+        self._to_member = {code: member for member, code in codes.items()}
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else self._to_code[self.enum(value)]
+
+    def process_literal_param(self, value, dialect):
+        return str(self.process_bind_param(value, dialect))
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else self._to_member[int(value)]
+
+
+ACTIVE_CODES = sorted(APPOINTMENT_CODES[status] for status in ACTIVE_STATUSES)
+
+# SQL the partial indexes are defined with. Queries must repeat the same condition with literal codes for
+# SQLite to use the index, so they build it with is_active() / is_pending() rather than a bound IN list.
+ACTIVE_APPOINTMENT_SQL = f"status IN ({', '.join(str(code) for code in ACTIVE_CODES)})"
+PENDING_CHANGE_REQUEST_SQL = f'status = {CHANGE_REQUEST_CODES[ChangeRequestStatus.PENDING]}'
+
+
+def is_active(column):
+    return column.in_([literal_column(str(code)) for code in ACTIVE_CODES])
+
+
+def is_pending(column):
+    return column == literal_column(str(CHANGE_REQUEST_CODES[ChangeRequestStatus.PENDING]))
+
+
+# Converts status columns created as text to integer codes; runs at startup and does nothing once done.
+# - SQLite cannot change a column's type, so each table is rebuilt: renamed aside, recreated from the model
+#   (with its indexes), refilled with the labels mapped to codes, and the old copy dropped. Other tables keep
+#   referring to it by name, so legacy_alter_table stops the rename from rewriting their foreign keys.
+# - Unknown labels abort the upgrade rather than guess a status.
+def upgrade_status_columns(db, tables):
+    for table, codes in tables:
+        columns = {column['name']: column for column in inspect(db.engine).get_columns(table.name)}
+        if isinstance(columns['status']['type'], Integer):
+            continue
+
+        with db.engine.begin() as conn:
+            labels = set(conn.execute(text(f"SELECT DISTINCT status FROM {table.name}")).scalars())
+            known = {member.value: code for member, code in codes.items()}
+            unknown = labels - set(known)
+            if unknown:
+                raise RuntimeError(f"Unknown {table.name}.status values {sorted(unknown)}; map them before upgrading")
+
+            legacy = f'{table.name}_legacy'
+            conn.execute(text("DROP VIEW IF EXISTS appointment_history"))
+            conn.execute(text("PRAGMA legacy_alter_table = ON"))
+            conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {legacy}"))
+            conn.execute(text("PRAGMA legacy_alter_table = OFF"))
+            for index in conn.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL"
+            ), {'table': legacy}).scalars().all():
+                conn.execute(text(f"DROP INDEX {index}"))
+            table.create(conn)
+
+            names = ', '.join(name for name in columns if name in table.c and name != 'status')
+            mapping = ' '.join(f"WHEN '{label}' THEN {code}" for label, code in known.items())
+            conn.execute(text(
+                f"INSERT INTO {table.name} ({names}, status) "
+                f"SELECT {names}, CASE status {mapping} END FROM {legacy}"
+            ))
+            conn.execute(text(f"DROP TABLE {legacy}"))
+        logger.info("Converted %s.status to integer codes", table.name)
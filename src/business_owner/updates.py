@@ -0,0 +1,104 @@
+import json
+import logging
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import event, func
+
+from official_website import app, db
+from realtime import emit_to_owner
+from .models import OwnerUpdate
+from .events import record_appointment_event
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+logger = logging.getLogger(__name__)
+
+PENDING_KEY = 'pending_owner_updates'
+
+
+# Records a small delta describing a change to an appointment.
+# - The row is added to the current transaction, so it is committed (or rolled back) with the change itself.
+# - Once the transaction commits, the delta is pushed to the owner's Socket.IO room as 'appointment_update'.
+# - `changes` holds only the fields that changed, e.g. date=..., cancellation_reason=...
+# - The change is also appended to the permanent appointment_event log, which keeps the read models current.
+def record_appointment_update(appointment, event_name, **changes):
+    record_appointment_event(appointment, event_name, changes)
+    update = OwnerUpdate(
+        owner_id=appointment.owner_id,
+        appointment_id=appointment.id,
+        event=event_name,
+        status=appointment.status,
+        changes=json.dumps(changes, default=str) if changes else None
+    )
+    db.session.add(update)
+    return update
+
+
+# Formats appointment datetimes the same way the dashboard payload does.
+def format_time(value):
+    return value.astimezone(MOSCOW_TZ).strftime('%Y-%m-%d %H:%M') if value else None
+
+
+# Returns the deltas an owner missed since `since`, oldest first.
+# - `reset` is set when older deltas were already pruned, telling the client to reload the full dashboard.
+#   It is also set when `since` is ahead of the owner's latest version: the owner's updates were renumbered
+#   by a move to another shard (see sharding.py).
+def updates_since(owner_id, since, limit):
+    oldest = db.session.query(func.min(OwnerUpdate.id)).scalar()
+    latest = latest_version(owner_id)
+    if (oldest is not None and since < oldest - 1) or since > latest:
+        return {'reset': True, 'version': latest, 'updates': [], 'has_more': False}
+
+    updates = OwnerUpdate.query.filter(
+        OwnerUpdate.owner_id == owner_id,
+        OwnerUpdate.id > since
+    ).order_by(OwnerUpdate.id).limit(limit + 1).all()
+
+    return {
+        'reset': False,
+        'version': latest,
+        'updates': [u.to_dict() for u in updates[:limit]],
+        'has_more': len(updates) > limit
+    }
+
+
+def latest_version(owner_id):
+    return db.session.query(func.max(OwnerUpdate.id)).filter(OwnerUpdate.owner_id == owner_id).scalar() or 0
+
+
+# Deletes deltas older than OWNER_UPDATE_RETENTION_DAYS; runs from the background scheduler.
+def prune_owner_updates():
+    with app.app_context():
+        try:
+            cutoff = datetime.now(MOSCOW_TZ) - timedelta(days=app.config['OWNER_UPDATE_RETENTION_DAYS'])
+            deleted = OwnerUpdate.query.filter(OwnerUpdate.created_at < cutoff).delete(synchronize_session=False)
+            db.session.commit()
+            if deleted:
+                logger.info("Pruned %s owner updates older than %s", deleted, cutoff)
+        except Exception as e:
+            logger.error("Error pruning owner updates: %s", e)
+            db.session.rollback()
+
+
+# Ids are only known after the flush, and the session cannot run SQL once committed,
+# so deltas are serialized after each flush and emitted after the commit.
+@event.listens_for(db.session, 'after_flush')
+def _collect_owner_updates(session, flush_context):
+    for obj in session.new:
+        if isinstance(obj, OwnerUpdate):
+            session.info.setdefault(PENDING_KEY, []).append((obj.owner_id, obj.to_dict()))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _emit_owner_updates(session):
+    for owner_id, payload in session.info.pop(PENDING_KEY, []):
+        try:
+            emit_to_owner(owner_id, 'appointment_update', payload)
+        except Exception as e:
+            logger.error("Failed to push update %s to owner %s: %s", payload['version'], owner_id, e)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_owner_updates(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)
@@ -0,0 +1,3 @@
+from official_website import app, db  # Import app and db from the official_website module
+
+from client import models, routes
@@ -0,0 +1,2 @@
+# The client table is shared with the shop endpoints, which create clients when they take bookings.
+from business_owner.models import Client, ClientLoginCode, Appointment
@@ -0,0 +1,303 @@
+import base64
+import json
+import logging
+import secrets
+from datetime import datetime, timedelta
+from functools import wraps
+
+import pytz
+from flask import request, jsonify, session
+from sqlalchemy import select, tuple_
+
+from official_website import app, db
+from invalidation import DependencyCache
+from read_routing import read_only
+from session_store import regenerate_session
+from business_owner.models import BusinessOwner, RequestChange, ClientHistoryEntry
+from business_owner.updates import record_appointment_update, format_time
+from business_owner.clients import normalize_phone, get_client_id
+from business_owner.hours import get_calendar
+from business_owner.status import AppointmentStatus
+from business_owner.line_items import snapshot_line_items, load_line_items, line_total, total_cost, total_duration, \
+    UNKNOWN_SERVICE
+from .models import Appointment, ClientLoginCode
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+logger = logging.getLogger(__name__)
+
+# Bookings a client may still cancel or ask to change.
+OPEN_STATUSES = (AppointmentStatus.PENDING, AppointmentStatus.ACCEPTED)
+
+# History pages and upcoming lists by client, dropped on any committed change to one of the client's appointments.
+client_cache = DependencyCache('clients', app.config['CLIENT_CACHE_SIZE'], app.config['CLIENT_CACHE_TTL'])
+
+
+def client_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'client_id' not in session:
+            return jsonify({'message': 'Unauthorized'}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+# Sends a login code to the client's phone.
+# - The code is stored in client_login_code and valid for CLIENT_OTP_TTL; requesting a new one replaces it.
+#   Booking OTPs in the OTP table are left alone, so logging in never breaks the shop's arrival check.
+@app.route('/api/client/login/request_otp', methods=['POST'])
+def client_request_otp():
+    data = request.get_json() or {}
+    phone_number = normalize_phone(data.get('phone_number'))
+    if not phone_number:
+        return jsonify({'message': 'A valid phone number is required'}), 400
+
+    otp_code = f'{secrets.randbelow(900000) + 100000}'
+    ClientLoginCode.query.filter_by(phone_number=phone_number).delete()
+    db.session.add(ClientLoginCode(phone_number=phone_number, code=otp_code))
+    db.session.commit()
+
+    # Simulate sending OTP to the client's phone number
+    logger.info("Sending login code SMS to %s", phone_number)
+    return jsonify({'message': f'OTP sent to {phone_number}'}), 200
+
+
+# Verifies the login code and starts a client session.
+# - The session holds the client id; a number that never booked gets a client row so it can book later.
+@app.route('/api/client/login/verify', methods=['POST'])
+def client_verify_otp():
+    data = request.get_json() or {}
+    phone_number = normalize_phone(data.get('phone_number'))
+    otp_code = str(data.get('otp_code') or '').strip()
+    if not phone_number or not otp_code:
+        return jsonify({'message': 'Phone number and OTP are required'}), 400
+
+    stored_otp = ClientLoginCode.query.filter_by(phone_number=phone_number) \
+        .order_by(ClientLoginCode.created_at.desc()).first()
+    if not stored_otp or datetime.utcnow() - stored_otp.created_at > app.config['CLIENT_OTP_TTL']:
+        return jsonify({'message': 'OTP expired or not found'}), 400
+    if not secrets.compare_digest(stored_otp.code, otp_code):
+        logger.warning("Client login OTP verification failed for %s", phone_number)
+        return jsonify({'message': 'Invalid OTP'}), 400
+
+    ClientLoginCode.query.filter_by(phone_number=phone_number).delete()
+    client_id = get_client_id(phone_number, create=True)
+    db.session.commit()
+
+    regenerate_session(session)
+    session['client_id'] = client_id
+    session['verified_phone_number'] = phone_number
+    logger.info("Client %s logged in", client_id)
+    return jsonify({'message': 'Login successful', 'phone_number': phone_number}), 200
+
+
+@app.route('/api/client/logout', methods=['POST'])
+def client_logout():
+    client_id = session.pop('client_id', None)
+    session.pop('verified_phone_number', None)
+    if client_id:
+        logger.info("Client %s logged out", client_id)
+    return jsonify({'message': 'Logout successful'}), 200
+
+
+# Opaque keyset cursor: the (date, id) of the last appointment on a page.
+def encode_cursor(date, appointment_id):
+    return base64.urlsafe_b64encode(f'{date.isoformat()}|{appointment_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    date, appointment_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(date), int(appointment_id)
+
+
+# Username and company name of the shops of `rows`, by owner id; one IN query.
+# Shops are read apart from the appointments, which may live in another database (see sharding.py).
+def load_shops(rows):
+    owner_ids = {row.owner_id for row in rows}
+    if not owner_ids:
+        return {}
+    shops = db.session.query(BusinessOwner.id, BusinessOwner.username, BusinessOwner.company_name) \
+        .filter(BusinessOwner.id.in_(owner_ids))
+    return {shop.id: {'username': shop.username, 'company_name': shop.company_name} for shop in shops}
+
+
+# Serializes appointments with their shop and line items.
+# - Prices and durations come from the snapshots taken at booking time, so no service is loaded.
+def serialize_appointments(rows):
+    shops = load_shops(rows)
+    result = []
+    for appointment in rows:
+        services_details = [{
+            'service_id': item['id'],
+            'name': item['title'] or UNKNOWN_SERVICE,
+            'quantity': item['quantity'],
+            'cost': line_total(item),
+            'duration': item['duration']
+        } for item in load_line_items(appointment.service)]
+
+        result.append({
+            'id': appointment.id,
+            'shop': shops.get(appointment.owner_id),
+            'date': appointment.date.strftime('%Y-%m-%d %H:%M') if appointment.date else None,
+            'end_time': appointment.end_time.strftime('%Y-%m-%d %H:%M') if appointment.end_time else None,
+            'status': appointment.status,
+            'services': services_details,
+            'total': appointment.total_cost,
+            'cancellation_reason': appointment.cancellation_reason,
+            'rejection_reason': appointment.rejection_reason if appointment.status == AppointmentStatus.REJECTED else None
+        })
+    return result
+
+
+# History reads the client_history_entry projection of the event log, which keeps archived appointments;
+# pages are seeks on its (client_id, date, appointment_id) index.
+# With shards every database returns its own next page; the newest of those rows make the page.
+def load_history_page(client_id, cursor, limit):
+    history = ClientHistoryEntry.__table__.c
+    query = select(
+        *[column.label('id') if column is history.appointment_id else column for column in history]
+    ).where(history.client_id == client_id, history.date.isnot(None))
+    if cursor:
+        query = query.where(tuple_(history.date, history.appointment_id) < cursor)
+    rows = db.session.execute(query.order_by(history.date.desc(), history.appointment_id.desc()).limit(limit + 1)).all()
+    rows = sorted(rows, key=lambda row: (row.date, row.id), reverse=True)[:limit + 1]
+
+    page = rows[:limit]
+    next_cursor = encode_cursor(page[-1].date, page[-1].id) if len(rows) > limit else None
+    return {'appointments': serialize_appointments(page), 'next_cursor': next_cursor}
+
+
+# Upcoming bookings are open, so they are always in the hot table.
+def load_upcoming(client_id):
+    now = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
+    table = Appointment.__table__
+    rows = db.session.execute(select(table).where(
+        table.c.client_id == client_id, table.c.date >= now, table.c.status.in_(OPEN_STATUSES)
+    ).order_by(table.c.date, table.c.id)).all()
+    return serialize_appointments(sorted(rows, key=lambda row: (row.date, row.id)))
+
+
+# Returns the client's appointments across all shops, newest first.
+# - Keyset pagination: pass the returned `next_cursor` as `cursor` to get the next page; pages are index seeks
+#   and cost the same however deep the client goes.
+@app.route('/api/client/appointments', methods=['GET'])
+@client_login_required
+@read_only
+def client_appointments():
+    client_id = session['client_id']
+    page_size = app.config['CLIENT_HISTORY_PAGE_SIZE']
+    limit = request.args.get('limit', page_size, type=int)
+    if limit < 1:
+        return jsonify({'message': 'limit must be positive'}), 400
+    limit = min(limit, page_size)
+
+    raw_cursor = request.args.get('cursor')
+    try:
+        cursor = decode_cursor(raw_cursor) if raw_cursor else None
+    except (ValueError, UnicodeDecodeError):
+        return jsonify({'message': 'Invalid cursor'}), 400
+
+    page = client_cache.get(
+        ('history', client_id, raw_cursor, limit),
+        lambda: load_history_page(client_id, cursor, limit),
+        [f'client:{client_id}:appointments']
+    )
+    return jsonify(page), 200
+
+
+# Returns the client's pending and accepted appointments that have not started yet, soonest first.
+@app.route('/api/client/appointments/upcoming', methods=['GET'])
+@client_login_required
+@read_only
+def client_upcoming_appointments():
+    client_id = session['client_id']
+    appointments = client_cache.get(
+        ('upcoming', client_id),
+        lambda: load_upcoming(client_id),
+        [f'client:{client_id}:appointments']
+    )
+    return jsonify({'appointments': appointments}), 200
+
+
+# Loads one of the session client's open, future appointments.
+# - Returns (appointment, None) or (None, error response).
+def open_client_appointment(appointment_id):
+    appointment = Appointment.query.filter_by(id=appointment_id, client_id=session['client_id']).first()
+    if not appointment:
+        return None, (jsonify({'message': 'Appointment not found'}), 404)
+    if appointment.status not in OPEN_STATUSES or appointment.date < datetime.now(MOSCOW_TZ).replace(tzinfo=None):
+        return None, (jsonify({'message': f'Appointment is {appointment.status.lower()} and can no longer be changed'}), 409)
+    return appointment, None
+
+
+# Cancels one of the client's appointments; the verified session stands in for the cancellation OTP.
+@app.route('/api/client/appointments/<int:appointment_id>/cancel', methods=['POST'])
+@client_login_required
+def client_cancel_appointment(appointment_id):
+    data = request.get_json(silent=True) or {}
+    appointment, error = open_client_appointment(appointment_id)
+    if error:
+        return error
+
+    appointment.status = AppointmentStatus.CANCELLED
+    appointment.cancellation_reason = data.get('cancellation_reason')
+    record_appointment_update(appointment, 'cancelled', cancellation_reason=appointment.cancellation_reason)
+    db.session.commit()
+
+    logger.info("Appointment %s cancelled by client %s", appointment_id, session['client_id'])
+    return jsonify({'message': 'Appointment cancelled successfully.'}), 200
+
+
+# Asks the shop to move an appointment and/or change its services; the owner accepts or rejects the request.
+# - Expects 'date' ('YYYY-MM-DD HH:MM') and 'services' ([{'id', 'quantity'}], the shop's own services).
+@app.route('/api/client/appointments/<int:appointment_id>/change', methods=['POST'])
+@client_login_required
+def client_request_change(appointment_id):
+    data = request.get_json() or {}
+    requested_date_str = data.get('date')
+    requested_services = data.get('services')
+    if not requested_date_str or not requested_services:
+        return jsonify({'message': 'Requested date and services are required'}), 400
+
+    appointment, error = open_client_appointment(appointment_id)
+    if error:
+        return error
+
+    owner = db.session.get(BusinessOwner, appointment.owner_id)
+    try:
+        requested_date = MOSCOW_TZ.localize(datetime.strptime(requested_date_str, '%Y-%m-%d %H:%M'))
+        line_items = snapshot_line_items(requested_services, owner.user_id)
+    except (ValueError, TypeError):
+        return jsonify({'message': 'Invalid date or service information'}), 400
+    if line_items is None:
+        return jsonify({'message': 'One or more services not found'}), 404
+
+    total_service_time = total_duration(line_items)
+    requested_end_time = requested_date + timedelta(minutes=total_service_time)
+    if not get_calendar(owner.user_id).covers(requested_date, requested_end_time):
+        return jsonify({'message': 'The shop is closed at the requested time'}), 409
+
+    change_request = RequestChange(
+        appointment_id=appointment.id,
+        client_name=appointment.client_name,
+        phone_number=session['verified_phone_number'],
+        client_email=appointment.client_email,
+        requested_date=requested_date,
+        requested_end_time=requested_end_time,
+        requested_service=json.dumps(line_items),
+        requested_total_service_time=total_service_time,
+        requested_num_services=len(line_items),
+        requested_total_cost=total_cost(line_items)
+    )
+    db.session.add(change_request)
+    db.session.flush()
+    record_appointment_update(appointment, 'change_requested',
+                              request_change_id=change_request.id,
+                              requested_date=format_time(requested_date),
+                              requested_end_time=format_time(requested_end_time),
+                              requested_service=line_items,
+                              requested_total_service_time=total_service_time,
+                              requested_total_cost=change_request.requested_total_cost)
+    db.session.commit()
+
+    return jsonify({'message': 'Request change submitted successfully', 'request_change_id': change_request.id}), 200
@@ -1,12 +1,94 @@
 from dotenv import load_dotenv
 import os
+from datetime import timedelta
 
 load_dotenv()
 
 class Config:
     basedir = os.path.abspath(os.path.dirname(__file__))
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'mps.db')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI') or 'sqlite:///' + os.path.join(basedir, 'mps.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     DEBUG = True
-    SQLALCHEMY_ECHO = True
-    SECRET_KEY = os.environ.get('SECRET_KEY') or 'a_super_secret_key'
\ No newline at end of file
+    SQLALCHEMY_ECHO = os.environ.get('SQLALCHEMY_ECHO', '0') == '1'
+    SECRET_KEY = os.environ.get('SECRET_KEY') or 'a_super_secret_key'
+
+    # On-demand request profiling (see profiling.py). Disabled hooks are never registered.
+    PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '0') == '1'
+    PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', '0'))  # Percent of requests profiled at random
+    PROFILING_SAMPLE_INTERVAL = float(os.environ.get('PROFILING_SAMPLE_INTERVAL', '0.005'))  # Seconds between stack samples
+    PROFILING_MAX_PROFILES = int(os.environ.get('PROFILING_MAX_PROFILES', '200'))
+    PROFILING_DIR = os.environ.get('PROFILING_DIR') or os.path.join(basedir, 'profiles')
+
+    # Logging pipeline (see logging_setup.py). LOG_LEVELS takes "module=LEVEL" pairs separated by commas.
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_LEVELS = os.environ.get('LOG_LEVELS', 'sqlalchemy.engine=WARNING,werkzeug=INFO')
+    LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', '0.1'))  # Fraction of DEBUG records kept
+    LOG_FILE = os.environ.get('LOG_FILE')  # JSON lines are written to stderr when unset
+
+    # Shared Socket.IO server (see realtime.py). SOCKETIO_MESSAGE_QUEUE enables cross-process fan-out,
+    # e.g. redis://localhost:6379/0, or local://<channel> for the in-process stand-in.
+    SOCKETIO_CORS_ORIGINS = ["http://localhost:3002", "http://192.168.64.1:3002"]
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+
+    OWNER_UPDATE_RETENTION_DAYS = int(os.environ.get('OWNER_UPDATE_RETENTION_DAYS', '7'))  # Dashboard catch-up window
+
+    # Server-side sessions (see session_store.py): 'sqlite', 'redis' or 'cookie' for Flask's signed cookie.
+    SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'sqlite')
+    SESSION_REDIS_URL = os.environ.get('SESSION_REDIS_URL', 'redis://localhost:6379/0')
+    PERMANENT_SESSION_LIFETIME = timedelta(days=1)
+    SESSION_ACTIVITY_WRITE_INTERVAL = timedelta(seconds=int(os.environ.get('SESSION_ACTIVITY_WRITE_INTERVAL', '300')))
+
+    # React production build served by static_assets.py; run `flask ingest-static` after each build.
+    STATIC_BUILD_DIR = os.environ.get('STATIC_BUILD_DIR') or os.path.normpath(os.path.join(basedir, '..', 'frontend', 'build'))
+    STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # Seconds hashed assets may be cached
+
+    # Cache invalidation (see invalidation.py). Set INVALIDATION_BUS_URL, e.g. redis://localhost:6379/0,
+    # to invalidate caches in every worker process, not just the one that committed the change.
+    INVALIDATION_BUS_URL = os.environ.get('INVALIDATION_BUS_URL')
+    INVALIDATION_BUS_CHANNEL = os.environ.get('INVALIDATION_BUS_CHANNEL', 'mps-invalidations')
+
+    # Username -> owner lookup cache for the public shop endpoints (see business_owner/owner_cache.py).
+    OWNER_CACHE_SIZE = int(os.environ.get('OWNER_CACHE_SIZE', '1024'))
+    OWNER_CACHE_TTL = int(os.environ.get('OWNER_CACHE_TTL', '300'))  # Seconds
+
+    # Serialized /api/shop/<username>/data responses (see business_owner/catalog.py).
+    CATALOG_CACHE_SIZE = int(os.environ.get('CATALOG_CACHE_SIZE', '512'))  # Serialized shop catalogs kept per process
+
+    CALENDAR_CACHE_SIZE = int(os.environ.get('CALENDAR_CACHE_SIZE', '1024'))  # Compiled working-hours calendars kept per process
+
+    # Country code assumed for client phone numbers entered without one (see business_owner/clients.py).
+    CLIENT_PHONE_DEFAULT_COUNTRY = os.environ.get('CLIENT_PHONE_DEFAULT_COUNTRY', '7')  # Russia; '8XXXXXXXXXX' is read as '+7XXXXXXXXXX'
+
+    # Partner onboarding through /api/register/batch (see official_website/routes.py).
+    REGISTRATION_BATCH_SIZE = int(os.environ.get('REGISTRATION_BATCH_SIZE', '200'))  # Registrations written per transaction
+
+    # Owner batch actions through /api/business_owner/reservations/batch (see business_owner/routes.py).
+    RESERVATION_BATCH_LIMIT = int(os.environ.get('RESERVATION_BATCH_LIMIT', '100'))  # Reservation IDs accepted per request
+
+    # Client portal (see client/routes.py).
+    CLIENT_OTP_TTL = timedelta(minutes=5)  # How long a login code stays valid
+    CLIENT_HISTORY_PAGE_SIZE = 20  # Default and maximum appointments per history page
+    CLIENT_CACHE_SIZE = int(os.environ.get('CLIENT_CACHE_SIZE', '2048'))  # History pages and upcoming lists kept per process
+    CLIENT_CACHE_TTL = int(os.environ.get('CLIENT_CACHE_TTL', '300'))  # Seconds; also rolls past bookings out of 'upcoming'
+
+    # Appointment archiving (see business_owner/archive.py).
+    APPOINTMENT_ARCHIVE_AFTER_DAYS = int(os.environ.get('APPOINTMENT_ARCHIVE_AFTER_DAYS', '90'))  # Age at which closed appointments leave the hot table
+    APPOINTMENT_ARCHIVE_BATCH_SIZE = int(os.environ.get('APPOINTMENT_ARCHIVE_BATCH_SIZE', '500'))  # Appointments moved per transaction
+
+    # Earliest bookable start per shop and service (see business_owner/availability.py).
+    NEXT_AVAILABLE_HORIZON_DAYS = int(os.environ.get('NEXT_AVAILABLE_HORIZON_DAYS', '60'))  # How far ahead the next free start is searched
+
+    # Per-shop shard databases (see sharding.py). 0 keeps everything in SQLALCHEMY_DATABASE_URI. Otherwise that
+    # database keeps the global tables and SHARD_COUNT more hold the shops' appointments; run `flask rebalance-shards`
+    # to move existing shops into them.
+    SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '0'))
+    SHARD_DATABASE_URI = os.environ.get('SHARD_DATABASE_URI') or 'sqlite:///' + os.path.join(basedir, 'mps_shard_{shard}.db')
+    SHARD_ID_SLOTS = 1024  # Upper bound on databases sharing an id space; never change once sharded ids exist
+    SHARD_PLACEMENT_CACHE_SIZE = int(os.environ.get('SHARD_PLACEMENT_CACHE_SIZE', '4096'))  # Owner placements kept per process
+
+    # Read-only engines for views marked @read_only (see read_routing.py). SQLite databases are reopened with
+    # mode=ro; SQLALCHEMY_READ_DATABASE_URI sends the main database's reads to a replica instead.
+    READ_ROUTING_ENABLED = os.environ.get('READ_ROUTING_ENABLED', '1') == '1'
+    SQLALCHEMY_READ_DATABASE_URI = os.environ.get('SQLALCHEMY_READ_DATABASE_URI')
+    SQLALCHEMY_READ_POOL_SIZE = int(os.environ.get('SQLALCHEMY_READ_POOL_SIZE', '10'))  # Read-only connections kept per database
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE')  # e.g. 'wal', so readers run alongside the writer; unset keeps the file's mode
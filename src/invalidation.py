@@ -0,0 +1,247 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+from sqlalchemy import event, inspect
+
+logger = logging.getLogger(__name__)
+
+PENDING_KEY = 'pending_invalidations'
+
+# Identifies this process on the bus, so it ignores its own broadcasts.
+PROCESS_ID = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+_key_functions = {}
+_subscribers = []
+_bus = None
+
+
+# Tracks which entity keys change in each transaction and tells caches about them after the commit.
+# - Models declare their keys with @tracks(Model); caches declare the keys their entries depend on.
+# - INVALIDATION_BUS_URL (redis://...) also fans invalidations out to other processes.
+def init_invalidation(app, db):
+    global _bus
+    url = app.config.get('INVALIDATION_BUS_URL')
+    if url:
+        _bus = RedisBus(url, app.config.get('INVALIDATION_BUS_CHANNEL', 'mps-invalidations'))
+        _bus.start(_dispatch)
+
+    event.listen(db.session, 'after_flush', _collect_keys)
+    event.listen(db.session, 'after_commit', _publish_pending)
+    event.listen(db.session, 'after_soft_rollback', _discard_pending)
+
+
+# Registers the function returning the entity keys a changed instance of `model` affects, e.g.
+#   @tracks(Appointment)
+#   def appointment_keys(appointment):
+#       return [f'owner:{appointment.owner_id}:appointments']
+def tracks(model):
+    def decorator(fn):
+        _key_functions.setdefault(model, []).append(fn)
+        return fn
+    return decorator
+
+
+# Returns the current value of an attribute together with the value it had before this transaction,
+# so key functions can invalidate both the old and the new owner, username, date, ...
+def current_and_previous(obj, attribute):
+    history = inspect(obj).attrs[attribute].history
+    values = {getattr(obj, attribute), *history.deleted}
+    values.discard(None)
+    return values
+
+
+# Queues keys to invalidate once the session's transaction commits. Only needed for bulk UPDATE/DELETE
+# statements, which bypass the flush events the keys are normally collected from.
+def invalidate_on_commit(session, keys):
+    session.info.setdefault(PENDING_KEY, set()).update(keys)
+
+
+def subscribe(callback):
+    _subscribers.append(callback)
+
+
+# Invalidates `keys` in this process and, unless `broadcast` is off, in every process on the bus.
+def publish(keys, broadcast=True):
+    keys = set(keys)
+    if not keys:
+        return
+    _dispatch(keys)
+    if broadcast and _bus:
+        try:
+            _bus.publish(keys)
+        except Exception as e:
+            logger.error("Failed to broadcast invalidations: %s", e)
+
+
+def _dispatch(keys):
+    for callback in _subscribers:
+        try:
+            callback(keys)
+        except Exception as e:
+            logger.error("Invalidation subscriber %s failed: %s", callback, e)
+
+
+# Keys are computed after the flush, when new rows have their ids and attribute history is still available.
+def _collect_keys(session, flush_context):
+    pending = session.info.setdefault(PENDING_KEY, set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        for fn in _key_functions.get(type(obj), ()):
+            pending.update(key for key in fn(obj) if key)
+
+
+def _publish_pending(session):
+    keys = session.info.pop(PENDING_KEY, None)
+    if keys:
+        logger.debug("Invalidating %s", sorted(keys))
+        publish(keys)
+
+
+def _discard_pending(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)
+
+
+# Process-local LRU cache whose entries are dropped when an entity key they depend on is invalidated.
+# - `depends_on` is a list of keys, or a function of the computed value returning them.
+# - Invalidations are numbered; a value computed while one of its keys was invalidated is returned
+#   but not stored, so a fill racing with a commit never caches the stale row.
+# - Invalidation numbers are only kept while a computation that started before them is still running,
+#   so the bookkeeping stays as small as the work in flight.
+class DependencyCache:
+    registry = {}
+
+    def __init__(self, name, maxsize, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._dependents = {}
+        self._sequence = 0
+        self._invalidated_at = OrderedDict()
+        self._in_flight = Counter()
+        self._lock = threading.Lock()
+        DependencyCache.registry[name] = self
+        subscribe(self.invalidate)
+
+    def get(self, key, compute, depends_on):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and (entry[1] is None or entry[1] > now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            started = self._sequence
+            self._in_flight[started] += 1
+
+        try:
+            value = compute()
+            dependencies = set(depends_on(value) if callable(depends_on) else depends_on)
+        except BaseException:
+            with self._lock:
+                self._finish(started)
+            raise
+
+        with self._lock:
+            stale = any(self._invalidated_at.get(dep, 0) > started for dep in dependencies)
+            self._finish(started)
+            if stale:
+                return value
+            self._remove(key)
+            self._entries[key] = (value, now + self.ttl if self.ttl else None, dependencies)
+            for dep in dependencies:
+                self._dependents.setdefault(dep, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+        return value
+
+    def invalidate(self, keys):
+        with self._lock:
+            self._sequence += 1
+            for dep in keys:
+                self._mark_invalidated(dep)
+                for key in self._dependents.pop(dep, ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._sequence += 1
+            for dep in self._dependents:
+                self._mark_invalidated(dep)
+            self._entries.clear()
+            self._dependents.clear()
+
+    def _mark_invalidated(self, dep):
+        if self._in_flight:
+            self._invalidated_at.pop(dep, None)
+            self._invalidated_at[dep] = self._sequence
+
+    # Ends a computation started at `started` and forgets the invalidations no running computation can see.
+    def _finish(self, started):
+        self._in_flight[started] -= 1
+        if not self._in_flight[started]:
+            del self._in_flight[started]
+        oldest = min(self._in_flight, default=self._sequence)
+        while self._invalidated_at:
+            dep, sequence = next(iter(self._invalidated_at.items()))
+            if sequence > oldest:
+                break
+            del self._invalidated_at[dep]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            for dep in entry[2]:
+                dependents = self._dependents.get(dep)
+                if dependents:
+                    dependents.discard(key)
+                    if not dependents:
+                        del self._dependents[dep]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+# Cross-process invalidation over Redis pub/sub.
+class RedisBus:
+    def __init__(self, url, channel):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+
+    def start(self, handler):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+
+        def listen():
+            for message in pubsub.listen():
+                _handle_message(message['data'], handler)
+
+        threading.Thread(target=listen, name='invalidation-bus', daemon=True).start()
+
+    def publish(self, keys):
+        self.client.publish(self.channel, json.dumps({'origin': PROCESS_ID, 'keys': sorted(keys)}))
+
+
+def _handle_message(data, handler):
+    try:
+        message = json.loads(data)
+        if message['origin'] != PROCESS_ID:
+            handler(set(message['keys']))
+    except Exception as e:
+        logger.error("Invalid invalidation message %r: %s", data, e)
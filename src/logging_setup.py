@@ -0,0 +1,119 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+from datetime import datetime, timezone
+
+# Keys whose values never reach the log output, whether they appear in a logged dict or as "key=value".
+SECRET_KEYS = ('password', 'otp', 'otp_code', 'secret', 'token', 'secret_key')
+
+_SECRET_KEY_PREFIX = r"(?i)(['\"]?\b(?:" + '|'.join(SECRET_KEYS) + r")\b['\"]?\s*[:=]\s*)"
+_QUOTED_VALUE_PATTERN = re.compile(_SECRET_KEY_PREFIX + r"(['\"]).*?\2")
+_BARE_VALUE_PATTERN = re.compile(_SECRET_KEY_PREFIX + r"(?!['\"])[^,}\s]+")
+# Free-text messages such as "Generated OTP for +79990001122: 123456" or "Your OTP is 4821".
+_OTP_TEXT_PATTERN = re.compile(r"(?i)(\botp\b.*?)(?<![\d+])\d{4,6}(?!\d)")
+
+_listener = None
+
+
+# Configures process-wide logging once.
+# - Every logger feeds a single QueueHandler, so request threads only enqueue records.
+# - A QueueListener thread redacts secrets, renders JSON lines and writes them to LOG_FILE (or stderr).
+# - LOG_LEVELS sets per-module levels and DEBUG records are sampled at LOG_DEBUG_SAMPLE_RATE.
+# Calling it again is a no-op, so both app modules can rely on it.
+def configure_logging(app):
+    global _listener
+    if _listener is not None:
+        return
+
+    if app.config.get('LOG_FILE'):
+        output = logging.handlers.WatchedFileHandler(app.config['LOG_FILE'])
+    else:
+        output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter())
+    output.addFilter(RedactingFilter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(DebugSamplingFilter(app.config.get('LOG_DEBUG_SAMPLE_RATE', 1.0)))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(app.config.get('LOG_LEVEL', 'INFO'))
+
+    for name, level in parse_log_levels(app.config.get('LOG_LEVELS', '')).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+# Parses "business_owner.routes=DEBUG,sqlalchemy.engine=WARNING" into {'business_owner.routes': 'DEBUG', ...}.
+def parse_log_levels(spec):
+    levels = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        name, level = item.split('=', 1)
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def redact(text):
+    text = _QUOTED_VALUE_PATTERN.sub(r"\1\2***\2", text)
+    text = _BARE_VALUE_PATTERN.sub(r"\1***", text)
+    return _OTP_TEXT_PATTERN.sub(r"\1***", text)
+
+
+# Enqueues records with as little work as possible on the calling thread.
+# - The message is merged with its args here, because args may be mutated after the call returns.
+# - Redaction and JSON rendering happen later on the listener thread.
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# Keeps only a fraction of DEBUG records; INFO and above always pass.
+class DebugSamplingFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = float(rate)
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+class RedactingFilter(logging.Filter):
+    def filter(self, record):
+        record.msg = redact(str(record.msg))
+        if record.exc_text:
+            record.exc_text = redact(record.exc_text)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.msg,
+            'thread': record.threadName
+        }
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
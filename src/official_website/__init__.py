@@ -2,6 +2,14 @@ import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from threading import Lock
+from logging_setup import configure_logging
+from profiling import init_profiling
+from realtime import init_realtime
+from session_store import init_sessions
+from static_assets import init_static_assets
+from invalidation import init_invalidation
+from sharding import init_sharding, sharding_session_options
+from read_routing import init_read_routing, read_routing_session_options
 
 app = Flask(__name__)
 app.config.from_object('config.Config')
@@ -9,7 +17,16 @@ app.config.from_object('config.Config')
 
 app.secret_key = os.urandom(24)
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options=read_routing_session_options(sharding_session_options(app)))
+
+configure_logging(app)
+init_profiling(app)
+init_static_assets(app)
+init_realtime(app)
+init_sessions(app, db)
+init_invalidation(app, db)
+init_sharding(app, db)
+init_read_routing(app, db)
 
 db_initialized = False
 db_lock = Lock()
@@ -37,6 +37,19 @@ class WorkingHours(db.Model):
     end_time = db.Column(db.Time, nullable=False)  # End time of working hours
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)  # Reference to the user
 
+# Model representing a date-specific exception to the weekly working hours (holiday, shortened day, one-off closure).
+# - All rows of a date together replace that date's weekly hours: a row with `closed` set closes the day,
+#   otherwise each row is one open window.
+class WorkingHoursOverride(db.Model):
+    __tablename__ = 'working_hours_override'
+    id = db.Column(db.Integer, primary_key=True)  # Unique ID for each override entry
+    date = db.Column(db.Date, nullable=False)  # Date the override applies to
+    closed = db.Column(db.Boolean, default=False, nullable=False)  # Whether the business is closed all day
+    start_time = db.Column(db.Time, nullable=True)  # Start of an open window (unused when closed)
+    end_time = db.Column(db.Time, nullable=True)  # End of an open window (unused when closed)
+    note = db.Column(db.String(200), nullable=True)  # Optional reason shown to the owner (e.g., 'Public holiday')
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)  # Reference to the user
+
 # Model representing an admin user for the system.
 class Admin(db.Model):
     id = db.Column(db.Integer, primary_key=True)  # Unique ID for each admin
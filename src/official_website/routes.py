@@ -10,19 +10,28 @@ import json
 import pytz
 import qrcode
 from apscheduler.schedulers.background import BackgroundScheduler
-from flask import request, jsonify, session, redirect, url_for
-from sqlalchemy import func
+from flask import request, jsonify, session, redirect, url_for, Response
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import check_password_hash, generate_password_hash
 import os
-from business_owner.models import BusinessOwner, BusinessOwnerLog, Appointment, Feedback
-from run import socketio
+from business_owner.models import BusinessOwner, BusinessOwnerLog, Feedback
+from business_owner.catalog import catalog_cache
+from business_owner.search import refresh_stale_next_available
+from business_owner.updates import prune_owner_updates
+from business_owner.archive import appointment_history, run_appointment_archiver
+from business_owner.line_items import load_line_items, line_total, UNKNOWN_SERVICE
+from profiling import list_profiles, load_profile, set_sample_rate
+from invalidation import DependencyCache
+from realtime import emit_to_admins
+from singleflight import flights
+from session_store import purge_expired_sessions, regenerate_session
+from read_routing import read_only
 from . import app, db
 from .models import User, Admin, AdminLog, AcceptedRegistration, RejectedRegistration, AdminLoginEvent, \
     AdminLogoutEvent, DeletedApprovedAccount, ContactMessage
 from .models import Service, WorkingHours
-from flask_socketio import SocketIO
-socketio = SocketIO(app)
-logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
@@ -38,15 +47,15 @@ def login_required(f):
     def decorated_function(*args, **kwargs):
 
         if 'admin_id' not in session:
-            logging.debug("Admin ID not in session, redirecting to login.")
+            logger.debug("Admin ID not in session, redirecting to login.")
             return redirect(url_for('admin_login', next=request.url))
 
         expires_at = session.get('expires_at')
         if not expires_at or datetime.now(MOSCOW_TZ) > datetime.fromisoformat(expires_at):
-            logging.debug("Session expired or invalid, redirecting to login.")
+            logger.debug("Session expired or invalid, redirecting to login.")
             return redirect(url_for('admin_login', next=request.url))
 
-        logging.debug("Session valid, proceeding with request.")
+        logger.debug("Session valid, proceeding with request.")
         return f(*args, **kwargs)
 
     return decorated_function
@@ -57,9 +66,12 @@ def login_required(f):
 # - For client reports: It fetches client details such as name, email, phone, complaint, and company name.
 # - For owner reports: It fetches business owner details along with complaints made by clients about services, including the cost breakdown of services.
 # The response includes two lists: one for client reports and another for owner reports.
+# Complaints and appointments are read first and their shops after, by id: with sharding on they live in
+# different databases, and the complaint queries run against every shard.
 # If the time filter is invalid, it returns a 400 status code with an error message.
 @app.route('/api/reports', methods=['GET'])
 @login_required
+@read_only
 def get_reports():
     time_filter = request.args.get('time_filter', 'daily')
     now = datetime.now(MOSCOW_TZ)
@@ -81,69 +93,67 @@ def get_reports():
         Feedback.client_email.label('clientEmail'),
         Feedback.client_phone.label('clientPhone'),
         Feedback.complaint.label('complaint'),
-        BusinessOwner.company_name.label('companyName')
-    ).join(BusinessOwner).filter(
+        Feedback.owner_id
+    ).filter(
         Feedback.created_at >= start_date
     ).all()
 
+    app.logger.debug("Fetching owner reports from the appointment history (hot and archived appointments).")
+
+    history = appointment_history.c
+    owner_reports = db.session.query(
+        history.owner_id,
+        history.client_name.label('complainedClient'),
+        history.phone_number.label('clientPhone'),
+        history.service.label('services'),
+        history.total_cost.label('totalCost'),
+        history.date.label('serviceTime'),
+        history.report_details.label('complaint')
+    ).select_from(appointment_history).filter(
+        history.report_details.isnot(None)
+    ).all()
+
+    owner_ids = {report.owner_id for report in client_reports + owner_reports}
+    owners = {owner.id: owner for owner in BusinessOwner.query.filter(BusinessOwner.id.in_(owner_ids))} \
+        if owner_ids else {}
+
     client_reports_list = [{
         'clientName': report.clientName,
         'clientEmail': report.clientEmail,
         'clientPhone': report.clientPhone,
-        'companyName': report.companyName,
+        'companyName': owners[report.owner_id].company_name,
         'complaint': report.complaint
-    } for report in client_reports]
+    } for report in client_reports if report.owner_id in owners]
 
-    app.logger.debug("Fetching owner reports from the Appointment table.")
-
-
-    owner_reports = db.session.query(
-        BusinessOwner.personal_name.label('ownerName'),
-        BusinessOwner.company_name.label('companyName'),
-        BusinessOwner.email.label('ownerEmail'),
-        BusinessOwner.phone_number.label('ownerPhone'),
-        Appointment.client_name.label('complainedClient'),
-        Appointment.phone_number.label('clientPhone'),
-        Appointment.service.label('services'),
-        Appointment.date.label('serviceTime'),
-        Appointment.report_details.label('complaint')
-    ).join(BusinessOwner, Appointment.owner_id == BusinessOwner.id).filter(
-        Appointment.report_details.isnot(None)
-    ).all()
+    owner_reports = [report for report in owner_reports if report.owner_id in owners]
 
 
 
     if not owner_reports:
         app.logger.debug("No owner reports found.")
     else:
-        app.logger.debug(f"Found {len(owner_reports)} owner reports.")
+        app.logger.debug("Found %s owner reports.", len(owner_reports))
 
     owner_reports_list = []
 
     for report in owner_reports:
-        services = json.loads(report.services)
-        service_details = []
-        total_cost = 0
-
-        for service in services:
-            service_obj = Service.query.get(service['id'])
-            if service_obj:
-                quantity = service.get('quantity', 1)
-                cost = service_obj.cost * quantity
-                total_cost += cost
-                service_details.append(f"{service_obj.title} x {quantity} (${cost})")
+        service_details = [
+            f"{item['title'] or UNKNOWN_SERVICE} x {item['quantity']} (${line_total(item)})"
+            for item in load_line_items(report.services)
+        ]
 
+        owner = owners[report.owner_id]
         owner_reports_list.append({
-            'ownerName': report.ownerName,
-            'companyName': report.companyName,
-            'ownerEmail': report.ownerEmail,
-            'ownerPhone': report.ownerPhone,
+            'ownerName': owner.personal_name,
+            'companyName': owner.company_name,
+            'ownerEmail': owner.email,
+            'ownerPhone': owner.phone_number,
             'clientPhone': report.clientPhone,
             'complainedClient': report.complainedClient,
             'services': ', '.join(service_details),
             'serviceTime': report.serviceTime,
             'complaint': report.complaint,
-            'totalCost': total_cost
+            'totalCost': report.totalCost
         })
 
     return jsonify({
@@ -152,29 +162,6 @@ def get_reports():
     })
 
 
-#Failed attempt
-@socketio.on('connect')
-def handle_connect():
-    print("Client connected")
-
-
-@socketio.on('disconnect')
-def handle_disconnect():
-    print("Client disconnected")
-
-
-@socketio.on('my_event')
-def handle_my_event(data):
-    print(f"Received data: {data}")
-    socketio.emit('response', {'data': 'Message received'})
-
-
-
-@socketio.on('simple_message')
-def handle_simple_message(message):
-    print(f"Received simple message: {message}")
-    socketio.send(f"Echo: {message}")
-
 # Deletes unverified users whose OTPs have expired.
 # This function operates within the Flask app context and checks for users with 'Pending' status and an expired OTP.
 # It retrieves unverified users in batches (default of 100 users per batch), deletes them from the database, and logs the operation.
@@ -183,13 +170,13 @@ def delete_unverified_users():
     """Delete unverified users whose OTP has expired."""
     with app.app_context():
         try:
-            logging.info("Starting deletion of unverified users.")
+            logger.info("Starting deletion of unverified users.")
             current_time = datetime.now(MOSCOW_TZ)
 
             unverified_users = User.query.filter(User.status == 'Pending', User.otp_expiry < current_time).all()
 
             if not unverified_users:
-                logging.info("No unverified users to delete.")
+                logger.info("No unverified users to delete.")
                 return
 
             batch_size = 100
@@ -200,20 +187,24 @@ def delete_unverified_users():
                     for user in batch:
                         db.session.delete(user)
                     db.session.commit()
-                    logging.info(f"Deleted batch of {len(batch)} unverified users.")
+                    logger.info("Deleted batch of %s unverified users.", len(batch))
                 except Exception as batch_error:
-                    logging.error(f"Error deleting batch of unverified users: {batch_error}")
+                    logger.error("Error deleting batch of unverified users: %s", batch_error)
                     db.session.rollback()
 
-            logging.info(f"Deleted a total of {len(unverified_users)} unverified users.")
+            logger.info("Deleted a total of %s unverified users.", len(unverified_users))
         except Exception as e:
-            logging.error(f"Error deleting unverified users: {e}")
+            logger.error("Error deleting unverified users: %s", e)
             db.session.rollback()
 
 
 
 scheduler = BackgroundScheduler()
 scheduler.add_job(delete_unverified_users, 'interval', minutes=1)
+scheduler.add_job(prune_owner_updates, 'interval', hours=1)
+scheduler.add_job(purge_expired_sessions, 'interval', hours=1, args=[app])
+scheduler.add_job(refresh_stale_next_available, 'interval', minutes=15)
+scheduler.add_job(run_appointment_archiver, 'interval', hours=1)
 scheduler.start()
 
 
@@ -256,46 +247,6 @@ def generate_random_password(length=12):
 
     return ''.join(password)
 
-#Failed to try websocket
-@socketio.on('connect')
-def handle_connect():
-    print('Client connected')
-    socketio.emit('my_response', {'data': 'Connected'})
-
-
-@socketio.on('disconnect')
-def handle_disconnect():
-    print('Client disconnected')
-
-
-@socketio.on('my_event')
-def handle_my_event(json):
-    print('Received my_event: ' + str(json))
-    socketio.emit('my_response', {'data': 'Message received'})
-
-
-@socketio.on('my_event')
-def handle_my_event(data):
-    print('Received my_event:', data)
-    socketio.emit('my_response', {'data': 'Message received'})
-
-
-@socketio.on('connect')
-def test_connect():
-    print('Client connected')
-    socketio.emit('my_response', {'data': 'Connected'})
-
-
-@socketio.on('my_event')
-def handle_my_event(data):
-    print('Received my_event:', data)
-    socketio.emit('my_response', {'data': 'Message received'})
-
-
-@socketio.on('disconnect')
-def test_disconnect():
-    print('Client disconnected')
-
 # Sends a confirmation email to the business owner after their registration has been approved.
 # The email contains account details such as the company name, username, password, and a QR code link.
 # The content is formatted as HTML and includes a link to the QR code.
@@ -331,10 +282,10 @@ def send_confirmation_email(email, company_name, username, password, qr_code_lin
         msg.attach(MIMEText(email_content, 'html'))
 
 
-        logging.info(f"Sending email to {receiver_email} with content: {email_content}")
+        logger.debug("Prepared approval email for %s", receiver_email)
 
 
-        logging.info(f"Simulating sending email to {receiver_email}")
+        logger.info("Simulating sending email to %s", receiver_email)
 
         # Uncomment and configure the SMTP settings to actually send the email
         # with smtplib.SMTP('smtp.example.com', 587) as server:
@@ -342,12 +293,12 @@ def send_confirmation_email(email, company_name, username, password, qr_code_lin
         #     server.login("your-email@example.com", "your-password")  # Replace with your login details
         #     server.sendmail(sender_email, receiver_email, msg.as_string())
 
-        logging.info(f"Email successfully sent to {receiver_email}")
+        logger.info("Email successfully sent to %s", receiver_email)
 
     except smtplib.SMTPException as e:
-        logging.error(f"Failed to send email to {receiver_email} due to SMTP error: {e}")
+        logger.error("Failed to send email to %s due to SMTP error: %s", receiver_email, e)
     except Exception as e:
-        logging.error(f"Failed to send email to {receiver_email} due to unexpected error: {e}")
+        logger.error("Failed to send email to %s due to unexpected error: %s", receiver_email, e)
 
 # Initializes the database before handling any request. If the database tables don't exist, they are created,
 # and a log message is recorded indicating successful initialization. In case of failure, the error is logged.
@@ -356,9 +307,9 @@ def send_confirmation_email(email, company_name, username, password, qr_code_lin
 def initialize_database():
     try:
         db.create_all()
-        logging.info("Database initialized successfully.")
+        logger.debug("Database initialized successfully.")
     except Exception as e:
-        logging.exception("Failed to initialize the database.")
+        logger.exception("Failed to initialize the database.")
 
 
 @app.route('/')
@@ -377,150 +328,239 @@ def contact():
 
 
 
+REGISTRATION_FIELDS = ['personalName', 'companyName', 'storeAddress', 'phoneNumber', 'email', 'services', 'workingHours']
+SERVICE_FIELDS = ['title', 'cost', 'description', 'service_time']
+
+
+# Checks a registration payload and turns it into the rows to insert, before anything is written.
+# Raises ValueError with the message for the client when a field is missing or malformed.
+# - With `applyToAll`, the `sameHours` times are parsed once and used for every selected day.
+def parse_registration(data):
+    if not isinstance(data, dict):
+        raise ValueError('Registration must be a JSON object.')
+    for field in REGISTRATION_FIELDS:
+        if field not in data:
+            raise ValueError(f'Missing field: {field}')
+
+    if not isinstance(data['services'], list) or not all(isinstance(item, dict) for item in data['services']):
+        raise ValueError('Invalid services.')
+    services = []
+    for index, service_data in enumerate(data['services']):
+        missing = [field for field in SERVICE_FIELDS if field not in service_data]
+        if missing:
+            raise ValueError(f"Missing field in service {index + 1}: {missing[0]}")
+        try:
+            cost = float(service_data['cost'])
+            service_time = int(service_data['service_time'])
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid cost or service time in service {index + 1}")
+        services.append({'title': service_data['title'], 'cost': cost,
+                         'description': service_data['description'], 'service_time': service_time})
+
+    working_hours = data['workingHours']
+    days = working_hours.get('days') if isinstance(working_hours, dict) else None
+    if not isinstance(days, dict) or not all(isinstance(hours, dict) for hours in days.values()):
+        raise ValueError('Invalid working hours.')
+    selected = [(day, hours) for day, hours in days.items() if hours.get('selected')]
+    shared = None
+    if working_hours.get('applyToAll', False) and selected:
+        shared = _parse_hours('all days', working_hours.get('sameHours'))
+    hours_rows = []
+    for day, hours in selected:
+        start_time, end_time = shared or _parse_hours(day, hours)
+        hours_rows.append({'day': day, 'start_time': start_time, 'end_time': end_time})
+
+    return {
+        'user': {
+            'personal_name': data['personalName'],
+            'company_name': data['companyName'],
+            'store_address': data['storeAddress'],
+            'phone_number': data['phoneNumber'],
+            'email': data['email'],
+            'status': 'Unverified'
+        },
+        'services': services,
+        'working_hours': hours_rows,
+        'data': data
+    }
+
+
+def _parse_hours(day, hours):
+    try:
+        return datetime.strptime(hours['start'], '%H:%M').time(), datetime.strptime(hours['end'], '%H:%M').time()
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f'Invalid time format for {day}: {hours}')
+
+
+# Writes parsed registrations in the current transaction: one multi-row INSERT for the users, one for all
+# their services and one for all their working hours (Core inserts; the sharded session has no ORM bulk insert). Each user gets a fresh OTP valid for 5 minutes.
+# Returns the new user IDs in the order of `registrations`; the caller commits.
+def write_registrations(registrations):
+    now = datetime.now(MOSCOW_TZ)
+    user_rows = []
+    for registration in registrations:
+        registration['user'].update(otp=generate_otp(), otp_expiry=now + timedelta(minutes=5), otp_attempts=0,
+                                    created_at=datetime.now())
+        user_rows.append(registration['user'])
+
+    users = User.__table__
+    user_ids = db.session.scalars(insert(users).returning(users.c.id, sort_by_parameter_order=True), user_rows).all()
+
+    service_rows = []
+    hours_rows = []
+    for user_id, registration in zip(user_ids, registrations):
+        registration['user_id'] = user_id
+        service_rows.extend(dict(row, user_id=user_id) for row in registration['services'])
+        hours_rows.extend(dict(row, user_id=user_id) for row in registration['working_hours'])
+    if service_rows:
+        db.session.execute(insert(Service.__table__), service_rows)
+    if hours_rows:
+        db.session.execute(insert(WorkingHours.__table__), hours_rows)
+    return user_ids
+
+
+# Tells the admins about a registration written by write_registrations().
+def announce_registration(registration):
+    user = registration['user']
+    data = registration['data']
+    logger.debug("OTP stored in database for user: %s", user['email'])
+    emit_to_admins('new_registration', {
+        'user_id': registration['user_id'],
+        'personalName': user['personal_name'],
+        'companyName': user['company_name'],
+        'storeAddress': user['store_address'],
+        'phoneNumber': user['phone_number'],
+        'email': user['email'],
+        'services': data['services'],
+        'workingHours': data['workingHours'].get('days', {}),
+        'status': user['status'],
+        'comments': '',
+        'created_at': user['created_at'].isoformat()
+    })
+    emit_registration_status_update(registration['user_id'], 'Pending')
+
+
 # Handles the submission of the registration form, including personal and company details, services, and working hours.
-# The endpoint validates required fields, checks for an existing email, and saves the new user along with their services
-# and working hours into the database. If all validations pass, it generates an OTP, stores it in the database,
-# and emits a WebSocket event notifying clients of the new registration. Finally, it returns a success message with
-# instructions for OTP verification.
+# The endpoint validates the whole payload and checks for an existing email before writing anything, then saves the
+# new user, their services and working hours and their OTP in one transaction. Once committed, it emits a WebSocket
+# event notifying clients of the new registration and returns a success message with instructions for OTP verification.
 @app.route('/api/register', methods=['POST'])
 def register():
     try:
         data = request.get_json()
-        logging.debug(f"Received registration data: {data}")
-
 
-        required_fields = ['personalName', 'companyName', 'storeAddress', 'phoneNumber', 'email', 'services', 'workingHours']
-        for field in required_fields:
-            if field not in data:
-                logging.error(f"Missing field in registration data: {field}")
-                return jsonify({'message': f'Missing field: {field}'}), 400
+        try:
+            registration = parse_registration(data)
+        except ValueError as e:
+            logger.error("Invalid registration data: %s", e)
+            return jsonify({'message': str(e)}), 400
 
         existing_user = User.query.filter_by(email=data['email']).first()
         if existing_user:
-            logging.debug(f"Email already exists: {data['email']}")
+            logger.debug("Email already exists: %s", data['email'])
             return jsonify({'message': 'Email already exists.'}), 400
 
-
-        user = User(
-            personal_name=data['personalName'],
-            company_name=data['companyName'],
-            store_address=data['storeAddress'],
-            phone_number=data['phoneNumber'],
-            email=data['email'],
-            status='Unverified'
-        )
-        db.session.add(user)
+        user_id, = write_registrations([registration])
         db.session.commit()
-        if not user.id:
-            logging.error("User ID not set after commit. Registration failed.")
-            return jsonify({'message': 'An error occurred during registration.'}), 500
-
-        logging.debug(f"User created with ID: {user.id}")
-
-
-        for service_data in data['services']:
-            service = Service(
-                title=service_data['title'],
-                cost=service_data['cost'],
-                description=service_data['description'],
-                service_time=service_data['service_time'],
-                user_id=user.id
-            )
-            db.session.add(service)
-
-
-        apply_to_all = data['workingHours'].get('applyToAll', False)
-
-        if apply_to_all:
-
-            same_hours = data['workingHours']['sameHours']
-            for day, hours in data['workingHours']['days'].items():
-                if hours['selected']:
-                    try:
-                        working_hour = WorkingHours(
-                            day=day,
-                            start_time=datetime.strptime(same_hours['start'], '%H:%M').time(),
-                            end_time=datetime.strptime(same_hours['end'], '%H:%M').time(),
-                            user_id=user.id
-                        )
-                        db.session.add(working_hour)
-                    except ValueError as ve:
-                        logging.error(f"Invalid time format for {day}: {same_hours}")
-                        return jsonify({'message': f'Invalid time format for {day}: {same_hours}'}), 400
-        else:
+        logger.debug("User created with ID: %s", user_id)
 
-            for day, hours in data['workingHours']['days'].items():
-                if hours['selected']:
-                    try:
-                        working_hour = WorkingHours(
-                            day=day,
-                            start_time=datetime.strptime(hours['start'], '%H:%M').time(),
-                            end_time=datetime.strptime(hours['end'], '%H:%M').time(),
-                            user_id=user.id
-                        )
-                        db.session.add(working_hour)
-                    except ValueError as ve:
-                        logging.error(f"Invalid time format for {day}: {hours}")
-                        return jsonify({'message': f'Invalid time format for {day}: {hours}'}), 400
+        announce_registration(registration)
 
-        db.session.commit()
-
-
-        otp = generate_otp()
-        otp_expiry = datetime.now(MOSCOW_TZ) + timedelta(minutes=5)
+        return jsonify({'message': 'OTP has been sent to your phone. Please verify to complete the registration.',
+                        'user_id': user_id}), 201
 
+    except Exception as e:
+        db.session.rollback()
+        logger.exception("An error occurred during registration")
+        return jsonify({'message': 'An error occurred. Please try again.', 'error': str(e)}), 500
 
-        logging.debug(f"Generated OTP for {data['phoneNumber']}: {otp}")
 
+# Bulk registration for partner onboarding: the request body is NDJSON, one /api/register payload per line.
+# - Lines are parsed and validated as they are read; valid ones are written REGISTRATION_BATCH_SIZE at a time,
+#   each chunk in one transaction after a single IN query for emails already taken.
+# - If a chunk still hits a constraint (an email registered meanwhile), its rows are retried one by one in
+#   savepoints, so only the offending rows fail.
+# Responds with one result per non-empty line, in line order: 'created' with the user ID, or 'error' with the message.
+@app.route('/api/register/batch', methods=['POST'])
+@login_required
+def register_batch():
+    batch_size = app.config['REGISTRATION_BATCH_SIZE']
+    results = []
+    chunk = []
+    for number, line in enumerate(request.stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            chunk.append((number, parse_registration(json.loads(line))))
+        except ValueError as e:
+            results.append({'line': number, 'status': 'error', 'message': str(e)})
+            continue
+        if len(chunk) >= batch_size:
+            results.extend(_register_chunk(chunk))
+            chunk = []
+    if chunk:
+        results.extend(_register_chunk(chunk))
+
+    results.sort(key=lambda result: result['line'])
+    created = sum(result['status'] == 'created' for result in results)
+    logger.info("Batch registration: %s created, %s failed", created, len(results) - created)
+    return jsonify({'created': created, 'failed': len(results) - created, 'results': results}), 200
+
+
+def _register_chunk(chunk):
+    emails = {registration['user']['email'] for _, registration in chunk}
+    taken = set(db.session.scalars(select(User.email).where(User.email.in_(emails))))
+
+    results = []
+    accepted = []
+    for number, registration in chunk:
+        email = registration['user']['email']
+        if email in taken:
+            results.append({'line': number, 'status': 'error', 'message': 'Email already exists.'})
+            continue
+        taken.add(email)
+        accepted.append((number, registration))
+    if not accepted:
+        return results
 
-        user.otp = otp
-        user.otp_expiry = otp_expiry
-        user.otp_attempts = 0
+    try:
+        write_registrations([registration for _, registration in accepted])
         db.session.commit()
-
-        logging.debug(f"OTP stored in database: {otp} for user: {user.email}")
-
-
-        socketio.emit('new_registration', {
-            'user_id': user.id,
-            'personalName': user.personal_name,
-            'companyName': user.company_name,
-            'storeAddress': user.store_address,
-            'phoneNumber': user.phone_number,
-            'email': user.email,
-            'services': data['services'],
-            'workingHours': data['workingHours']['days'],
-            'status': user.status,
-            'comments': '',
-            'created_at': user.created_at.isoformat()
-        })
-
-
-        emit_registration_status_update(user.id, 'Pending')
-
-        return jsonify({'message': 'OTP has been sent to your phone. Please verify to complete the registration.',
-                        'user_id': user.id}), 201
-
-    except Exception as e:
+        written = accepted
+    except IntegrityError:
         db.session.rollback()
-        logging.exception("An error occurred during registration")
-        return jsonify({'message': 'An error occurred. Please try again.', 'error': str(e)}), 500
+        written = []
+        for number, registration in accepted:
+            try:
+                with db.session.begin_nested():
+                    write_registrations([registration])
+                written.append((number, registration))
+            except IntegrityError as e:
+                results.append({'line': number, 'status': 'error', 'message': 'Email already exists.'})
+                logger.debug("Batch registration line %s failed: %s", number, e.orig)
+        db.session.commit()
+
+    for number, registration in written:
+        announce_registration(registration)
+        results.append({'line': number, 'status': 'created', 'user_id': registration['user_id']})
+    return results
 
 # Emits a WebSocket event to notify clients about the status update of a registration.
 # The event name is dynamically generated based on the registration status, and it sends
-# the `user_id` and the current `status` to connected clients.
+# the `user_id` and the current `status` to the admins' room.
 def emit_registration_status_update(user_id, status):
-    socketio.emit(f'registration_{status.lower()}', {
+    emit_to_admins(f'registration_{status.lower()}', {
         'user_id': user_id,
         'status': status
     })
 
 
-# Manually triggers a WebSocket event ('custom_event') that sends a simple message to connected clients.
+# Manually triggers a WebSocket event ('custom_event') that sends a simple message to connected admins.
 # This route can be used for testing or manually triggering specific actions via WebSockets.
 @app.route('/trigger_event')
 def trigger_event():
-    socketio.emit('custom_event', 'This is a manually triggered event')
+    emit_to_admins('custom_event', 'This is a manually triggered event')
     return "Event triggered!"
 
 # Verifies the OTP provided by the user during registration. If the OTP matches and hasn't expired, the user's status
@@ -538,10 +578,10 @@ def verify_otp():
             user.otp_expiry = None
             db.session.commit()
 
-            logging.debug(f"OTP verified successfully for user_id={user.id}")
+            logger.debug("OTP verified successfully for user_id=%s", user.id)
 
 
-            socketio.emit('registration_updated', {
+            emit_to_admins('registration_updated', {
                 'user_id': user.id,
                 'status': user.status
             })
@@ -551,7 +591,7 @@ def verify_otp():
             return jsonify({'message': 'Invalid OTP'}), 400
 
     except Exception as e:
-        logging.exception("An error occurred during OTP verification")
+        logger.exception("An error occurred during OTP verification")
         return jsonify({'message': 'An error occurred. Please try again.', 'error': str(e)}), 500
 
 # Resends a new OTP to the user during the OTP verification process if needed, updating the expiry time and OTP status.
@@ -563,7 +603,7 @@ def resend_otp():
 
         user = User.query.get(user_id)
         if not user:
-            logging.debug(f"User not found: user_id={user_id}")
+            logger.debug("User not found: user_id=%s", user_id)
             return jsonify({'message': 'User not found'}), 404
 
         user.otp = generate_otp()
@@ -572,16 +612,14 @@ def resend_otp():
         user.otp_hold_until = None
         db.session.commit()
 
-        logging.debug(f"Resent OTP for user: {user.phone_number}")
-
-        print(f"OTP for {user.phone_number}: {user.otp}")
+        logger.debug("Resent OTP for user: %s", user.phone_number)
 
         return jsonify({'message': 'OTP resent successfully'}), 200
     except KeyError as e:
-        logging.error(f"Missing required field: {e}")
+        logger.error("Missing required field: %s", e)
         return jsonify({'message': 'Invalid request data. User ID is required.'}), 400
     except Exception as e:
-        logging.exception("An error occurred during OTP resend")
+        logger.exception("An error occurred during OTP resend")
         return jsonify({'message': 'An error occurred. Please try again.', 'error': str(e)}), 500
 
 # handle the admin login functionality.
@@ -592,10 +630,11 @@ def resend_otp():
 def admin_login():
     try:
         data = request.get_json()
-        logging.debug(f"Admin login attempt with data: {data}")
+        logger.debug("Admin login attempt for username: %s", (data or {}).get('username'))
 
         admin = Admin.query.filter_by(username=data['username']).first()
         if admin and check_password_hash(admin.password, data['password']):
+            regenerate_session(session)
             session['admin_id'] = admin.id
             session['expires_at'] = (datetime.now(MOSCOW_TZ) + timedelta(minutes=30)).isoformat()
             session['admin_logged_in'] = True
@@ -604,16 +643,16 @@ def admin_login():
             db.session.add(login_event)
             db.session.commit()
 
-            logging.debug(f"Admin login successful for admin_id: {admin.id}")
+            logger.debug("Admin login successful for admin_id: %s", admin.id)
             return jsonify({'message': 'Login successful'}), 200
 
-        logging.debug("Invalid admin credentials")
+        logger.debug("Invalid admin credentials")
         return jsonify({'message': 'Invalid credentials'}), 401
     except KeyError as e:
-        logging.error(f"Missing required field: {e}")
+        logger.error("Missing required field: %s", e)
         return jsonify({'message': 'Invalid request data. Username and password are required.'}), 400
     except Exception as e:
-        logging.exception("An error occurred during admin login")
+        logger.exception("An error occurred during admin login")
         return jsonify({'message': 'An error occurred. Please try again.', 'error': str(e)}), 500
 
 
@@ -627,15 +666,15 @@ def admin_logout():
             db.session.commit()
             session.pop('admin_id', None)
             session.pop('expires_at', None)
-            logging.debug(f"Admin with ID {logout_event.admin_id} logged out successfully")
+            logger.debug("Admin with ID %s logged out successfully", logout_event.admin_id)
         else:
-            logging.debug("No admin_id found in session")
+            logger.debug("No admin_id found in session")
 
         response = jsonify({'message': 'Logout successful'})
         response.set_cookie('session', '', expires=0)
         return response, 200
     except Exception as e:
-        logging.exception("An error occurred during admin logout")
+        logger.exception("An error occurred during admin logout")
         return jsonify({'message': 'An error occurred. Please try again.', 'error': str(e)}), 500
 
 # Fetches registration data for a specific status
@@ -643,8 +682,9 @@ def admin_logout():
 # It is used to populate the registration table.
 @app.route('/api/admin/dashboard', methods=['GET'])
 @login_required
+@read_only
 def admin_dashboard():
-    logging.debug("Accessing admin dashboard")
+    logger.debug("Accessing admin dashboard")
 
     status = request.args.get('status', None)
     sort_by = request.args.get('sort_by', 'newest')
@@ -654,7 +694,7 @@ def admin_dashboard():
 
 
     if status:
-        logging.debug(f"Filtering with status={status}")
+        logger.debug("Filtering with status=%s", status)
         query = query.filter_by(status=status)
 
 
@@ -670,19 +710,19 @@ def admin_dashboard():
         elif time_filter == 'year':
             start_date = now - timedelta(days=365)
         if start_date:
-            logging.debug(f"Filtering by start date: {start_date}")
+            logger.debug("Filtering by start date: %s", start_date)
             query = query.filter(User.created_at >= start_date)
 
     if sort_by == 'newest':
-        logging.debug("Applying sort by newest")
+        logger.debug("Applying sort by newest")
         query = query.order_by(User.created_at.desc())
     elif sort_by == 'oldest':
-        logging.debug("Applying sort by oldest")
+        logger.debug("Applying sort by oldest")
         query = query.order_by(User.created_at.asc())
 
     try:
         users = query.all()
-        logging.debug(f"Users found after filtering: {len(users)}")
+        logger.debug("Users found after filtering: %s", len(users))
 
         registrations = []
         for user in users:
@@ -717,10 +757,10 @@ def admin_dashboard():
                 'created_at': user.created_at.isoformat()
             })
 
-        logging.debug(f"Registrations: {registrations}")
+        logger.debug("Registrations: %s", registrations)
         return jsonify(registrations), 200
     except Exception as e:
-        logging.exception("An error occurred while accessing the admin dashboard")
+        logger.exception("An error occurred while accessing the admin dashboard")
         return jsonify({'message': 'An error occurred. Please try again.', 'error': str(e)}), 500
 
 # Handles the display of the admin reports page.
@@ -728,7 +768,7 @@ def admin_dashboard():
 @app.route('/admin/reports')
 @login_required
 def reports():
-    logging.debug("Accessing admin reports")
+    logger.debug("Accessing admin reports")
     return "Reports Page Content"
 
 def get_filtered_working_hours(user_id, time_filter):
@@ -755,7 +795,7 @@ def get_filtered_working_hours(user_id, time_filter):
     working_hours = WorkingHours.query.filter_by(user_id=user_id).all()
 
 
-    logging.debug(f"Original working hours for user_id {user_id}: {working_hours}")
+    logger.debug("Original working hours for user_id %s: %s", user_id, working_hours)
 
 
     if time_filter == 'all':
@@ -780,7 +820,7 @@ def get_filtered_working_hours(user_id, time_filter):
         for i in range(365):  # Include last 365 days
             days_to_include.add((now - timedelta(days=i)).strftime('%A'))
 
-    logging.debug(f"Days to include for time_filter '{time_filter}': {days_to_include}")
+    logger.debug("Days to include for time_filter '%s': %s", time_filter, days_to_include)
 
 
     filtered_working_hours = [
@@ -788,7 +828,7 @@ def get_filtered_working_hours(user_id, time_filter):
         for wh in working_hours if wh.day in days_to_include
     ]
 
-    logging.debug(f"Filtered working hours for user_id {user_id}: {filtered_working_hours}")
+    logger.debug("Filtered working hours for user_id %s: %s", user_id, filtered_working_hours)
 
     return filtered_working_hours
 
@@ -810,7 +850,6 @@ def approve_registration(user_id):
             return redirect(url_for('admin_login'))
 
         data = request.get_json()
-        app.logger.debug(f"Received data for approval: {data}")
         comments = data.get('comments', '')
         email_content = data.get('emailContent', '')
 
@@ -871,7 +910,7 @@ def approve_registration(user_id):
 
                 user.status = 'Approved'
                 db.session.add(user)
-                socketio.emit('registration_approved', {
+                emit_to_admins('registration_approved', {
                     'user_id': user.id,
                     'status': 'Approved'
                 })
@@ -883,23 +922,23 @@ def approve_registration(user_id):
                 db.session.commit()
 
 
-                app.logger.info(f"Approval Email Content:\n{email_content}")
+                app.logger.info('Approval email prepared for %s', user.email)
 
                 # Simulate sending email for now
-                app.logger.info(f"Simulating sending email to {user.email}")
+                app.logger.info("Simulating sending email to %s", user.email)
 
-                app.logger.debug(f"Approved registration for user: {user.email}")
-                app.logger.debug(f"Business owner account created for {user.company_name} with username {username}")
-                app.logger.debug(f"Credentials saved to {all_credentials_file} and QR code saved to {qr_code_filepath}")
+                app.logger.debug("Approved registration for user: %s", user.email)
+                app.logger.debug("Business owner account created for %s with username %s", user.company_name, username)
+                app.logger.debug("Credentials saved to %s and QR code saved to %s", all_credentials_file, qr_code_filepath)
                 return jsonify({'message': 'Registration approved and business owner account created',
                                 'companyName': user.company_name, 'username': username,
                                 'password': password, 'qr_code_link': shop_link}), 200
             except Exception as e:
                 db.session.rollback()
-                app.logger.exception(f"An error occurred during approval: {e}")
+                app.logger.exception("An error occurred during approval: %s", e)
                 return jsonify({'message': 'An error occurred. Please try again.', 'error': str(e)}), 500
         else:
-            app.logger.error(f"User not found for approval: {user_id}")
+            app.logger.error("User not found for approval: %s", user_id)
             return jsonify({'message': 'User not found'}), 404
     except Exception as e:
         app.logger.exception("Unexpected error")
@@ -919,12 +958,10 @@ def reject_registration(user_id):
             return redirect(url_for('admin_login'))
 
         data = request.get_json()
-        app.logger.debug(f"Received data for rejection: {data}")
         comments = data.get('comments', '')
         email_content = data.get('emailContent', '')
 
-        app.logger.debug(f"Parsed comments: {comments}")
-        app.logger.debug(f"Parsed email content: {email_content}")
+        app.logger.debug("Parsed comments: %s", comments)
 
         if not comments or not email_content:
             app.logger.error("Comments and email content are required")
@@ -933,7 +970,7 @@ def reject_registration(user_id):
         user = User.query.get(user_id)
         if user:
             try:
-                app.logger.debug(f"Rejecting registration for user: {user.email}")
+                app.logger.debug("Rejecting registration for user: %s", user.email)
                 user.status = 'Rejected'  # Update status to 'Rejected'
                 rejected_registration = RejectedRegistration(user_id=user.id, comments=comments)
                 log = AdminLog(admin_id=session['admin_id'],
@@ -941,8 +978,8 @@ def reject_registration(user_id):
                 db.session.add(rejected_registration)
                 db.session.add(log)
                 db.session.commit()
-                app.logger.debug(f"Rejected registration for user: {user.email}")
-                socketio.emit('registration_rejected', {
+                app.logger.debug("Rejected registration for user: %s", user.email)
+                emit_to_admins('registration_rejected', {
                     'user_id': user.id,
                     'status': 'Rejected'
                 })
@@ -954,7 +991,7 @@ def reject_registration(user_id):
                 app.logger.exception("An error occurred during rejection")
                 return jsonify({'message': 'An error occurred. Please try again.', 'error': str(e)}), 500
         else:
-            app.logger.error(f"User not found for rejection: {user_id}")
+            app.logger.error("User not found for rejection: %s", user_id)
             return jsonify({'message': 'User not found'}), 404
     except Exception as e:
         app.logger.exception("Unexpected error")
@@ -975,10 +1012,10 @@ def send_rejection_email(email, comments):
         """
 
 
-        app.logger.info(f"Rejection Email Content:\n{email_content}")
+        app.logger.info('Rejection email prepared for %s', user.email)
 
     except Exception as e:
-        app.logger.error(f"Failed to generate email content due to an unexpected error: {e}")
+        app.logger.error("Failed to generate email content due to an unexpected error: %s", e)
 
 # Fetches all admin logs from the database and returns them in JSON format.
 # It first verifies if the admin session is valid by checking the session expiration.
@@ -996,7 +1033,7 @@ def admin_logs():
             logs = AdminLog.query.all()
             log_entries = [{'admin_id': log.admin_id, 'action': log.action, 'timestamp': log.timestamp.isoformat()} for
                            log in logs]
-            app.logger.debug(f"Admin logs: {log_entries}")
+            app.logger.debug("Admin logs: %s", log_entries)
             return jsonify(log_entries), 200
         except Exception as e:
             app.logger.exception("An error occurred while fetching admin logs")
@@ -1005,6 +1042,61 @@ def admin_logs():
         app.logger.exception("Unexpected error")
         return jsonify({'message': 'Internal server error', 'error': str(e)}), 500
 
+# Lists stored request profiles and lets an admin change the random sampling rate.
+# - GET returns the profiles' metadata (request ID, path, mode, duration), newest first.
+# - POST accepts {'sample_rate': <percent>} and applies it to this process.
+# Returns 404 when profiling is disabled in the configuration.
+@app.route('/api/admin/profiles', methods=['GET', 'POST'])
+@login_required
+def admin_profiles():
+    if 'profiling' not in app.extensions:
+        return jsonify({'message': 'Profiling is disabled'}), 404
+
+    if request.method == 'POST':
+        data = request.get_json()
+        try:
+            set_sample_rate(app, float(data.get('sample_rate', 0)))
+        except (TypeError, ValueError) as e:
+            return jsonify({'message': str(e)}), 400
+        log = AdminLog(admin_id=session['admin_id'], action=f"Set profiling sample rate to {data.get('sample_rate')}%")
+        db.session.add(log)
+        db.session.commit()
+
+    return jsonify({
+        'sample_rate': app.extensions['profiling']['sample_rate'],
+        'profiles': list_profiles(app)
+    }), 200
+
+# Downloads a stored request profile by request ID.
+# - `format` may be 'pstats', 'text', 'speedscope' or 'flamegraph' (collapsed stacks); cProfile captures
+#   support the first two and sampled captures the last two.
+@app.route('/api/admin/profiles/<request_id>', methods=['GET'])
+@login_required
+def download_profile(request_id):
+    if 'profiling' not in app.extensions:
+        return jsonify({'message': 'Profiling is disabled'}), 404
+
+    fmt = request.args.get('format', 'pstats')
+    try:
+        profile = load_profile(app, request_id, fmt)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    if not profile:
+        return jsonify({'message': f'No {fmt} profile found for request {request_id}'}), 404
+
+    content, mimetype, filename = profile
+    return Response(content, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# Returns hit/miss counters of this process's in-memory caches.
+@app.route('/api/admin/cache_stats', methods=['GET'])
+@login_required
+def admin_cache_stats():
+    stats = {name: cache.stats() for name, cache in DependencyCache.registry.items()}
+    stats['catalogs'] = catalog_cache.stats()
+    stats['coalesced_requests'] = flights.stats()
+    return jsonify(stats), 200
+
 # Fetches all admin login events from the database and returns them in JSON format.
 # It checks if the admin is authenticated by validating the session.
 # If the session is expired or invalid, the admin is redirected to the login page.
@@ -1021,7 +1113,7 @@ def admin_login_events():
             login_events = AdminLoginEvent.query.all()
             events = [{'admin_id': event.admin_id, 'login_time': event.login_time.isoformat()} for event in
                       login_events]
-            app.logger.debug(f"Admin login events: {events}")
+            app.logger.debug("Admin login events: %s", events)
             return jsonify(events), 200
         except Exception as e:
             app.logger.exception("An error occurred while fetching login events")
@@ -1047,7 +1139,7 @@ def admin_logout_events():
             logout_events = AdminLogoutEvent.query.all()
             events = [{'admin_id': event.admin_id, 'logout_time': event.logout_time.isoformat()} for event in
                       logout_events]
-            app.logger.debug(f"Admin logout events: {events}")
+            app.logger.debug("Admin logout events: %s", events)
             return jsonify(events), 200
         except Exception as e:
             app.logger.exception("An error occurred while fetching logout events")
@@ -1087,7 +1179,7 @@ def admin_statistics():
                 'pending': pending_requests
             }
 
-            app.logger.debug(f"Statistics: {stats}")
+            app.logger.debug("Statistics: %s", stats)
             return jsonify(stats), 200
         except Exception as e:
             app.logger.exception("An error occurred while fetching statistics")
@@ -1126,26 +1218,26 @@ def delete_user(user_id):
                     comments=comments
                 )
                 db.session.add(deleted_account)
-                app.logger.debug(f"Added DeletedApprovedAccount for user: {user.email}")
+                app.logger.debug("Added DeletedApprovedAccount for user: %s", user.email)
 
 
                 log = AdminLog(admin_id=session['admin_id'],
                                action=f'Deleted approved account for {user.email} with comments: {comments}')
                 db.session.add(log)
-                app.logger.debug(f"Added AdminLog entry for deleting user: {user.email}")
+                app.logger.debug("Added AdminLog entry for deleting user: %s", user.email)
 
 
                 user.status = 'Deleted'
                 db.session.commit()
-                app.logger.debug(f"Updated status to Deleted for user: {user.email}")
+                app.logger.debug("Updated status to Deleted for user: %s", user.email)
 
 
                 business_owner = BusinessOwner.query.filter_by(email=user.email).first()
                 if business_owner:
                     db.session.delete(business_owner)
                     db.session.commit()
-                    app.logger.debug(f"Business owner account deleted: {business_owner.username}")
-                    socketio.emit('registration_deleted', {
+                    app.logger.debug("Business owner account deleted: %s", business_owner.username)
+                    emit_to_admins('registration_deleted', {
                         'user_id': user.id,
                         'status': 'Deleted'
                     })
@@ -1159,7 +1251,7 @@ def delete_user(user_id):
                 app.logger.exception("An error occurred during deletion")
                 return jsonify({'message': 'An error occurred. Please try again.', 'error': str(e)}), 500
         else:
-            app.logger.error(f"User not found for deletion: {user_id}")
+            app.logger.error("User not found for deletion: %s", user_id)
             return jsonify({'message': 'User not found'}), 404
     except Exception as e:
         app.logger.exception("Unexpected error")
@@ -1174,13 +1266,13 @@ def check_business_owner_auth():
     try:
         if 'user_id' in session:
             user_id = session.get('user_id')
-            app.logger.info(f"Authentication check passed for user_id: {user_id}")
+            app.logger.info("Authentication check passed for user_id: %s", user_id)
             return jsonify({'authenticated': True}), 200
         else:
             app.logger.warning("Authentication check failed: No user_id in session")
             return jsonify({'authenticated': False}), 401
     except Exception as e:
-        app.logger.error(f"Error during authentication check: {str(e)}")
+        app.logger.error("Error during authentication check: %s", e)
         return jsonify({'authenticated': False, 'error': 'Internal server error'}), 500
 
 # Sends a deletion email to a business owner after their registration is deleted.
@@ -1208,10 +1300,10 @@ def send_delete_email(email, company_name, comments):
 
         msg.attach(MIMEText(email_content, 'html'))
 
-        logging.info(f"Preparing to send email to {receiver_email}")
+        logger.info("Preparing to send email to %s", receiver_email)
 
 
-        logging.info(f"Simulating sending email to {receiver_email} with content: {email_content}")
+        logger.info("Simulating sending email to %s", receiver_email)
 
         # Uncomment and configure the SMTP settings to actually send the email
         # with smtplib.SMTP('smtp.example.com', 587) as server:
@@ -1219,12 +1311,12 @@ def send_delete_email(email, company_name, comments):
         #     server.login("your-email@example.com", "your-password")  # Replace with your login details
         #     server.sendmail(sender_email, receiver_email, msg.as_string())
 
-        logging.info(f"Email successfully sent to {receiver_email}")
+        logger.info("Email successfully sent to %s", receiver_email)
 
     except smtplib.SMTPException as e:
-        logging.error(f"Failed to send email to {receiver_email} due to SMTP error: {e}")
+        logger.error("Failed to send email to %s due to SMTP error: %s", receiver_email, e)
     except Exception as e:
-        logging.error(f"Failed to send email to {receiver_email} due to unexpected error: {e}")
+        logger.error("Failed to send email to %s due to unexpected error: %s", receiver_email, e)
 
 # Verifies the validity of the admin's session by checking the presence of 'admin_id' and 'expires_at' in the session.
 # If either is missing, it returns a response indicating that the session is invalid.
@@ -1248,7 +1340,7 @@ def check_session():
         else:
             return jsonify({'authenticated': False, 'error': 'Session expired'}), 401
     except Exception as e:
-        app.logger.error(f"Error checking session: {str(e)}")
+        app.logger.error("Error checking session: %s", e)
         return jsonify({'authenticated': False, 'error': 'Internal server error'}), 500
 
 
@@ -1285,7 +1377,6 @@ def submit_contact_message():
 def get_contact_messages():
     try:
         contact_messages = ContactMessage.query.order_by(ContactMessage.created_at.desc()).all()
-        print(contact_messages)
         messages = [{
             'id': msg.id,
             'name': msg.name,
@@ -1331,19 +1422,19 @@ def update_responded_status(message_id):
 @app.route('/api/latest_otp/<int:user_id>', methods=['GET'])
 def get_latest_otp(user_id):
     try:
-        logging.debug(f"Received request to get latest OTP for user_id={user_id}")
+        logger.debug("Received request to get latest OTP for user_id=%s", user_id)
 
         user = User.query.get(user_id)
         if not user:
-            logging.warning(f"User not found for user_id={user_id}")
+            logger.warning("User not found for user_id=%s", user_id)
             return jsonify({'message': 'User not found'}), 404
 
         if not user.otp:
-            logging.info(f"No OTP generated for user_id={user_id}")
+            logger.info("No OTP generated for user_id=%s", user_id)
             return jsonify({'message': 'No OTP generated for this user'}), 404
 
-        logging.debug(f"Returning OTP for user_id={user_id}: {user.otp}")
+        logger.debug("Returning OTP for user_id=%s", user_id)
         return jsonify({'otp': user.otp}), 200
     except Exception as e:
-        logging.exception("An error occurred while retrieving the OTP")
+        logger.exception("An error occurred while retrieving the OTP")
         return jsonify({'message': 'An error occurred. Please try again.', 'error': str(e)}), 500
\ No newline at end of file
@@ -0,0 +1,273 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import pytz
+from flask import g, request, session
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Profile'
+REQUEST_ID_HEADER = 'X-Request-ID'
+PROFILE_MODES = ('cprofile', 'sample')
+
+
+# Runs a single request under a profiler when an admin asks for it.
+# - Nothing is registered on the app unless PROFILING_ENABLED is set, so a disabled hook costs nothing per request.
+# - An admin opts a request in with the X-Profile header ('cprofile' or 'sample'), or a sample rate picks requests at random.
+# - Finished profiles are written to PROFILING_DIR keyed by request ID and returned in the X-Request-ID header.
+def init_profiling(app):
+    if not app.config.get('PROFILING_ENABLED'):
+        return
+
+    os.makedirs(app.config['PROFILING_DIR'], exist_ok=True)
+    app.extensions['profiling'] = {'sample_rate': float(app.config.get('PROFILING_SAMPLE_RATE', 0.0))}
+
+    @app.before_request
+    def start_request_profile():
+        mode = _requested_mode(app)
+        if not mode:
+            return None
+
+        g.profile_request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+        g.profile_mode = mode
+        g.profile_started = time.perf_counter()
+        if mode == 'cprofile':
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        else:
+            g.profiler = StackSampler(threading.get_ident(), app.config['PROFILING_SAMPLE_INTERVAL'])
+            g.profiler.start()
+        return None
+
+    @app.after_request
+    def tag_profiled_response(response):
+        if 'profile_request_id' in g:
+            response.headers[REQUEST_ID_HEADER] = g.profile_request_id
+        return response
+
+    @app.teardown_request
+    def finish_request_profile(exc=None):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+
+        elapsed = time.perf_counter() - g.profile_started
+        if g.profile_mode == 'cprofile':
+            profiler.disable()
+        else:
+            profiler.stop()
+
+        try:
+            save_profile(app, g.profile_request_id, g.profile_mode, profiler, elapsed)
+        except Exception as e:
+            logger.error("Failed to store profile %s: %s", g.profile_request_id, e)
+
+
+# Decides whether the current request should be profiled and with which profiler.
+# - The header opt-in is honoured only for a valid admin session.
+# - Sampled requests always use cProfile.
+def _requested_mode(app):
+    mode = request.headers.get(PROFILE_HEADER)
+    if mode:
+        mode = mode.strip().lower()
+        if mode in ('1', 'true'):
+            mode = 'cprofile'
+        if mode in PROFILE_MODES and _admin_session_valid():
+            return mode
+        return None
+
+    sample_rate = app.extensions['profiling']['sample_rate']
+    if sample_rate > 0 and random.random() * 100 < sample_rate:
+        return 'cprofile'
+    return None
+
+
+def _admin_session_valid():
+    expires_at = session.get('expires_at')
+    if 'admin_id' not in session or not expires_at:
+        return False
+    return datetime.now(MOSCOW_TZ) <= datetime.fromisoformat(expires_at)
+
+
+def set_sample_rate(app, sample_rate):
+    if not 0 <= sample_rate <= 100:
+        raise ValueError("Sample rate must be between 0 and 100 percent.")
+    app.extensions['profiling']['sample_rate'] = float(sample_rate)
+
+
+def _profile_path(app, request_id, extension):
+    # Request IDs may come from a client header, so keep only characters that are safe in a file name.
+    safe_id = ''.join(c for c in request_id if c.isalnum() or c in '-_')
+    if not safe_id:
+        raise ValueError("Invalid request ID.")
+    return os.path.join(app.config['PROFILING_DIR'], f"{safe_id}.{extension}")
+
+
+# Writes a finished profile next to a small JSON file describing the request it belongs to.
+def save_profile(app, request_id, mode, profiler, elapsed):
+    meta = {
+        'request_id': request_id,
+        'mode': mode,
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'elapsed': elapsed,
+        'created_at': datetime.now(MOSCOW_TZ).isoformat()
+    }
+
+    if mode == 'cprofile':
+        profiler.dump_stats(_profile_path(app, request_id, 'pstats'))
+    else:
+        with open(_profile_path(app, request_id, 'samples.json'), 'w') as file:
+            json.dump(profiler.to_speedscope(f"{request.method} {request.path}"), file)
+
+    with open(_profile_path(app, request_id, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+    _prune_profiles(app)
+    logger.info("Stored %s profile %s for %s %s (%.3fs)", mode, request_id, request.method, request.path, elapsed)
+
+
+# Keeps only the newest PROFILING_MAX_PROFILES profiles on disk.
+def _prune_profiles(app):
+    directory = app.config['PROFILING_DIR']
+    metas = sorted(
+        (os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.meta.json')),
+        key=os.path.getmtime
+    )
+    for meta_path in metas[:-app.config['PROFILING_MAX_PROFILES']]:
+        prefix = meta_path[:-len('meta.json')]
+        for extension in ('meta.json', 'pstats', 'samples.json'):
+            if os.path.exists(prefix + extension):
+                os.remove(prefix + extension)
+
+
+def list_profiles(app):
+    directory = app.config['PROFILING_DIR']
+    if not os.path.isdir(directory):
+        return []
+
+    profiles = []
+    for name in os.listdir(directory):
+        if name.endswith('.meta.json'):
+            with open(os.path.join(directory, name)) as file:
+                profiles.append(json.load(file))
+    return sorted(profiles, key=lambda p: p['created_at'], reverse=True)
+
+
+# Loads a stored profile in the requested download format.
+# - 'pstats' returns the raw cProfile dump, 'text' a printed summary of it.
+# - 'speedscope' and 'flamegraph' (collapsed stacks) are available for sampled profiles.
+# Returns (bytes, mimetype, filename), or None when no matching profile exists.
+def load_profile(app, request_id, fmt):
+    pstats_path = _profile_path(app, request_id, 'pstats')
+    samples_path = _profile_path(app, request_id, 'samples.json')
+
+    if fmt == 'pstats' and os.path.exists(pstats_path):
+        with open(pstats_path, 'rb') as file:
+            return file.read(), 'application/octet-stream', f"{request_id}.pstats"
+
+    if fmt == 'text' and os.path.exists(pstats_path):
+        stream = io.StringIO()
+        pstats.Stats(pstats_path, stream=stream).sort_stats('cumulative').print_stats(50)
+        return stream.getvalue().encode(), 'text/plain', f"{request_id}.txt"
+
+    if fmt in ('speedscope', 'flamegraph') and os.path.exists(samples_path):
+        with open(samples_path) as file:
+            speedscope = json.load(file)
+        if fmt == 'speedscope':
+            return json.dumps(speedscope).encode(), 'application/json', f"{request_id}.speedscope.json"
+        return collapse_stacks(speedscope).encode(), 'text/plain', f"{request_id}.folded"
+
+    return None
+
+
+# Converts a speedscope sampled profile into Brendan Gregg's collapsed-stack format for flamegraph.pl.
+def collapse_stacks(speedscope):
+    frames = speedscope['shared']['frames']
+    profile = speedscope['profiles'][0]
+    folded = {}
+    for stack, weight in zip(profile['samples'], profile['weights']):
+        key = ';'.join(frames[i]['name'] for i in stack)
+        folded[key] = folded.get(key, 0) + weight
+    return '\n'.join(f"{stack} {int(weight * 1e6)}" for stack, weight in folded.items()) + '\n'
+
+
+# Minimal wall-clock sampling profiler.
+# - A daemon thread reads the request thread's current frame every `interval` seconds.
+# - Identical consecutive stacks are merged, so a long wait costs one sample entry.
+class StackSampler:
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.frames = []
+        self.frame_index = {}
+        self.samples = []
+        self.weights = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._elapsed = time.perf_counter() - self._started
+
+    def _run(self):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self._record(frame, now - last)
+            last = now
+
+    def _record(self, frame, weight):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_name, code.co_filename, code.co_firstlineno)
+            if key not in self.frame_index:
+                self.frame_index[key] = len(self.frames)
+                self.frames.append({'name': code.co_name, 'file': code.co_filename, 'line': code.co_firstlineno})
+            stack.append(self.frame_index[key])
+            frame = frame.f_back
+        stack.reverse()
+
+        if self.samples and self.samples[-1] == stack:
+            self.weights[-1] += weight
+        else:
+            self.samples.append(stack)
+            self.weights.append(weight)
+
+    def to_speedscope(self, name):
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': {'frames': self.frames},
+            'profiles': [{
+                'type': 'sampled',
+                'name': name,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': self._elapsed,
+                'samples': self.samples,
+                'weights': self.weights
+            }],
+            'name': name,
+            'exporter': 'mps-profiling'
+        }
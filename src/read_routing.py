@@ -0,0 +1,101 @@
+import logging
+import threading
+from contextvars import ContextVar
+from functools import wraps
+
+from flask import current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, make_url
+
+logger = logging.getLogger(__name__)
+
+_reading = ContextVar('reading', default=False)
+_read_engines = {}
+_lock = threading.Lock()
+_replicas = {}
+_pool_size = None
+
+
+# Sends the statements of views marked @read_only to read-only engines, so long reports and dashboards do not
+# share connections or transaction state with writes.
+# - Each database (the main one and, with sharding, every shard) gets a read-only twin: for SQLite the same
+#   file opened with mode=ro and PRAGMA query_only, so any write attempted from a read-only view fails.
+# - SQLALCHEMY_READ_DATABASE_URI points the main database's reads at a replica instead.
+# READ_ROUTING_ENABLED = False sends everything to the primary engines; it is read per request.
+def init_read_routing(app, db):
+    global _pool_size
+    _pool_size = app.config['SQLALCHEMY_READ_POOL_SIZE']
+    with app.app_context():
+        if app.config.get('SQLALCHEMY_READ_DATABASE_URI'):
+            _replicas[db.engine] = make_url(app.config['SQLALCHEMY_READ_DATABASE_URI'])
+        if app.config.get('SQLITE_JOURNAL_MODE'):
+            event.listen(db.engine, 'connect', _set_journal_mode(app.config['SQLITE_JOURNAL_MODE']))
+
+
+# Session options for SQLAlchemy(): wraps the session class `options` already chose (sharding's, or
+# Flask-SQLAlchemy's own) so every engine it picks can be swapped for its read-only twin.
+def read_routing_session_options(options):
+    base = options.get('class_', Session)
+    return {**options, 'class_': type(f'ReadRouting{base.__name__}', (ReadRoutingMixin, base), {})}
+
+
+class ReadRoutingMixin:
+    def get_bind(self, *args, **kwargs):
+        engine = super().get_bind(*args, **kwargs)
+        return read_engine_for(engine) if _reading.get() else engine
+
+
+# Marks a view as read-only: its queries run on the read-only engines.
+# - Place it under @app.route and the login decorators, right above the view.
+# - Rows the view loads are still attached to db.session; changing them inside the view fails on flush.
+def read_only(view):
+    @wraps(view)
+    def decorated_function(*args, **kwargs):
+        if not current_app.config['READ_ROUTING_ENABLED']:
+            return view(*args, **kwargs)
+        token = _reading.set(True)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            _reading.reset(token)
+    return decorated_function
+
+
+# The read-only twin of a primary engine, created on first use. Engines that cannot have one (in-memory SQLite)
+# are their own twin.
+def read_engine_for(engine):
+    read_engine = _read_engines.get(engine)
+    if read_engine is None:
+        with _lock:
+            read_engine = _read_engines.get(engine)
+            if read_engine is None:
+                read_engine = _read_engines[engine] = _create_read_engine(engine)
+    return read_engine
+
+
+def _create_read_engine(engine):
+    url = engine.url
+    if engine in _replicas:
+        url = _replicas[engine]
+    elif url.get_backend_name() == 'sqlite':
+        if not url.database or url.database == ':memory:':
+            return engine
+        url = make_url(f'sqlite:///file:{url.database}?mode=ro&uri=true')
+    else:
+        return engine
+
+    read_engine = create_engine(url, pool_size=_pool_size)
+    if url.get_backend_name() == 'sqlite':
+        event.listen(read_engine, 'connect', _query_only)
+    logger.info("Read-only engine for %s: %s", engine.url, url)
+    return read_engine
+
+
+def _query_only(dbapi_connection, connection_record):
+    dbapi_connection.execute('PRAGMA query_only = ON')
+
+
+def _set_journal_mode(mode):
+    def set_journal_mode(dbapi_connection, connection_record):
+        dbapi_connection.execute(f'PRAGMA journal_mode = {mode}')
+    return set_journal_mode
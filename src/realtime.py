@@ -0,0 +1,155 @@
+import logging
+import queue
+import threading
+from datetime import datetime
+
+import pytz
+import socketio as socketio_lib
+from flask import request, session
+from flask_socketio import SocketIO, join_room, leave_room
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+logger = logging.getLogger(__name__)
+
+ADMIN_ROOM = 'admin'
+
+# The one Socket.IO server for the whole application. It is bound to the Flask app by init_realtime(),
+# so every module emits through the same instance and handlers are registered exactly once.
+socketio = SocketIO()
+
+
+def owner_room(owner_id):
+    return f'owner:{owner_id}'
+
+
+def shop_room(username):
+    return f'shop:{username}'
+
+
+def slots_room(username, date):
+    return f'slots:{username}:{date}'
+
+
+# Binds the shared Socket.IO server to the app.
+# - SOCKETIO_MESSAGE_QUEUE fans emits out across worker processes: any URL supported by Flask-SocketIO
+#   (redis://, amqp://, kafka://, zmq+tcp://), or local://<channel> for the in-process stand-in below.
+# - Without a message queue each process only reaches its own websocket clients.
+def init_realtime(app):
+    options = {
+        'cors_allowed_origins': app.config['SOCKETIO_CORS_ORIGINS'],
+        'ping_timeout': 120,
+        'ping_interval': 20
+    }
+    url = app.config.get('SOCKETIO_MESSAGE_QUEUE')
+    if url and url.startswith('local://'):
+        options['client_manager'] = LocalPubSubManager(channel=url[len('local://'):] or 'flask-socketio')
+    elif url:
+        options['message_queue'] = url
+    socketio.init_app(app, **options)
+
+
+def emit_to_admins(event, data):
+    socketio.emit(event, data, to=ADMIN_ROOM)
+
+
+def emit_to_owner(owner_id, event, data):
+    socketio.emit(event, data, to=owner_room(owner_id))
+
+
+def emit_to_shop(username, event, data):
+    socketio.emit(event, data, to=shop_room(username))
+
+
+def emit_to_slots(username, date, event, data):
+    socketio.emit(event, data, to=slots_room(username, date))
+
+
+def _admin_session_valid():
+    expires_at = session.get('expires_at')
+    if 'admin_id' not in session or not expires_at:
+        return False
+    return datetime.now(MOSCOW_TZ) <= datetime.fromisoformat(expires_at)
+
+
+# Joins each connection to the rooms its session is entitled to.
+# - A valid admin session joins 'admin', a logged-in business owner joins 'owner:<id>'.
+# - Shop pages are public, so any client may pass {'shop': <username>} to join 'shop:<username>'.
+@socketio.on('connect')
+def handle_connect(auth=None):
+    rooms = []
+    if _admin_session_valid():
+        rooms.append(ADMIN_ROOM)
+    if 'owner_id' in session:
+        rooms.append(owner_room(session['owner_id']))
+
+    shop = (auth or {}).get('shop') or request.args.get('shop')
+    if shop:
+        rooms.append(shop_room(shop))
+
+    for room in rooms:
+        join_room(room)
+    logger.debug("Socket %s connected to rooms %s", request.sid, rooms)
+
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    logger.debug("Socket %s disconnected", request.sid)
+
+
+@socketio.on('subscribe_shop')
+def handle_subscribe_shop(data):
+    username = (data or {}).get('shop')
+    if username:
+        join_room(shop_room(username))
+
+
+@socketio.on('unsubscribe_shop')
+def handle_unsubscribe_shop(data):
+    username = (data or {}).get('shop')
+    if username:
+        leave_room(shop_room(username))
+
+
+# Shop pages subscribe to one (shop, date) pair at a time to receive 'slots_update' deltas
+# for the day the client is looking at: {'shop': <username>, 'date': 'YYYY-MM-DD'}.
+@socketio.on('subscribe_slots')
+def handle_subscribe_slots(data):
+    data = data or {}
+    if data.get('shop') and data.get('date'):
+        join_room(slots_room(data['shop'], data['date']))
+
+
+@socketio.on('unsubscribe_slots')
+def handle_unsubscribe_slots(data):
+    data = data or {}
+    if data.get('shop') and data.get('date'):
+        leave_room(slots_room(data['shop'], data['date']))
+
+
+# In-process stand-in for a message-queue backend.
+# - Every manager created in this process with the same channel receives every published message,
+#   the way separate workers would through Redis, so multi-worker fan-out can be exercised in tests
+#   and on a single development machine without a broker.
+class LocalPubSubManager(socketio_lib.PubSubManager):
+    name = 'local'
+
+    _subscribers = {}
+    _subscribers_lock = threading.Lock()
+
+    def __init__(self, channel='flask-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self._inbox = queue.Queue()
+        if not write_only:
+            with self._subscribers_lock:
+                self._subscribers.setdefault(channel, []).append(self._inbox)
+
+    def _publish(self, data):
+        with self._subscribers_lock:
+            inboxes = list(self._subscribers.get(self.channel, []))
+        for inbox in inboxes:
+            inbox.put(data)
+
+    def _listen(self):
+        while True:
+            yield self._inbox.get()
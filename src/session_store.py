@@ -0,0 +1,197 @@
+import logging
+import secrets
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from sqlalchemy import Column, Float, MetaData, String, Table, Text, delete, select
+from werkzeug.datastructures import CallbackDict
+
+logger = logging.getLogger(__name__)
+
+serializer = TaggedJSONSerializer()
+
+
+# Replaces Flask's signed-cookie session with a server-side store when SESSION_BACKEND is 'sqlite' or 'redis'.
+# - Only a random session ID travels in the cookie.
+# - The store is written only when the session actually changed during the request.
+# 'cookie' keeps Flask's default behaviour.
+def init_sessions(app, db):
+    backend_name = app.config.get('SESSION_BACKEND', 'cookie')
+    if backend_name == 'sqlite':
+        backend = SQLiteSessionBackend(db)
+    elif backend_name == 'redis':
+        backend = RedisSessionBackend(app.config['SESSION_REDIS_URL'])
+    elif backend_name == 'cookie':
+        return None
+    else:
+        raise ValueError(f"Unknown SESSION_BACKEND: {backend_name}")
+
+    app.session_interface = ServerSideSessionInterface(backend)
+    return backend
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, permanent=True):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+        self._default_permanent = permanent
+
+    # Moves the data to a fresh session ID; the old one is deleted from the store when the session is saved.
+    def regenerate(self):
+        if not self.new:
+            self.previous_sid = self.previous_sid or self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+    @property
+    def permanent(self):
+        return self.get('_permanent', self._default_permanent)
+
+    @permanent.setter
+    def permanent(self, value):
+        self['_permanent'] = bool(value)
+
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open_session(self, app, request):
+        permanent = app.config.get('SESSION_PERMANENT', True)
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.backend.load(sid)
+            if data is not None:
+                return ServerSession(data, sid=sid, permanent=permanent)
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True, permanent=permanent)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid:
+            self.backend.delete(session.previous_sid)
+
+        if not session:
+            if session.modified and not session.new:
+                self.backend.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not session.modified:
+            return
+
+        expires = self.get_expiration_time(app, session)
+        ttl = app.permanent_session_lifetime.total_seconds()
+        self.backend.save(session.sid, dict(session), time.time() + ttl)
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=expires,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+        response.vary.add('Cookie')
+
+
+# Stores sessions in a `server_session` table next to the application data.
+# - It uses its own connections rather than db.session, so saving a session never commits
+#   or rolls back anything a request handler left in the ORM session.
+class SQLiteSessionBackend:
+    def __init__(self, db):
+        self.db = db
+        self.table = Table(
+            'server_session', MetaData(),
+            Column('sid', String(64), primary_key=True),
+            Column('data', Text, nullable=False),
+            Column('expires_at', Float, nullable=False, index=True)
+        )
+        self._created = False
+
+    def _ensure_table(self):
+        if not self._created:
+            self.table.create(self.db.engine, checkfirst=True)
+            self._created = True
+
+    def load(self, sid):
+        self._ensure_table()
+        with self.db.engine.connect() as conn:
+            row = conn.execute(
+                select(self.table.c.data).where(self.table.c.sid == sid, self.table.c.expires_at > time.time())
+            ).first()
+        return serializer.loads(row.data) if row else None
+
+    def save(self, sid, data, expires_at):
+        self._ensure_table()
+        payload = serializer.dumps(data)
+        with self.db.engine.begin() as conn:
+            updated = conn.execute(
+                self.table.update().where(self.table.c.sid == sid).values(data=payload, expires_at=expires_at)
+            ).rowcount
+            if not updated:
+                conn.execute(self.table.insert().values(sid=sid, data=payload, expires_at=expires_at))
+
+    def delete(self, sid):
+        self._ensure_table()
+        with self.db.engine.begin() as conn:
+            conn.execute(delete(self.table).where(self.table.c.sid == sid))
+
+    def purge_expired(self):
+        self._ensure_table()
+        with self.db.engine.begin() as conn:
+            return conn.execute(delete(self.table).where(self.table.c.expires_at <= time.time())).rowcount
+
+
+# Stores sessions in Redis (or anything speaking its protocol) with the expiry as the key TTL.
+class RedisSessionBackend:
+    def __init__(self, url, prefix='mps:session:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def load(self, sid):
+        raw = self.client.get(self.prefix + sid)
+        return serializer.loads(raw.decode()) if raw else None
+
+    def save(self, sid, data, expires_at):
+        ttl = max(int(expires_at - time.time()), 1)
+        self.client.setex(self.prefix + sid, ttl, serializer.dumps(data))
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+    def purge_expired(self):
+        return 0
+
+
+# Gives the session a new ID once the user has authenticated, so an ID planted before login (session fixation)
+# is useless afterwards. Call it right before storing the login in the session.
+# - With the 'cookie' backend the whole session travels in the signed cookie and there is no ID to replace.
+def regenerate_session(session):
+    if isinstance(session, ServerSession):
+        session.regenerate()
+
+
+# Removes expired sessions; runs from the background scheduler.
+def purge_expired_sessions(app):
+    backend = getattr(app.session_interface, 'backend', None)
+    if backend is None:
+        return
+    with app.app_context():
+        try:
+            purged = backend.purge_expired()
+            if purged:
+                logger.info("Purged %s expired sessions", purged)
+        except Exception as e:
+            logger.error("Error purging expired sessions: %s", e)
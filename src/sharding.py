@@ -0,0 +1,415 @@
+import logging
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import click
+from flask import g, request, session
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, event, inspect, select, text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+from sqlalchemy.sql.util import find_tables
+
+from invalidation import DependencyCache, publish
+
+logger = logging.getLogger(__name__)
+
+CONTROL = 'control'
+
+# Tables holding one shop's data, in the order rebalancing copies them (parents first), with the condition
+# selecting one owner's rows. Everything else (users, owners, clients, services, admin tables, logs, OTPs,
+# sessions) stays in the control database.
+OWNER_TABLES = {
+    'appointment': 'owner_id = :owner_id',
+    'appointment_archive': 'owner_id = :owner_id',
+    'request_change': 'appointment_id IN (SELECT id FROM appointment WHERE owner_id = :owner_id)',
+    'feedback': 'owner_id = :owner_id',
+    'shop_capacity': 'owner_id = :owner_id',
+    'owner_update': 'owner_id = :owner_id',
+    'appointment_event': 'owner_id = :owner_id',
+    'owner_status_count': 'owner_id = :owner_id',
+    'owner_daily_earnings': 'owner_id = :owner_id',
+    'schedule_entry': 'owner_id = :owner_id',
+    'client_history_entry': 'owner_id = :owner_id',
+}
+
+SHARDED_TABLES = set(OWNER_TABLES) | {'appointment_history'}
+
+# Tables whose ids are referenced elsewhere (by clients, change requests, the event log) and so must stay unique
+# across databases; see _assign_partitioned_id.
+PARTITIONED_ID_TABLES = ('appointment', 'request_change', 'feedback')
+
+# Tables whose ids are only local order; their rows get fresh ids in the database they move to.
+REASSIGNED_ID_TABLES = {'shop_capacity', 'owner_update', 'appointment_event'}
+
+metadata = MetaData()
+
+# Where each owner's data lives: 'control' (data from before sharding, until rebalanced) or 'shard_<n>'.
+owner_shard = Table(
+    'owner_shard', metadata,
+    Column('owner_id', Integer, primary_key=True),
+    Column('shard', String(32), nullable=False)
+)
+
+# Id counters of PARTITIONED_ID_TABLES, one row per table in every database.
+shard_sequence = Table(
+    'shard_sequence', metadata,
+    Column('name', String(64), primary_key=True),
+    Column('next_value', Integer, nullable=False)
+)
+
+_db = None
+_engines = {}
+_engine_slots = {}
+_id_slots = None
+_placements = None
+_current_shard = ContextVar('current_shard', default=None)
+
+
+# Splits each shop's data out of the main SQLite file into SHARD_COUNT shard databases (SHARD_DATABASE_URI).
+# - The main database becomes the control database: global tables stay there, and so does every owner's data
+#   until `flask rebalance-shards` moves it to the shard the stable hash of the owner id picks.
+# - db.session routes each statement itself (see OwnerShardedSession), so handlers query as before.
+# SHARD_COUNT = 0 (the default) keeps the single database and registers nothing.
+def init_sharding(app, db):
+    global _db, _id_slots, _placements
+    count = app.config.get('SHARD_COUNT', 0)
+    if not count:
+        return None
+
+    _db = db
+    _engine_slots[CONTROL] = 0
+    for index in range(count):
+        name = f'shard_{index}'
+        _engines[name] = create_engine(app.config['SHARD_DATABASE_URI'].format(shard=index))
+        _engine_slots[name] = index + 1
+    _id_slots = app.config['SHARD_ID_SLOTS']
+    if count >= _id_slots:
+        raise ValueError(f"SHARD_COUNT must be below SHARD_ID_SLOTS ({_id_slots})")
+    _placements = DependencyCache('shard_placements', app.config['SHARD_PLACEMENT_CACHE_SIZE'])
+
+    app.before_request(_enter_request_shard)
+    app.teardown_request(_leave_request_shard)
+    event.listen(db.session, 'after_flush', _place_new_owners)
+
+    @app.cli.command('rebalance-shards', help="Move each shop's data to the shard its owner id hashes to.")
+    @click.option('--owner', 'owner_ids', multiple=True, type=int, help='Owner to move (repeatable; defaults to all).')
+    @click.option('--dry-run', is_flag=True, help='Only report the moves.')
+    def rebalance_shards_command(owner_ids, dry_run):
+        moves = rebalance(owner_ids or None, dry_run=dry_run)
+        for owner_id, source, target, rows in moves:
+            click.echo(f"Owner {owner_id}: {source} -> {target}" + ('' if dry_run else f" ({rows} rows)"))
+        click.echo(f"{'Would move' if dry_run else 'Moved'} {len(moves)} owners.")
+
+    logger.info("Sharding enabled with %s shards", count)
+    return _engines
+
+
+# Session options for SQLAlchemy(); the session class has to be chosen before the extension is created.
+def sharding_session_options(app):
+    return {'class_': OwnerShardedSession} if app.config.get('SHARD_COUNT') else {}
+
+
+def sharding_enabled():
+    return _db is not None
+
+
+# Control first, then the shards: the order fan-out results come back in.
+def database_names():
+    return [CONTROL] + list(_engines)
+
+
+def shard_names():
+    return list(_engines)
+
+
+def engine_for(name):
+    return _db.engine if name == CONTROL else _engines[name]
+
+
+# db.session when sharding is on. Flask-SQLAlchemy passes the extension as `db`, as it does to its own Session.
+# - Flushes write each row to its owner's database.
+# - Reads of global tables go to control; reads of shop tables go to the database of the owner the request
+#   is about, or of the owner_id the query filters on, and otherwise to every database with results concatenated.
+class OwnerShardedSession(ShardedSession):
+    def __init__(self, db, **kwargs):
+        super().__init__(
+            shard_chooser=choose_shard,
+            identity_chooser=choose_identity_shards,
+            execute_chooser=choose_query_shards,
+            shards={CONTROL: db.engine, **_engines},
+            **kwargs
+        )
+        self._db = db
+        self._model_changes = {}
+
+
+def choose_shard(mapper, instance, clause=None):
+    if mapper is None or mapper.local_table.name not in SHARDED_TABLES:
+        return CONTROL
+    if instance is not None:
+        state = inspect(instance)
+        if state.identity_token is not None:
+            return state.identity_token
+        shard = _instance_shard(instance)
+        if shard:
+            return shard
+    return _current_shard.get() or CONTROL
+
+
+# New rows go to their owner's database; change requests (which have no owner_id) follow their appointment.
+def _instance_shard(instance):
+    owner_id = getattr(instance, 'owner_id', None)
+    if owner_id is not None:
+        return shard_of(owner_id)
+    appointment_id = getattr(instance, 'appointment_id', None)
+    owner_session = inspect(instance).session
+    if appointment_id is not None and owner_session is not None:
+        for key, obj in owner_session.identity_map.items():
+            if inspect(obj).mapper.local_table.name == 'appointment' and key[1] == (appointment_id,):
+                return key[2]
+    return None
+
+
+def choose_identity_shards(mapper, primary_key, *, lazy_loaded_from=None, **kwargs):
+    if mapper.local_table.name not in SHARDED_TABLES:
+        return [CONTROL]
+    if lazy_loaded_from is not None and lazy_loaded_from.identity_token is not None:
+        return [lazy_loaded_from.identity_token]
+    shard = _current_shard.get()
+    return [shard] if shard else database_names()
+
+
+def choose_query_shards(orm_context):
+    statement = orm_context.statement
+    tables = {table.name for table in find_tables(statement, include_crud=True)}
+    if orm_context.bind_mapper is not None:
+        tables.add(orm_context.bind_mapper.local_table.name)
+
+    sharded = tables & SHARDED_TABLES
+    if not sharded:
+        return [CONTROL]
+    if tables - sharded:
+        raise RuntimeError(f"Query joins shop tables {sorted(sharded)} with global tables {sorted(tables - sharded)}; "
+                           f"they live in different databases")
+
+    shard = _current_shard.get() or _filtered_owner_shard(statement)
+    return [shard] if shard else database_names()
+
+
+# The database of the single owner a statement filters on with `owner_id = <value>`, if there is one.
+def _filtered_owner_shard(statement):
+    owner_ids = set()
+    for element in visitors.iterate(statement):
+        if isinstance(element, BinaryExpression) and element.operator is operators.eq:
+            for column, value in ((element.left, element.right), (element.right, element.left)):
+                if getattr(column, 'name', None) == 'owner_id' and isinstance(value, BindParameter):
+                    owner_ids.add(value.effective_value)
+    if len(owner_ids) == 1 and None not in owner_ids:
+        return shard_of(owner_ids.pop())
+    return None
+
+
+# The stable placement of an owner that has none recorded: the same shard in every process and on every run.
+def hash_shard(owner_id):
+    return f'shard_{zlib.crc32(str(owner_id).encode()) % len(_engines)}'
+
+
+# The database holding the owner's data, from owner_shard; owners without a row are still in control.
+def shard_of(owner_id):
+    owner_id = int(owner_id)
+    return _placements.get(owner_id, lambda: _load_placement(owner_id), [f'owner:{owner_id}:shard'])
+
+
+def _load_placement(owner_id):
+    with _db.engine.connect() as conn:
+        shard = conn.execute(select(owner_shard.c.shard).where(owner_shard.c.owner_id == owner_id)).scalar()
+    if shard is not None and shard != CONTROL and shard not in _engines:
+        raise RuntimeError(f"Owner {owner_id} is placed on unknown shard {shard}; check SHARD_COUNT")
+    return shard or CONTROL
+
+
+# Owners registered while sharding is on start on their hash shard; the placement commits with the owner.
+def _place_new_owners(session, flush_context):
+    owner_ids = [obj.id for obj in session.new if inspect(obj).mapper.local_table.name == 'business_owner']
+    if owner_ids:
+        session.execute(insert(owner_shard).on_conflict_do_nothing(index_elements=['owner_id']),
+                        [{'owner_id': owner_id, 'shard': hash_shard(owner_id)} for owner_id in owner_ids])
+
+
+# Requests about one shop run against its database only: owner dashboard calls by the session's owner,
+# public shop pages by the owner in the URL.
+def _enter_request_shard():
+    owner_id = None
+    view_args = request.view_args or {}
+    if 'owner_id' in view_args:
+        owner_id = view_args['owner_id']
+    elif 'username' in view_args:
+        from business_owner.owner_cache import get_owner_by_username
+        owner = get_owner_by_username(view_args['username'])
+        owner_id = owner.id if owner else None
+    elif request.path.startswith('/api/business_owner/'):
+        owner_id = session.get('owner_id')
+    if owner_id is not None:
+        g.shard_token = _current_shard.set(shard_of(owner_id))
+
+
+def _leave_request_shard(exc):
+    token = g.pop('shard_token', None)
+    if token is not None:
+        _current_shard.reset(token)
+
+
+# Runs the block against one owner's database, e.g. in scheduled jobs and CLI commands.
+@contextmanager
+def shard_scope(owner_id):
+    token = _current_shard.set(shard_of(owner_id))
+    try:
+        yield
+    finally:
+        _current_shard.reset(token)
+
+
+# Gives rows of PARTITIONED_ID_TABLES ids no other database can hand out: counter * SHARD_ID_SLOTS + slot,
+# where control is slot 0 and shard_<n> slot n + 1. The counter is read and bumped in the inserting transaction,
+# so it costs no cross-database locking, and ids survive rows moving between databases.
+def _assign_partitioned_id(mapper, connection, target):
+    if target.id is not None:
+        return
+    counter = connection.execute(text(
+        "UPDATE shard_sequence SET next_value = next_value + 1 WHERE name = :name RETURNING next_value"
+    ), {'name': mapper.local_table.name}).scalar_one()
+    target.id = counter * _id_slots + _slot_of(connection.engine)
+
+
+def _slot_of(engine):
+    for name in database_names():
+        if engine_for(name) is engine:
+            return _engine_slots[name]
+    raise RuntimeError(f"Engine {engine.url} is not a shard")
+
+
+# Creates the shop tables in every shard, plus the placement and id counters; runs at startup.
+# - `setup` functions take an engine and add what create_all cannot (views, triggers).
+# - Id counters start above every id already in control, so ids from before sharding never come back.
+def init_shard_schemas(db, setup=()):
+    tables = [db.metadata.tables[name] for name in OWNER_TABLES]
+    metadata.create_all(db.engine)
+
+    with db.engine.connect() as conn:
+        floors = {name: conn.execute(text(
+            f"SELECT MAX(id) FROM (SELECT MAX(id) AS id FROM {name}"
+            + (" UNION ALL SELECT MAX(id) FROM appointment_archive" if name == 'appointment' else '') + ")"
+        )).scalar() or 0 for name in PARTITIONED_ID_TABLES}
+
+    for name in database_names():
+        engine = engine_for(name)
+        if name != CONTROL:
+            db.metadata.create_all(engine, tables=tables)
+        shard_sequence.create(engine, checkfirst=True)
+        with engine.begin() as conn:
+            for table, floor in floors.items():
+                conn.execute(insert(shard_sequence).on_conflict_do_nothing(index_elements=['name']),
+                             {'name': table, 'next_value': 0})
+                conn.execute(text(
+                    "UPDATE shard_sequence SET next_value = MAX(next_value, :start) WHERE name = :name"
+                ), {'name': table, 'start': floor // _id_slots + 1})
+        if name != CONTROL:
+            for fn in setup:
+                fn(engine)
+
+    for mapper in db.Model.registry.mappers:
+        if mapper.local_table.name in PARTITIONED_ID_TABLES:
+            event.listen(mapper, 'before_insert', _assign_partitioned_id)
+
+
+# Moves owners' data to the shard their id hashes to (or keeps it where it is when already there).
+# - Each owner moves in two transactions: the copy commits in the target first, replacing any leftovers of an
+#   earlier interrupted move, then the rows are deleted from every other database and the placement updated.
+#   A failure in between leaves the owner readable where owner_shard points, with a stale copy the next run replaces.
+# - Writes to the shop during its move may be lost; run it while the shops being moved are quiet.
+# - Rows of REASSIGNED_ID_TABLES get new ids in the target, in their original order; a dashboard that kept an
+#   owner_update version from before the move is told to reload.
+# - Returns (owner_id, source, target, rows moved) per owner moved.
+def rebalance(owner_ids=None, dry_run=False):
+    with _db.engine.connect() as conn:
+        if owner_ids is None:
+            owner_ids = conn.execute(text("SELECT id FROM business_owner ORDER BY id")).scalars().all()
+        placed = dict(conn.execute(select(owner_shard.c.owner_id, owner_shard.c.shard)).all())
+
+    moves = []
+    for owner_id in owner_ids:
+        source = placed.get(owner_id, CONTROL)
+        target = hash_shard(owner_id)
+        holders = [name for name in database_names() if name != target and _holds_owner(name, owner_id)]
+        if not holders and source == target:
+            continue
+        if dry_run:
+            moves.append((owner_id, source, target, None))
+            continue
+        moves.append((owner_id, source, target, _move_owner(owner_id, holders, target)))
+    return moves
+
+
+def _holds_owner(name, owner_id):
+    with engine_for(name).connect() as conn:
+        return any(conn.execute(text(f"SELECT 1 FROM {table} WHERE {condition} LIMIT 1"),
+                                {'owner_id': owner_id}).first()
+                   for table, condition in OWNER_TABLES.items())
+
+
+def _move_owner(owner_id, holders, target):
+    params = {'owner_id': owner_id}
+    copied = {}
+    for holder in holders:
+        with engine_for(holder).connect() as conn:
+            for table, condition in OWNER_TABLES.items():
+                order = ' ORDER BY id' if table in REASSIGNED_ID_TABLES else ''
+                rows = [dict(row) for row in conn.execute(
+                    text(f"SELECT * FROM {table} WHERE {condition}{order}"), params).mappings()]
+                if table in REASSIGNED_ID_TABLES:
+                    for row in rows:
+                        row.pop('id')
+                copied.setdefault(table, []).extend(rows)
+
+    if holders:
+        with engine_for(target).begin() as conn:
+            _delete_owner_rows(conn, owner_id)
+            for table in OWNER_TABLES:
+                rows = copied.get(table)
+                if rows:
+                    columns = list(rows[0])
+                    conn.execute(text(
+                        f"INSERT INTO {table} ({', '.join(columns)}) "
+                        f"VALUES ({', '.join(':' + column for column in columns)})"
+                    ), rows)
+
+    for holder in holders:
+        with engine_for(holder).begin() as conn:
+            _delete_owner_rows(conn, owner_id)
+
+    with _db.engine.begin() as conn:
+        conn.execute(insert(owner_shard).on_conflict_do_update(index_elements=['owner_id'], set_={'shard': target}),
+                     {'owner_id': owner_id, 'shard': target})
+    publish([f'owner:{owner_id}:shard'])
+
+    moved = sum(len(rows) for rows in copied.values())
+    logger.info("Moved %s rows of owner %s from %s to %s", moved, owner_id, holders, target)
+    return moved
+
+
+# Deletes an owner's rows, children first; append-only triggers are lifted for the delete and restored
+# in the same transaction.
+def _delete_owner_rows(conn, owner_id):
+    triggers = conn.execute(text(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name IN "
+        f"({', '.join(repr(table) for table in OWNER_TABLES)})"
+    )).all()
+    for trigger in triggers:
+        conn.execute(text(f"DROP TRIGGER {trigger.name}"))
+    for table, condition in reversed(list(OWNER_TABLES.items())):
+        conn.execute(text(f"DELETE FROM {table} WHERE {condition}"), {'owner_id': owner_id})
+    for trigger in triggers:
+        conn.execute(text(trigger.sql))
@@ -0,0 +1,97 @@
+import logging
+import threading
+from functools import wraps
+
+from flask import Response, current_app, request
+
+from realtime import socketio
+
+logger = logging.getLogger(__name__)
+
+# Headers that belong to one client and must not be copied onto responses shared with others.
+PRIVATE_HEADERS = ('Set-Cookie', 'Content-Length', 'Vary')
+
+
+class _Call:
+    def __init__(self, event):
+        self.event = event
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+def _new_event():
+    # Under eventlet/gevent the Socket.IO server hands out green events, so waiters yield instead of blocking the hub.
+    server = getattr(socketio, 'server', None)
+    return server.eio.create_event() if server else threading.Event()
+
+
+# Runs at most one computation per key at a time; concurrent callers with the same key wait for it
+# and receive the same result (or the same exception).
+class SingleFlight:
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _Call(_new_event())
+                self.calls += 1
+            else:
+                call.waiters += 1
+                self.shared += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.event.set()
+            if call.waiters:
+                logger.debug("Coalesced %d requests for %s", call.waiters, key)
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'shared': self.shared, 'in_flight': len(self._in_flight)}
+
+
+flights = SingleFlight()
+
+
+# Coalesces identical concurrent GET requests to a public read endpoint.
+# - The key is the endpoint with its URL and query arguments, sorted; the session, cookies and headers are not part of it,
+#   so only use it on views whose response depends on nothing else.
+# - The first request runs the view; the others wait and get a copy of its serialized response.
+# - Conditional GET is applied per request afterwards, so a shared response with an ETag still yields 304 where it should.
+def coalesced(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (
+            request.endpoint,
+            tuple(sorted(kwargs.items())),
+            tuple(sorted(request.args.items(multi=True)))
+        )
+
+        def run():
+            response = current_app.make_response(view(*args, **kwargs))
+            headers = [(name, value) for name, value in response.headers if name not in PRIVATE_HEADERS]
+            return response.get_data(), response.status_code, headers
+
+        body, status, headers = flights.do(key, run)
+        return Response(body, status=status, headers=headers).make_conditional(request)
+    return wrapper
@@ -0,0 +1,188 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+
+import click
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header, parse_etags
+from werkzeug.wsgi import wrap_file
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = '.static-manifest.json'
+INDEX_FILE = 'index.html'
+SPA_ENDPOINT = 'serve_react_app'
+
+# Create React App names build output like main.3f2a1b9c.chunk.js; such files never change content.
+HASHED_NAME_PATTERN = re.compile(r'\.[0-9a-f]{8,}\.')
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+MIN_COMPRESS_SIZE = 1024
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Serves the React production build from STATIC_BUILD_DIR ahead of Flask.
+# - Runs as WSGI middleware, so asset requests never open a session or reach before_request/DB hooks.
+# - Paths Flask would route to serve_react_app get index.html the same way.
+# - Install it before init_realtime() so Socket.IO traffic is still intercepted first.
+def init_static_assets(app):
+    @app.cli.command('ingest-static', help='Fingerprint and precompress the React build.')
+    @click.option('--build-dir', default=None, help='React build directory (defaults to STATIC_BUILD_DIR).')
+    def ingest_static_command(build_dir):
+        manifest = ingest_build(build_dir or app.config['STATIC_BUILD_DIR'])
+        click.echo(f"Ingested {len(manifest)} static files.")
+
+    root = app.config.get('STATIC_BUILD_DIR')
+    if not root or not os.path.isdir(root):
+        logger.info("No React build found at %s; static files are served by Flask.", root)
+        return None
+
+    manifest = load_manifest(root)
+    app.wsgi_app = StaticAssets(app, app.wsgi_app, root, manifest)
+    return app.wsgi_app
+
+
+# Fingerprints every file of a build and writes .gz/.br variants next to compressible ones.
+# - The content hash becomes the ETag; hashed file names are marked immutable.
+# - A variant is kept only when it is smaller than the original.
+# - The result is written to the build directory as MANIFEST_NAME and returned.
+def ingest_build(root):
+    manifest = scan_build(root, compress=True)
+    with open(os.path.join(root, MANIFEST_NAME), 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    logger.info("Ingested %s static files from %s", len(manifest), root)
+    return manifest
+
+
+def load_manifest(root):
+    path = os.path.join(root, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path) as file:
+            return json.load(file)
+    logger.warning("%s not found in %s; run `flask ingest-static` to precompress the build.", MANIFEST_NAME, root)
+    return scan_build(root, compress=False)
+
+
+def scan_build(root, compress):
+    manifest = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if name.startswith('.') or name.endswith(('.gz', '.br')):
+                continue
+            path = os.path.join(directory, name)
+            key = os.path.relpath(path, root).replace(os.sep, '/')
+            with open(path, 'rb') as file:
+                content = file.read()
+
+            mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            entry = {
+                'etag': hashlib.sha256(content).hexdigest()[:20],
+                'mimetype': mimetype,
+                'immutable': bool(HASHED_NAME_PATTERN.search(name)),
+                'sizes': {'identity': len(content)}
+            }
+            if compress and len(content) >= MIN_COMPRESS_SIZE and mimetype.startswith(COMPRESSIBLE_TYPES):
+                _write_variants(path, content, entry)
+            else:
+                _collect_variants(path, entry)
+            manifest[key] = entry
+    return manifest
+
+
+def _write_variants(path, content, entry):
+    variants = {'gzip': ('.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0))}
+    if brotli is not None:
+        variants['br'] = ('.br', lambda data: brotli.compress(data, quality=11))
+
+    for encoding, (suffix, compress) in variants.items():
+        compressed = compress(content)
+        if len(compressed) < len(content):
+            with open(path + suffix, 'wb') as file:
+                file.write(compressed)
+            entry['sizes'][encoding] = len(compressed)
+        elif os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+# Picks up variants produced by an external build step (e.g. a compression plugin).
+def _collect_variants(path, entry):
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if os.path.exists(path + suffix):
+            entry['sizes'][encoding] = os.path.getsize(path + suffix)
+
+
+class StaticAssets:
+    def __init__(self, app, wsgi_app, root, manifest):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.root = root
+        self.manifest = manifest
+        self.max_age = app.config.get('STATIC_IMMUTABLE_MAX_AGE', 31536000)
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] in ('GET', 'HEAD'):
+            key = self._resolve(environ)
+            if key:
+                return self.serve(key, environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+    # Returns the manifest key to serve, or None to hand the request to Flask.
+    def _resolve(self, environ):
+        key = environ.get('PATH_INFO', '').lstrip('/')
+        if key in self.manifest:
+            return key
+        if INDEX_FILE not in self.manifest:
+            return None
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None
+        return INDEX_FILE if endpoint == SPA_ENDPOINT else None
+
+    def serve(self, key, environ, start_response):
+        entry = self.manifest[key]
+        encoding = self._negotiate(entry, environ)
+        etag = entry['etag'] if encoding == 'identity' else f"{entry['etag']}-{encoding}"
+
+        headers = [
+            ('ETag', f'"{etag}"'),
+            ('Vary', 'Accept-Encoding'),
+            ('Cache-Control', f'public, max-age={self.max_age}, immutable' if entry['immutable'] else 'no-cache')
+        ]
+
+        if parse_etags(environ.get('HTTP_IF_NONE_MATCH')).contains(etag):
+            start_response('304 Not Modified', headers)
+            return []
+
+        mimetype = entry['mimetype']
+        if mimetype.startswith('text/') or mimetype == 'application/javascript':
+            mimetype += '; charset=utf-8'
+        headers.append(('Content-Type', mimetype))
+        headers.append(('Content-Length', str(entry['sizes'][encoding])))
+        if encoding != 'identity':
+            headers.append(('Content-Encoding', encoding))
+
+        start_response('200 OK', headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+
+        path = os.path.join(self.root, *key.split('/'))
+        if encoding != 'identity':
+            path += '.br' if encoding == 'br' else '.gz'
+        # wrap_file hands the file to the server's wsgi.file_wrapper, which uses sendfile where the server supports it.
+        return wrap_file(environ, open(path, 'rb'))
+
+    @staticmethod
+    def _negotiate(entry, environ):
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        for encoding in ('br', 'gzip'):
+            if encoding in entry['sizes'] and accepted[encoding]:
+                return encoding
+        return 'identity'
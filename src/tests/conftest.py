@@ -0,0 +1,39 @@
+import os
+import sys
+import tempfile
+import uuid
+from datetime import time
+
+import pytest
+
+# The application modules are imported as top-level modules from src/, as run.py does.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Tests that import the app run against scratch databases, never the mps.db next to config.py.
+_scratch_dir = tempfile.mkdtemp(prefix='mps-tests-')
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite:///' + os.path.join(_scratch_dir, 'mps.db'))
+os.environ.setdefault('SHARD_DATABASE_URI', 'sqlite:///' + os.path.join(_scratch_dir, 'mps_shard_{shard}.db'))
+
+
+# A new approved shop, open 09:00-18:00 every day, with one 30-minute service.
+@pytest.fixture()
+def shop():
+    from werkzeug.security import generate_password_hash
+    from official_website import app, db
+    from official_website.models import User, Service, WorkingHours
+    from business_owner.models import BusinessOwner
+
+    with app.app_context():
+        db.create_all()
+        username = 'shop_%s' % uuid.uuid4().hex[:8]
+        user = User(personal_name='Owner', company_name=username, store_address='Street 1', phone_number='+79990000000', email=username + '@example.com', status='Approved')
+        db.session.add(user)
+        db.session.flush()
+        service = Service(title='Haircut', cost=30, description='Short cut', service_time=30, user_id=user.id)
+        db.session.add(service)
+        for day in ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']:
+            db.session.add(WorkingHours(day=day, start_time=time(9), end_time=time(18), user_id=user.id))
+        owner = BusinessOwner(user_id=user.id, personal_name='Owner', company_name=username, store_address='Street 1', phone_number='+79990000000', email=username + '@example.com', username=username, password=generate_password_hash('password'), qr_code_link='qr')
+        db.session.add(owner)
+        db.session.commit()
+        return {'username': username, 'owner_id': owner.id, 'user_id': user.id, 'service_id': service.id}
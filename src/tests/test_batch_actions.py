@@ -0,0 +1,63 @@
+import importlib
+from datetime import datetime, timedelta
+
+from official_website import app, db
+from business_owner.models import Appointment
+from business_owner.status import AppointmentStatus
+
+importlib.import_module('client')  # Registers the client portal routes used by the app
+
+
+def reserve(shop, phone, hour):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['verified_phone_number'] = phone
+        sess['option_selected'] = 'no'
+    day = (datetime.now() + timedelta(days=3)).strftime('%Y-%m-%d')
+    response = client.post('/api/shop/%s/reserve' % shop['username'], json={
+        'client_name': 'Client', 'client_email': 'client@example.com',
+        'services': [{'id': shop['service_id'], 'quantity': 1}], 'date': '%s %02d:00' % (day, hour),
+    })
+    assert response.status_code == 200, response.get_json()
+    with app.app_context():
+        return Appointment.query.filter_by(owner_id=shop['owner_id'], phone_number=phone).one().id
+
+
+def owner_client(shop):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['owner_id'] = shop['owner_id']
+        sess['user_id'] = shop['user_id']
+    return client
+
+
+def test_batch_report_records_report_on_each_appointment(shop):
+    ids = [reserve(shop, '+79991110001', 10), reserve(shop, '+79991110002', 11)]
+
+    response = owner_client(shop).post('/api/business_owner/reservations/batch', json={
+        'action': 'report', 'reservation_ids': ids + [999999], 'report_details': 'No-show',
+    })
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['changed'] == 2 and body['failed'] == 1
+    results = {result['id']: result for result in body['results']}
+    assert [results[i]['result'] for i in ids] == ['ok', 'ok']
+    assert all(results[i]['status'] == AppointmentStatus.REPORTED for i in ids)
+    assert results[999999]['result'] == 'error'
+    with app.app_context():
+        for appointment in Appointment.query.filter(Appointment.id.in_(ids)):
+            assert appointment.status == AppointmentStatus.REPORTED
+            assert appointment.report_details == 'No-show'
+
+
+def test_batch_report_requires_details(shop):
+    ids = [reserve(shop, '+79991110003', 12)]
+
+    response = owner_client(shop).post('/api/business_owner/reservations/batch', json={
+        'action': 'report', 'reservation_ids': ids,
+    })
+
+    assert response.status_code == 400
+    with app.app_context():
+        assert db.session.get(Appointment, ids[0]).status != AppointmentStatus.REPORTED
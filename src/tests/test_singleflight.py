@@ -0,0 +1,318 @@
+import importlib
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from official_website import app
+from realtime import socketio
+from singleflight import SingleFlight, coalesced, flights
+
+importlib.import_module('client')  # Registers the client portal routes used by the app
+
+WAITERS = 8
+
+
+# Starts `count` threads calling flight.do(key, fn) and returns them with the list their outcomes land in.
+def start_callers(flight, key, fn, count):
+    outcomes = []
+    lock = threading.Lock()
+
+    def call():
+        try:
+            outcome = ('result', flight.do(key, fn))
+        except Exception as e:
+            outcome = ('error', e)
+        with lock:
+            outcomes.append(outcome)
+
+    threads = [threading.Thread(target=call) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+
+# Waits until `shared` callers in total have queued behind a computation of `flight`; False on timeout.
+def wait_for_shared(flight, shared, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if flight.stats()['shared'] >= shared:
+            return True
+        time.sleep(0.001)
+    return False
+
+
+def join(threads):
+    for thread in threads:
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+
+def test_one_computation_serves_all_waiters():
+    flight = SingleFlight()
+    gate = threading.Event()
+    computed = []
+
+    def compute():
+        computed.append(1)
+        gate.wait(5)
+        return object()
+
+    threads, outcomes = start_callers(flight, 'shop', compute, WAITERS)
+    assert wait_for_shared(flight, WAITERS - 1)
+    gate.set()
+    join(threads)
+
+    assert len(computed) == 1
+    assert len(outcomes) == WAITERS
+    assert all(kind == 'result' for kind, _ in outcomes)
+    assert len({id(value) for _, value in outcomes}) == 1
+    assert flight.stats() == {'calls': 1, 'shared': WAITERS - 1, 'in_flight': 0}
+
+
+def test_error_reaches_every_waiter():
+    flight = SingleFlight()
+    gate = threading.Event()
+    error = ValueError('catalog unavailable')
+
+    def compute():
+        gate.wait(5)
+        raise error
+
+    threads, outcomes = start_callers(flight, 'shop', compute, WAITERS)
+    assert wait_for_shared(flight, WAITERS - 1)
+    gate.set()
+    join(threads)
+
+    assert len(outcomes) == WAITERS
+    assert all(kind == 'error' and value is error for kind, value in outcomes)
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_completed_computation_is_not_reused():
+    flight = SingleFlight()
+    computed = []
+
+    def compute():
+        computed.append(1)
+        return len(computed)
+
+    assert flight.do('shop', compute) == 1
+    assert flight.do('shop', compute) == 2
+    assert flight.stats() == {'calls': 2, 'shared': 0, 'in_flight': 0}
+
+
+def test_failed_computation_is_not_reused():
+    flight = SingleFlight()
+
+    def fail():
+        raise RuntimeError('first call fails')
+
+    with pytest.raises(RuntimeError):
+        flight.do('shop', fail)
+    assert flight.do('shop', lambda: 'recovered') == 'recovered'
+
+
+def test_different_keys_do_not_coalesce():
+    flight = SingleFlight()
+    gate = threading.Event()
+    started = threading.Barrier(3, timeout=5)
+
+    def compute():
+        started.wait()
+        gate.wait(5)
+        return threading.get_ident()
+
+    first, first_outcomes = start_callers(flight, 'shop-a', compute, 1)
+    second, second_outcomes = start_callers(flight, 'shop-b', compute, 1)
+    started.wait()
+    gate.set()
+    join(first + second)
+
+    assert flight.stats() == {'calls': 2, 'shared': 0, 'in_flight': 0}
+    assert first_outcomes[0][1] != second_outcomes[0][1]
+
+
+# Stands in for the Socket.IO server under eventlet/gevent, whose engine.io server hands out green events.
+class GreenServer:
+    def __init__(self):
+        self.eio = self
+        self.events = []
+
+    def create_event(self):
+        green_event = threading.Event()
+        self.events.append(green_event)
+        return green_event
+
+
+def test_waiters_wait_on_the_socketio_servers_event(monkeypatch):
+    server = GreenServer()
+    monkeypatch.setattr(socketio, 'server', server)
+    flight = SingleFlight()
+    gate = threading.Event()
+
+    def compute():
+        gate.wait(5)
+        return 'catalog'
+
+    threads, outcomes = start_callers(flight, 'shop', compute, WAITERS)
+    assert wait_for_shared(flight, WAITERS - 1)
+    gate.set()
+    join(threads)
+
+    assert len(server.events) == 1 and server.events[0].is_set()
+    assert outcomes == [('result', 'catalog')] * WAITERS
+
+
+# Counts the statements reading `table` while the block runs. The first one is held until `waiters` more
+# requests have queued behind the coalesced view it runs in; `held` is set once it is.
+@contextmanager
+def hold_first_read(table, waiters):
+    pattern = re.compile(r'\bFROM %s\b' % table)
+    target = flights.stats()['shared'] + waiters
+    reads = []
+    held = threading.Event()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if pattern.search(statement):
+            reads.append(statement)
+            if len(reads) == 1:
+                held.set()
+                wait_for_shared(flights, target)
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield reads, held
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def shop_client(**session_values):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['option_selected'] = 'no'
+        sess.update(session_values)
+    return client
+
+
+# Sends one GET per (client, url, headers) from its own thread and returns the responses in the same order.
+def get_concurrently(requests):
+    responses = [None] * len(requests)
+
+    def get(index, client, url, headers):
+        responses[index] = client.get(url, headers=headers)
+
+    threads = [threading.Thread(target=get, args=(index,) + tuple(req)) for index, req in enumerate(requests)]
+    for thread in threads:
+        thread.start()
+    join(threads)
+    return responses
+
+
+# Sends the leader request, waits until its view reads `table`, then sends the waiters while the leader is held there.
+def coalesce(table, leader, waiters):
+    before = flights.stats()
+    with hold_first_read(table, len(waiters)) as (reads, held):
+        leader_response = []
+        client, url, headers = leader
+        leader_thread = threading.Thread(target=lambda: leader_response.append(client.get(url, headers=headers)))
+        leader_thread.start()
+        assert held.wait(5)
+        waiter_responses = get_concurrently(waiters)
+        join([leader_thread])
+    after = flights.stats()
+    return leader_response[0], waiter_responses, len(reads), after['calls'] - before['calls'], after['shared'] - before['shared']
+
+
+def test_concurrent_shop_data_requests_share_one_catalog_read(shop):
+    url = '/api/shop/%s/data' % shop['username']
+    waiters = [(shop_client(), url, {}) for _ in range(WAITERS - 1)]
+
+    leader, responses, reads, calls, shared = coalesce('shop_catalog', (shop_client(), url, {}), waiters)
+
+    assert reads == 1
+    assert (calls, shared) == (1, WAITERS - 1)
+    assert leader.status_code == 200
+    for response in responses:
+        assert response.status_code == 200
+        assert response.get_data() == leader.get_data()
+        assert response.headers['ETag'] == leader.headers['ETag']
+        assert int(response.headers['Content-Length']) == len(leader.get_data())
+
+
+def test_concurrent_slot_requests_share_one_bookings_read(shop):
+    day = (datetime.now() + timedelta(days=3)).strftime('%Y-%m-%d')
+    path = '/api/shop/%s/available_slots' % shop['username']
+    url = '%s?date=%s&service_id=%s' % (path, day, shop['service_id'])
+    # The key sorts the query arguments, so their order in the URL does not matter.
+    reordered = '%s?service_id=%s&date=%s' % (path, shop['service_id'], day)
+    waiters = [(shop_client(), url if index % 2 else reordered, {}) for index in range(WAITERS - 1)]
+
+    leader, responses, reads, calls, shared = coalesce('appointment', (shop_client(), url, {}), waiters)
+
+    assert reads == 1
+    assert (calls, shared) == (1, WAITERS - 1)
+    assert leader.status_code == 200 and leader.get_json()['available_slots']
+    assert all(response.get_data() == leader.get_data() for response in responses)
+
+
+def test_waiter_revalidates_its_own_etag_and_gets_no_leader_cookie(shop):
+    url = '/api/shop/%s/data' % shop['username']
+    etag = shop_client().get(url).headers['ETag']
+    # The owner session has no last_activity yet, so the leader's request rewrites it and gets a Set-Cookie of its own.
+    owner = shop_client(owner_id=shop['owner_id'], user_id=shop['user_id'])
+    waiters = [(shop_client(), url, {'If-None-Match': etag}) for _ in range(WAITERS - 1)]
+
+    leader, responses, reads, calls, shared = coalesce('shop_catalog', (owner, url, {}), waiters)
+
+    assert (calls, shared) == (1, WAITERS - 1)
+    assert leader.status_code == 200 and 'Set-Cookie' in leader.headers
+    for response in responses:
+        assert response.status_code == 304
+        assert response.get_data() == b''
+        assert response.headers['ETag'] == etag
+        assert 'Set-Cookie' not in response.headers
+
+
+def test_shared_response_drops_the_leaders_private_headers():
+    view_app = Flask(__name__)
+    entered = threading.Event()
+    gate = threading.Event()
+
+    @view_app.route('/catalog')
+    @coalesced
+    def catalog():
+        entered.set()
+        gate.wait(5)
+        response = Response(b'{"services": []}', mimetype='application/json')
+        response.set_etag('v1')
+        response.set_cookie('leader', 'private')
+        response.headers['Vary'] = 'Cookie'
+        return response
+
+    before = flights.stats()['shared']
+    leader, responses = [], []
+    leader_thread = threading.Thread(target=lambda: leader.append(view_app.test_client().get('/catalog')))
+    leader_thread.start()
+    assert entered.wait(5)
+    revalidating = [index % 2 == 0 for index in range(WAITERS - 1)]
+    waiters = [(view_app.test_client(), '/catalog', {'If-None-Match': '"v1"'} if etag else {}) for etag in revalidating]
+    waiters_thread = threading.Thread(target=lambda: responses.extend(get_concurrently(waiters)))
+    waiters_thread.start()
+    assert wait_for_shared(flights, before + WAITERS - 1)
+    gate.set()
+    join([leader_thread, waiters_thread])
+
+    assert leader[0].status_code == 200
+    for response in leader + responses:
+        assert 'Set-Cookie' not in response.headers and 'Vary' not in response.headers
+    for etag, response in zip(revalidating, responses):
+        assert response.status_code == (304 if etag else 200)
+    for response in leader + [response for etag, response in zip(revalidating, responses) if not etag]:
+        assert response.headers.getlist('Content-Length') == [str(len(response.get_data()))]